@@ -2,22 +2,75 @@
 Workflow to set up a constant pH calculations of ligands with GROMOS
 """
 
-#imports
-from .utils import load_config_yaml, create_dataclass_file
+# Importing constph is kept cheap: submodules, their dependencies (yaml, dacite, numpy) and
+# the version lookup are only loaded when first accessed.
+import importlib
 
+# public names -> submodule they are imported from
+_lazy_attributes = {
+    "load_config_yaml": "utils",
+    "create_dataclass_file": "utils",
+    "load_campaign": "campaign",
+}
+_submodules = {
+    "analysis",
+    "assets",
+    "atomic",
+    "batch",
+    "campaign",
+    "column_cache",
+    "convergence",
+    "constants",
+    "gromos_factory",
+    "imd",
+    "imd_template",
+    "mbar",
+    "output_budget",
+    "pipeline",
+    "segments",
+    "setup_manifest",
+    "tre",
+    "state",
+    "system",
+    "tail",
+    "titration",
+    "tuning",
+    "typed_config",
+    "uncertainty",
+    "utils",
+    "validation",
+}
 
-# Handle versioneer
-from ._version import get_versions
-versions = get_versions()
-__version__ = versions['version']
-__git_revision__ = versions['full-revisionid']
-del get_versions, versions
 
+def __getattr__(name):
+    if name in _lazy_attributes:
+        module = importlib.import_module(f".{_lazy_attributes[name]}", __name__)
+        value = getattr(module, name)
+    elif name in _submodules:
+        value = importlib.import_module(f".{name}", __name__)
+    elif name in ("__version__", "__git_revision__"):
+        # Handle versioneer
+        from ._version_cache import get_versions
+        versions = get_versions()
+        globals()["__version__"] = versions["version"]
+        globals()["__git_revision__"] = versions["full-revisionid"]
+        return globals()[name]
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
 
-import logging
-# format logging message
-FORMAT = "[%(filename)s:%(lineno)s - %(funcName)1s()] %(message)s"
-# set logging level
-logging.basicConfig(format=FORMAT,
-    datefmt='%d-%m-%Y:%H:%M',
-    level=logging.INFO)
\ No newline at end of file
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_attributes) | _submodules | {"__version__", "__git_revision__"})
+
+
+def setup_logging(level=None):
+    """Formats the root logger the way the constph scripts log; the package itself never touches it"""
+    import logging
+    # format logging message
+    FORMAT = "[%(filename)s:%(lineno)s - %(funcName)1s()] %(message)s"
+    # set logging level
+    logging.basicConfig(format=FORMAT,
+        datefmt='%d-%m-%Y:%H:%M',
+        level=logging.INFO if level is None else level)
@@ -0,0 +1,115 @@
+"""
+Version lookup without running git on every import.
+
+Installed packages carry the version versioneer baked into _version.py at build time. In a git
+checkout the versions are computed once and cached next to this file, keyed by the checked-out
+commit, the tags and the state of the git index. The cache is bypassed while a tracked file
+differs from its index entry, since only git itself can tell whether the edit makes the tree dirty.
+"""
+import json
+import os
+import struct
+
+from . import _version
+from .atomic import atomic_write
+
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".version_cache.json")
+
+
+def _worktree_matches_index(root: str, index_path: str) -> bool:
+    """
+    True if every tracked file has the size and mtime its index entry recorded, the check git
+    status starts with. Files modified in the second the index was written count as modified.
+    """
+    with open(index_path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"DIRC":
+        return False
+    version, count = struct.unpack(">II", data[4:12])
+    if version not in (2, 3):
+        # version 4 compresses the paths, not worth parsing here
+        return False
+    index_mtime = os.stat(index_path).st_mtime
+    pos = 12
+    for _ in range(count):
+        start = pos
+        # ctime, ctime ns, mtime, mtime ns, dev, ino, mode, uid, gid, size; sha1; flags
+        fields = struct.unpack_from(">10I", data, pos)
+        mtime, mode, size = fields[2], fields[6], fields[9]
+        (flags,) = struct.unpack_from(">H", data, pos + 60)
+        pos += 62
+        if version == 3 and flags & 0x4000:
+            pos += 2
+        end = data.index(b"\0", pos)
+        name = data[pos:end].decode("utf-8", "surrogateescape")
+        pos = start + ((end - start + 8) & ~7)
+        if flags & 0x3000:
+            # unmerged entry
+            return False
+        if mode >> 12 == 0o16:
+            # submodule
+            continue
+        try:
+            stat = os.lstat(os.path.join(root, name))
+        except OSError:
+            return False
+        if int(stat.st_mtime) != mtime or stat.st_size & 0xFFFFFFFF != size or stat.st_mtime >= index_mtime:
+            return False
+    return True
+
+
+def _git_state(root: str):
+    """
+    Returns a key of the checked-out commit, the tags and the index, None if root is not a git
+    checkout or the working tree has edits the index does not know about
+    """
+    git_dir = os.path.join(root, ".git")
+    try:
+        with open(os.path.join(git_dir, "HEAD")) as f:
+            head = f.read().strip()
+        state = [head]
+        if head.startswith("ref: "):
+            ref = os.path.join(git_dir, head[len("ref: "):])
+            if os.path.isfile(ref):
+                with open(ref) as f:
+                    state.append(f.read().strip())
+        # branches and tags packed by git gc, and the loose tags, which the version is derived from
+        for path in [os.path.join(git_dir, "packed-refs")] + [
+            directory for directory, _, _ in os.walk(os.path.join(git_dir, "refs", "tags"))
+        ]:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                state.append(f"{stat.st_mtime_ns}:{stat.st_size}")
+        index_path = os.path.join(git_dir, "index")
+        index = os.stat(index_path)
+        state.append(f"{index.st_mtime_ns}:{index.st_size}")
+        if not _worktree_matches_index(root, index_path):
+            return None
+    except (OSError, ValueError, struct.error):
+        return None
+    return "|".join(state)
+
+
+def get_versions() -> dict:
+    """Returns versioneer's version dict, from the build-time value or the cache if possible"""
+    if hasattr(_version, "version_json"):
+        # _version.py was replaced by a static file when the package was built
+        return _version.get_versions()
+
+    key = _git_state(os.path.dirname(os.path.dirname(CACHE_FILE)))
+    if key is None:
+        return _version.get_versions()
+    try:
+        with open(CACHE_FILE) as f:
+            cached = json.load(f)
+        if cached["key"] == key:
+            return cached["versions"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    versions = _version.get_versions()
+    try:
+        atomic_write(CACHE_FILE, json.dumps({"key": key, "versions": versions}), durable=False)
+    except OSError:
+        pass
+    return versions
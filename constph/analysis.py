@@ -0,0 +1,133 @@
+"""
+Free energies of the A-EDS end states by exponential reweighting (EXP).
+
+All end states are sampled through the reference state R. The free energy of end state i
+relative to R is
+
+    F_i = -kT ln < exp(-(E_i - E_R) / kT) >_R
+
+evaluated with a log-sum-exp over the frames, so large energy gaps do not overflow. The
+relative free energies F_i - F_1 are the EIR offsets a search run hands to the production run,
+and the deprotonation free energy of a production run gives the pKa.
+All functions work on whole arrays (frames x states), energies in kJ/mol.
+"""
+import logging
+
+import numpy as np
+
+from constph.constants import BOLTZMANN, DEFAULT_TEMPERATURE, LN10
+
+logger = logging.getLogger(__name__)
+
+
+def logsumexp(a: np.ndarray, axis: int = 0) -> np.ndarray:
+    """ln(sum(exp(a))) along axis, shifted by the maximum for numerical stability"""
+    a = np.asarray(a, dtype=float)
+    amax = np.max(a, axis=axis, keepdims=True)
+    amax[~np.isfinite(amax)] = 0.0
+    return np.log(np.sum(np.exp(a - amax), axis=axis)) + np.squeeze(amax, axis=axis)
+
+
+def reweighted_free_energies(
+    e_states: np.ndarray, e_ref: np.ndarray, temperature: float = DEFAULT_TEMPERATURE
+) -> np.ndarray:
+    """
+    Free energies of the end states relative to the sampled reference state.
+    Parameters
+    ----------
+    e_states: np.ndarray
+        end-state energies, frames x states
+    e_ref: np.ndarray
+        reference-state energies, frames
+    temperature: float
+        temperature in K
+    Returns
+    ----------
+    free_energies: np.ndarray
+        F_i per state, kJ/mol
+    """
+    kT = BOLTZMANN * temperature
+    e_states = np.asarray(e_states, dtype=float)
+    e_ref = np.asarray(e_ref, dtype=float)
+    if e_states.ndim != 2 or len(e_states) != len(e_ref):
+        raise ValueError(f"Expected frames x states end-state energies for {len(e_ref)} frames, got {e_states.shape}")
+    if len(e_ref) == 0:
+        raise ValueError("No frames to reweight")
+
+    # -(E_i - E_R) / kT, computed in place: one frames x states temporary
+    reduced = np.subtract(e_ref[:, None], e_states)
+    reduced *= 1.0 / kT
+    amax = reduced.max(axis=0)
+    reduced -= amax
+    np.exp(reduced, out=reduced)
+    return -kT * (np.log(reduced.sum(axis=0)) + amax - np.log(len(e_ref)))
+
+
+def relative_free_energies(
+    e_states: np.ndarray, e_ref: np.ndarray, temperature: float = DEFAULT_TEMPERATURE, reference: int = 0
+) -> np.ndarray:
+    """Free energies of the end states relative to end state reference (0-based), kJ/mol"""
+    free_energies = reweighted_free_energies(e_states, e_ref, temperature)
+    return free_energies - free_energies[reference]
+
+
+class RunningExp(object):
+    def __init__(self, temperature: float = DEFAULT_TEMPERATURE):
+        """
+        EXP free energies over a growing set of frames, e.g. of a running search. Only the
+        log-sum-exp per state is kept, so every update costs the new frames only.
+        """
+
+        self.kT = BOLTZMANN * temperature
+        self.n = 0
+        self._log_sum = None
+
+    def update(self, e_states: np.ndarray, e_ref: np.ndarray):
+        """Adds frames, end-state energies frames x states and reference energies"""
+        if len(e_ref) == 0:
+            return
+        reduced = (np.asarray(e_ref, dtype=float)[:, None] - np.asarray(e_states, dtype=float)) / self.kT
+        log_sum = logsumexp(reduced, axis=0)
+        self._log_sum = log_sum if self._log_sum is None else np.logaddexp(self._log_sum, log_sum)
+        self.n += len(e_ref)
+
+    @property
+    def free_energies(self) -> np.ndarray:
+        """Free energies of the end states relative to the reference state, kJ/mol"""
+        if self._log_sum is None:
+            raise ValueError("No frames to reweight")
+        return -self.kT * (self._log_sum - np.log(self.n))
+
+    def relative_free_energies(self, reference: int = 0) -> np.ndarray:
+        free_energies = self.free_energies
+        return free_energies - free_energies[reference]
+
+
+def eir_offsets(tre, temperature: float = DEFAULT_TEMPERATURE) -> np.ndarray:
+    """
+    EIR offsets from the energy trajectory of a search run: the free energies of the end
+    states relative to the first one.
+    Parameters
+    ----------
+    tre: constph.tre.EnergyTrajectory
+        end-state and reference energies
+    temperature: float
+        temperature in K
+    """
+    return relative_free_energies(tre.states, tre.e_ref, temperature)
+
+
+def pka_from_free_energy(delta_g, temperature: float = DEFAULT_TEMPERATURE, ph: float = 0.0):
+    """
+    pKa from the deprotonation free energy at pH ph,
+    dG = G(deprotonated) - G(protonated) = kT ln(10) (pKa - pH).
+    """
+    return ph + np.asarray(delta_g) / (BOLTZMANN * temperature * LN10)
+
+
+def pka_from_reference(delta_g, delta_g_ref, pka_ref: float, temperature: float = DEFAULT_TEMPERATURE):
+    """
+    pKa relative to a reference compound with known pKa, whose deprotonation free energy
+    delta_g_ref was computed with the same setup: systematic errors of both cancel.
+    """
+    return pka_ref + (np.asarray(delta_g) - delta_g_ref) / (BOLTZMANN * temperature * LN10)
@@ -0,0 +1,164 @@
+"""
+Content-addressed store of the files shared by many run directories.
+
+Topologies, perturbation topologies and coordinates are the same for every intermediate state
+of a system and often for every pH value and system of a campaign. The store keeps one
+read-only copy per content, named by its sha256, and run directories reference it: by
+hardlinks, which cost neither data blocks nor inodes, or by symlinks, which also work across
+filesystems but need the store to be visible wherever the runs are read. When a link can not
+be made (another filesystem, a filesystem without links, too many links) the file is copied.
+Store files are read-only so an in-place edit in one run directory can not change the others;
+links are placed by renaming, so restaging a changed file replaces the link instead of writing
+through it and a run directory never holds a missing or partial file.
+"""
+import errno
+import logging
+import os
+import shutil
+import stat
+import threading
+import uuid
+from dataclasses import dataclass
+
+from constph.atomic import atomic_copy, atomic_open, sync_directory
+from constph.column_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+ASSET_STORE_DIR = ".constph_assets"
+STAGING_MODES = ("hardlink", "symlink", "copy")
+DEFAULT_STAGING = "hardlink"
+# link errors after which a file is copied instead
+LINK_FALLBACK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES)
+
+
+@dataclass
+class StagingReport:
+    staged: int = 0
+    hardlinked: int = 0
+    symlinked: int = 0
+    copied: int = 0
+    # new files and bytes in the store
+    stored_files: int = 0
+    stored_bytes: int = 0
+    # bytes of the linked files, which copies would have taken
+    linked_bytes: int = 0
+
+    @property
+    def bytes_saved(self) -> int:
+        """Bytes saved against one copy per staged file, net of what was added to the store"""
+        return self.linked_bytes - self.stored_bytes
+
+    @property
+    def inodes_saved(self) -> int:
+        """Inodes saved against one copy per staged file; symlinks take an inode of their own"""
+        return self.hardlinked - self.stored_files
+
+    def __str__(self) -> str:
+        return (
+            f"{self.staged} files staged ({self.hardlinked} hardlinks, {self.symlinked} symlinks, "
+            f"{self.copied} copies), {self.bytes_saved / 2 ** 20:.1f} MiB and {self.inodes_saved} inodes saved"
+        )
+
+
+def _remove(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class AssetStore(object):
+    def __init__(self, root: str, mode: str = DEFAULT_STAGING):
+        """
+        A content-addressed store of shared input files, safe to stage from several threads.
+        Parameters
+        ----------
+        root: str
+            directory of the store, on the filesystem of the run directories for hardlinks
+        mode: str
+            hardlink, symlink or copy: how run directories reference the stored files
+        """
+
+        if mode not in STAGING_MODES:
+            raise ValueError(f"Unknown staging mode {mode}, expected one of {STAGING_MODES}")
+        self.root = os.path.abspath(root)
+        self.mode = mode
+        self.report = StagingReport()
+        self._lock = threading.Lock()
+        self._add_lock = threading.Lock()
+
+    def path(self, digest: str, suffix: str = "") -> str:
+        return os.path.join(self.root, digest[:2], f"{digest}{suffix}")
+
+    def add(self, source: str, digest: str = None) -> str:
+        """Stores source unless its content is stored already and returns the store path"""
+        digest = digest or file_sha256(source)
+        path = self.path(digest, os.path.splitext(source)[1])
+        if os.path.exists(path):
+            return path
+        # one thread stores a new content, the others wait for it
+        with self._add_lock:
+            if os.path.exists(path):
+                return path
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(source, "rb") as src, atomic_open(path, "wb") as f:
+                shutil.copyfileobj(src, f)
+                os.chmod(f.fileno(), stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            with self._lock:
+                self.report.stored_files += 1
+                self.report.stored_bytes += os.path.getsize(path)
+        return path
+
+    def stage(self, source: str, target: str, digest: str = None) -> str:
+        """
+        Places the content of source at target, as a link to the store or as a copy.
+        Returns
+        ----------
+        method: str
+            hardlink, symlink or copy, how the file was placed
+        """
+        stored = self.add(source, digest) if self.mode != "copy" else None
+        method = "copy"
+        if self.mode == "hardlink":
+            method = self._link(os.link, stored, target, "hardlink")
+        elif self.mode == "symlink":
+            method = self._link(os.symlink, stored, target, "symlink")
+        if method == "copy":
+            atomic_copy(stored or source, target)
+        size = os.path.getsize(target)
+        with self._lock:
+            self.report.staged += 1
+            if method == "hardlink":
+                self.report.hardlinked += 1
+            elif method == "symlink":
+                self.report.symlinked += 1
+            else:
+                self.report.copied += 1
+            if method != "copy":
+                self.report.linked_bytes += size
+        return method
+
+    def _link(self, link, stored: str, target: str, method: str) -> str:
+        """Links target to the stored file: a link under a temporary name renamed over target"""
+        directory, name = os.path.split(target)
+        tmp_path = os.path.join(directory, f".{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            link(stored, tmp_path)
+        except OSError as exc:
+            if exc.errno not in LINK_FALLBACK_ERRORS:
+                raise
+            logger.debug(f"Can not {method} {stored} to {target} ({exc}), copying it")
+            return "copy"
+        try:
+            os.replace(tmp_path, target)
+        except BaseException:
+            _remove(tmp_path)
+            raise
+        sync_directory(directory or ".")
+        return method
+
+
+def default_asset_store(configuration: dict, mode: str = DEFAULT_STAGING) -> AssetStore:
+    """The store shared by all systems set up in the output directory of configuration"""
+    return AssetStore(os.path.join(configuration["analysis_dir_base"], ASSET_STORE_DIR), mode)
@@ -0,0 +1,228 @@
+"""
+Atomic, crash-safe file output.
+
+Every file constph writes is written to a temporary file next to its destination and renamed
+over it once complete, so a reader (e.g. a batch scheduler) sees either the previous file or the
+new one, never a truncated one, even if the writing process is interrupted. Replacing a file
+this way also replaces a hardlink instead of writing through it.
+
+The rename protects against interrupted processes; surviving a crash of the machine also needs
+the data on disk. The fsync policy decides when that happens:
+
+- always: fsync every file before its rename and its directory after it,
+- batch: fsync the run inputs (RUN_INPUT_SUFFIXES: IMD, job and structure files, which a
+  scheduler may pick up at any time) before their rename, like always; fsync all other files
+  written since the last sync, and the directories of all of them, in one pass at the end of a
+  setup (sync_pending), or at exit,
+- never: leave it to the operating system.
+
+A file is only safe against a crash of the machine once its data was synced before the
+rename. In batch mode that holds for the run inputs; the other files (manifests, tables) are
+renamed first, so until sync_pending they are only protected against interrupted processes
+and a crash of the machine may leave them empty. Their readers treat such a file as missing.
+
+The policy is taken from $CONSTPH_FSYNC and defaults to batch. Caches, which are rebuilt if
+lost, are written atomically but never synced.
+"""
+import atexit
+import itertools
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+FSYNC_POLICIES = ("always", "batch", "never")
+DEFAULT_FSYNC = "batch"
+# files waiting for the batched fsync after which it runs on its own
+MAX_PENDING = 10000
+# files read by md++ or a scheduler, synced before their rename in batch mode as well
+RUN_INPUT_SUFFIXES = (".imd", ".job", ".arg", ".top", ".ptp", ".cnf")
+
+_counter = itertools.count()
+
+
+def _fsync_path(path: str, directory: bool = False):
+    fd = os.open(path, os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if directory else 0))
+    try:
+        os.fsync(fd)
+    except OSError as exc:
+        # some filesystems can not sync directories
+        if not directory:
+            raise
+        logger.debug(f"Could not fsync directory {path}: {exc}")
+    finally:
+        os.close(fd)
+
+
+class AtomicWriter(object):
+    def __init__(self, fsync: str = DEFAULT_FSYNC):
+        """
+        Writes files through a temporary file and a rename, thread-safe.
+        Parameters
+        ----------
+        fsync: str
+            always, batch or never, see the module documentation
+        """
+
+        self.fsync = fsync
+        self._pending = set()
+        # directories of run inputs whose data is synced already
+        self._pending_dirs = set()
+        self._lock = threading.Lock()
+
+    @property
+    def fsync(self) -> str:
+        return self._fsync
+
+    @fsync.setter
+    def fsync(self, policy: str):
+        if policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy {policy}, expected one of {FSYNC_POLICIES}")
+        self._fsync = policy
+
+    def __len__(self) -> int:
+        """Files waiting for the batched fsync of their data"""
+        return len(self._pending)
+
+    @contextmanager
+    def open(self, path: str, mode: str = "w", durable: bool = True, **kwargs):
+        """
+        Opens a temporary file that replaces path when the block finishes without an error.
+        Parameters
+        ----------
+        path: str
+            destination
+        mode: str
+            w or wb
+        durable: bool
+            sync the file according to the policy, False for caches
+        kwargs:
+            passed to open
+        """
+        path = os.fspath(path)
+        directory, name = os.path.split(os.path.abspath(path))
+        sync_data = durable and (
+            self.fsync == "always" or (self.fsync == "batch" and name.endswith(RUN_INPUT_SUFFIXES))
+        )
+        tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.{next(_counter)}.tmp")
+        try:
+            with open(tmp_path, mode.replace("w", "x"), **kwargs) as f:
+                yield f
+                f.flush()
+                try:
+                    # keep the permissions of the file that is replaced, e.g. of an executable job script
+                    os.chmod(f.fileno(), os.stat(path).st_mode & 0o7777)
+                except FileNotFoundError:
+                    pass
+                if sync_data:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if durable and self.fsync == "always":
+            _fsync_path(directory, directory=True)
+        elif durable and self.fsync == "batch":
+            with self._lock:
+                if sync_data:
+                    self._pending_dirs.add(directory)
+                else:
+                    self._pending.add(os.path.join(directory, name))
+                full = len(self._pending) >= MAX_PENDING
+            if full:
+                self.sync()
+
+    def write(self, path: str, data, durable: bool = True):
+        """Writes str or bytes to path"""
+        with self.open(path, "wb" if isinstance(data, bytes) else "w", durable) as f:
+            f.write(data)
+
+    def copy(self, source: str, target: str, durable: bool = True):
+        """Copies the content of source to target"""
+        with open(source, "rb") as src, self.open(target, "wb", durable) as f:
+            shutil.copyfileobj(src, f)
+
+    def add_directory(self, directory: str):
+        """Syncs a directory whose entries changed outside the writer (a rename, a link) by the policy"""
+        directory = os.path.abspath(directory)
+        if self.fsync == "always":
+            _fsync_path(directory, directory=True)
+        elif self.fsync == "batch":
+            with self._lock:
+                self._pending_dirs.add(directory)
+
+    def sync(self) -> int:
+        """
+        Flushes the files written since the last sync to disk, and the directories of all files
+        written since, run inputs included.
+        Returns
+        ----------
+        synced: int
+            number of files flushed here, without the run inputs synced when they were written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, set()
+            directories, self._pending_dirs = self._pending_dirs, set()
+        for path in sorted(pending):
+            try:
+                _fsync_path(path)
+            except FileNotFoundError:
+                # replaced or removed since, its replacement is pending itself
+                continue
+            directories.add(os.path.dirname(path))
+        for directory in sorted(directories):
+            try:
+                _fsync_path(directory, directory=True)
+            except FileNotFoundError:
+                # a build directory renamed since, registered under its new name
+                continue
+        if pending:
+            logger.debug(f"Synced {len(pending)} files in {len(directories)} directories")
+        return len(pending)
+
+
+_writer = AtomicWriter(os.environ.get("CONSTPH_FSYNC", DEFAULT_FSYNC))
+atexit.register(_writer.sync)
+
+
+def get_writer() -> AtomicWriter:
+    """The writer all constph output goes through"""
+    return _writer
+
+
+def set_fsync_policy(policy: str) -> str:
+    """Sets the fsync policy of all constph output and returns the previous one"""
+    previous = _writer.fsync
+    _writer.fsync = policy
+    return previous
+
+
+def atomic_open(path: str, mode: str = "w", durable: bool = True, **kwargs):
+    """See AtomicWriter.open"""
+    return _writer.open(path, mode, durable, **kwargs)
+
+
+def atomic_write(path: str, data, durable: bool = True):
+    """Writes str or bytes to path atomically"""
+    _writer.write(path, data, durable)
+
+
+def atomic_copy(source: str, target: str, durable: bool = True):
+    """Copies source to target atomically"""
+    _writer.copy(source, target, durable)
+
+
+def sync_directory(directory: str):
+    """See AtomicWriter.add_directory"""
+    _writer.add_directory(directory)
+
+
+def sync_pending() -> int:
+    """Runs the batched fsync of everything written since the last one"""
+    return _writer.sync()
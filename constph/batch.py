@@ -0,0 +1,215 @@
+"""
+Batch generation of GROMOS inputs over parameter grids (pH ladders, seeds, sigma, offsets).
+
+All variants of a system are rendered from one field dict through the compiled templates of
+GromosFactory and written to disk one at a time, so memory does not grow with the batch.
+"""
+import hashlib
+import itertools
+import json
+import logging
+import os
+from dataclasses import asdict, dataclass, replace
+
+from constph.atomic import atomic_write, sync_pending
+from constph.constants import BOLTZMANN, DEFAULT_SEED, DEFAULT_TEMPERATURE, LN10
+from constph.gromos_factory import PRODUCTION_TEMPLATE, SEARCH_TEMPLATE, GromosFactory
+
+logger = logging.getLogger(__name__)
+
+# GROMOS reads IG as a positive 32 bit integer
+MAX_SEED = 2 ** 31 - 1
+
+
+def replica_seed(base_seed: int, *key) -> int:
+    """A reproducible seed in [1, MAX_SEED) derived from base_seed and the variant key"""
+    digest = hashlib.sha256(repr((base_seed,) + key).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % (MAX_SEED - 1) + 1
+
+
+@dataclass(frozen=True)
+class Variant:
+    name: str
+    ph: float
+    replica: int
+    seed: int
+    sigma: float
+    offsets: tuple
+
+
+class ParameterGrid(object):
+    def __init__(
+        self,
+        nstates: int,
+        ph_values=None,
+        n_replicas: int = 1,
+        sigmas=None,
+        offsets=None,
+        base_seed: int = DEFAULT_SEED,
+        protons=None,
+        temperature: float = DEFAULT_TEMPERATURE,
+    ):
+        """
+        The cartesian product of pH values, offset sets, sigmas and replicas.
+        The pH enters the EIR offsets: state i releases protons[i] protons relative to the
+        first state, and its offset is shifted by protons[i] * kT ln(10) * pH, so offsets are
+        given at pH 0 (as estimated by a search run).
+        Parameters
+        ----------
+        nstates: int
+            number of end states (NSTATES)
+        ph_values: list
+            pH values, None leaves the offsets unshifted
+        n_replicas: int
+            replicas per parameter combination, each with its own seed
+        sigmas: list
+            sigma values, None keeps the configured one
+        offsets: list
+            sets of EIR offsets, one value per state; None is all zeros
+        base_seed: int
+            seed all replica seeds are derived from
+        protons: list
+            protons released per state relative to state 1, defaults to (0, 1, 1, ...)
+        temperature: float
+            temperature in K used to convert pH into energies
+        """
+
+        self.nstates = int(nstates)
+        self.ph_values = list(ph_values) if ph_values is not None else [None]
+        self.n_replicas = n_replicas
+        self.sigmas = list(sigmas) if sigmas is not None else [None]
+        self.offsets = [tuple(o) for o in offsets] if offsets is not None else [(0.0,) * self.nstates]
+        self.base_seed = base_seed
+        self.protons = tuple(protons) if protons is not None else (0,) + (1,) * (self.nstates - 1)
+        self.kT = BOLTZMANN * temperature
+        for values in self.offsets:
+            if len(values) != self.nstates:
+                raise ValueError(f"Expected {self.nstates} offsets per set, got {values}")
+        if len(self.protons) != self.nstates:
+            raise ValueError(f"Expected {self.nstates} proton counts, got {self.protons}")
+
+    def __len__(self) -> int:
+        return len(self.ph_values) * len(self.offsets) * len(self.sigmas) * self.n_replicas
+
+    def shifted_offsets(self, offsets: tuple, ph) -> tuple:
+        if ph is None:
+            return offsets
+        return tuple(o + n * self.kT * LN10 * ph for o, n in zip(offsets, self.protons))
+
+    def __iter__(self):
+        seeds = set()
+        for ph, (k, offsets), sigma, replica in itertools.product(
+            self.ph_values, enumerate(self.offsets), self.sigmas, range(self.n_replicas)
+        ):
+            name = "" if ph is None else f"pH{ph:.2f}"
+            if len(self.offsets) > 1:
+                name += f"_off{k}"
+            if len(self.sigmas) > 1:
+                name += f"_sigma{sigma:g}"
+            name = f"{name}_r{replica}".lstrip("_")
+
+            attempt = 0
+            seed = replica_seed(self.base_seed, ph, k, sigma, replica)
+            while seed in seeds:
+                attempt += 1
+                seed = replica_seed(self.base_seed, ph, k, sigma, replica, attempt)
+            seeds.add(seed)
+            yield Variant(name, ph, replica, seed, sigma, self.shifted_offsets(offsets, ph))
+
+
+def production_offsets(aeds_parameters: dict, variant: Variant) -> tuple:
+    """EIR of a production variant: the offsets of the search run plus the pH shift and offset set of the variant"""
+    searched = aeds_parameters["offsets"]
+    if len(searched) != len(variant.offsets):
+        raise ValueError(f"Expected {len(variant.offsets)} searched offsets, got {searched}")
+    return tuple(float(o) + shift for o, shift in zip(searched, variant.offsets))
+
+
+def render_batch(
+    factory: GromosFactory, env: str, grid: ParameterGrid, prefix: str = None, aeds_parameters: dict = None
+):
+    """
+    Renders one input per variant of the grid.
+    Production inputs need the A-EDS parameters of the search run: EMIN and EMAX are taken
+    over, the offsets of each variant are the searched ones shifted by its pH and offset set.
+    Parameters
+    ----------
+    aeds_parameters: dict
+        EMIN, EMAX and offsets of the search run, see constph.pipeline.aeds_parameters_from_search;
+        required for production
+    Yields
+    ----------
+    variant, file_name, text: tuple
+        the variant with the offsets written to the input, its file name and the rendered input
+    Raises
+    ----------
+    ValueError
+        if production inputs are rendered without aeds_parameters
+    """
+
+    if env == "search":
+        template, fields = SEARCH_TEMPLATE, factory._get_search_fields()
+    elif env == "production":
+        if aeds_parameters is None:
+            raise ValueError(
+                "Production inputs need EMIN, EMAX and the offsets of the search run, "
+                "see constph.pipeline.aeds_parameters_from_search"
+            )
+        template, fields = PRODUCTION_TEMPLATE, factory._get_production_fields(aeds_parameters)
+    else:
+        raise NotImplementedError(f"Something went wrong with {env} input.")
+    header = factory._get_Gromos_input_header(env)
+    prefix = prefix or env
+
+    for variant in grid:
+        fields["IG"] = variant.seed
+        if variant.sigma is not None:
+            fields["SIGMA"] = variant.sigma
+        if env == "production":
+            variant = replace(variant, offsets=production_offsets(aeds_parameters, variant))
+            fields["OFFSETS"] = "   ".join(f"{offset:.4f}" for offset in variant.offsets)
+        elif variant.ph is not None or len(grid.offsets) > 1 or any(variant.offsets):
+            fields["OFFSETS"] = "   ".join(f"{offset:.4f}" for offset in variant.offsets)
+        yield variant, f"{prefix}_{variant.name}.imd", header + template.render(fields)
+
+
+def write_batch(
+    factory: GromosFactory,
+    env: str,
+    grid: ParameterGrid,
+    out_dir: str,
+    prefix: str = None,
+    aeds_parameters: dict = None,
+) -> list:
+    """
+    Renders and writes one input per variant of the grid.
+    Parameters
+    ----------
+    factory: GromosFactory
+        factory of the system
+    env: str
+        search or production
+    grid: ParameterGrid
+        the variants
+    out_dir: str
+        directory the inputs and batch_manifest.json are written to
+    prefix: str
+        file name prefix, defaults to env
+    aeds_parameters: dict
+        EMIN, EMAX and offsets of the search run, required for production, see render_batch
+    Returns
+    ----------
+    manifest: list
+        one dict per variant with its file name and parameters
+    """
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = []
+    for variant, file_name, text in render_batch(factory, env, grid, prefix, aeds_parameters):
+        atomic_write(os.path.join(out_dir, file_name), text)
+        manifest.append(dict(asdict(variant), file=file_name))
+
+    atomic_write(os.path.join(out_dir, "batch_manifest.json"), json.dumps(manifest, indent=1))
+    sync_pending()
+    logger.info(f"Wrote {len(manifest)} {env} inputs to {out_dir}")
+    return manifest
@@ -1,51 +1,104 @@
+# Generated by constph.typed_config, do not edit.
+# flake8: noqa
 from dataclasses import dataclass
 
+SCHEMA_VERSION = '1a23d0c180f3ae2a'
+
 #dataclass
 @dataclass
-class production_parameters:
-    nstep: int
-    nstdcd: int
-    nstout: int
-    cons: str
-    dt: float
-@dataclass
-class production_run:
-    production_parameters: production_parameters
+class structure:
+    __slots__ = ('name', 'topo', 'coord', 'pttopo')
+    name: str
+    topo: str
+    coord: str
+    pttopo: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['name'], data['topo'], data['coord'], data['pttopo'])
 @dataclass
-class search_parameters:
-    NSTLIM: int
-    NTWX: int
-    NTWE: int
-    cons: str
-    dt: float
+class system:
+    __slots__ = ('structure', 'name')
+    structure: structure
+    name: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(structure.from_dict(data['structure']), data['name'])
 @dataclass
-class search_run:
-    search_parameters: search_parameters
+class paths:
+    __slots__ = ('gromos_bin', 'work_dir')
+    gromos_bin: str
+    work_dir: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['gromos_bin'], data['work_dir'])
 @dataclass
 class specs:
+    __slots__ = ('lib_template', 'program_version', 'joblist')
     lib_template: str
     program_version: str
     joblist: str
-@dataclass
-class paths:
-    gromos_bin: str
-    work_dir: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['lib_template'], data['program_version'], data['joblist'])
 @dataclass
 class config:
+    __slots__ = ('paths', 'specs')
     paths: paths
     specs: specs
+    @classmethod
+    def from_dict(cls, data):
+        return cls(paths.from_dict(data['paths']), specs.from_dict(data['specs']))
 @dataclass
-class structure:
-    name: str
-    topo: str
-    coord: str
-    pttopo: str
+class search_parameters:
+    __slots__ = ('NSM', 'NSTLIM', 'dt', 'ATMNR1', 'ATMNR2', 'NTWX', 'NTWE', 'NSTATES', 'sigma', 'asteps', 'bsteps', 'cons')
+    NSM: int
+    NSTLIM: int
+    dt: float
+    ATMNR1: int
+    ATMNR2: int
+    NTWX: int
+    NTWE: int
+    NSTATES: int
+    sigma: int
+    asteps: int
+    bsteps: int
+    cons: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['NSM'], data['NSTLIM'], data['dt'], data['ATMNR1'], data['ATMNR2'], data['NTWX'], data['NTWE'], data['NSTATES'], data['sigma'], data['asteps'], data['bsteps'], data['cons'])
 @dataclass
-class system:
-    structure: structure
-    name: str
+class search_run:
+    __slots__ = ('search_parameters',)
+    search_parameters: search_parameters
+    @classmethod
+    def from_dict(cls, data):
+        return cls(search_parameters.from_dict(data['search_parameters']))
+@dataclass
+class production_parameters:
+    __slots__ = ('NSM', 'NSTLIM', 'dt', 'ATMNR1', 'ATMNR2', 'NTWX', 'NTWE', 'NSTATES', 'sigma', 'cons')
+    NSM: int
+    NSTLIM: int
+    dt: float
+    ATMNR1: int
+    ATMNR2: int
+    NTWX: int
+    NTWE: int
+    NSTATES: int
+    sigma: int
+    cons: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['NSM'], data['NSTLIM'], data['dt'], data['ATMNR1'], data['ATMNR2'], data['NTWX'], data['NTWE'], data['NSTATES'], data['sigma'], data['cons'])
+@dataclass
+class production_run:
+    __slots__ = ('production_parameters',)
+    production_parameters: production_parameters
+    @classmethod
+    def from_dict(cls, data):
+        return cls(production_parameters.from_dict(data['production_parameters']))
 @dataclass
 class input_dataclass:
+    __slots__ = ('system', 'config', 'search_run', 'production_run', 'bin_dir', 'analysis_dir_base', 'data_dir_base', 'system_dir')
     system: system
     config: config
     search_run: search_run
@@ -54,3 +107,6 @@ class input_dataclass:
     analysis_dir_base: str
     data_dir_base: str
     system_dir: str
+    @classmethod
+    def from_dict(cls, data):
+        return cls(system.from_dict(data['system']), config.from_dict(data['config']), search_run.from_dict(data['search_run']), production_run.from_dict(data['production_run']), data['bin_dir'], data['analysis_dir_base'], data['data_dir_base'], data['system_dir'])
@@ -0,0 +1,178 @@
+import copy
+import fnmatch
+import logging
+import os
+
+from constph.utils import _resolve_settings, load_yaml
+from constph.validation import validate_configurations
+
+logger = logging.getLogger(__name__)
+
+# sections a campaign shares between all of its systems
+SHARED_SECTIONS = ("config", "search_run", "production_run")
+# name of the file holding the shared sections in a directory of fragments
+DEFAULTS_FILE = "defaults.yaml"
+
+
+def _merge(defaults: dict, overrides: dict) -> dict:
+    """Recursively merges overrides into a copy of defaults"""
+    merged = dict(defaults)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class Campaign(object):
+    def __init__(
+        self,
+        defaults: dict,
+        sources: dict,
+        input_dir: str,
+        output_dir: str,
+        use_cache: bool = True,
+        cache_dir: str = None,
+    ):
+        """
+        Many systems sharing the config, search_run and production_run defaults.
+        The settings map of a system is only parsed, merged and resolved when it is requested.
+        Parameters
+        ----------
+        defaults: dict
+            sections shared by all systems
+        sources: dict
+            system name -> per-system entry (dict) or path of a fragment yaml
+        input_dir: str
+            directory the input data is read from
+        output_dir: str
+            directory the systems are set up in
+        """
+
+        self.defaults = defaults
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir
+        self._sources = sources
+        self._settings = {}
+
+    @property
+    def names(self) -> list:
+        return list(self._sources)
+
+    def __len__(self) -> int:
+        return len(self._sources)
+
+    def __iter__(self):
+        return iter(self._sources)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sources
+
+    def __getitem__(self, name: str) -> dict:
+        """
+        Returns the settings map of a system, in the layout load_config_yaml returns.
+        The map is materialized on first access and shared by later calls.
+        """
+        if name not in self._settings:
+            entry = self._sources[name]
+            if not isinstance(entry, dict):
+                entry = load_yaml(entry, self.use_cache, self.cache_dir)
+            settingsMap = copy.deepcopy(_merge(self.defaults, entry))
+            self._settings[name] = _resolve_settings(settingsMap, self.input_dir, self.output_dir)
+        return self._settings[name]
+
+    def items(self):
+        """Yields (name, settings map) pairs, materializing one system at a time"""
+        for name in self._sources:
+            yield name, self[name]
+
+    def validate(self):
+        """
+        Checks the settings maps of all systems in one pass and raises a
+        constph.validation.ConfigValidationError listing every problem found.
+        """
+        validate_configurations(self.items())
+
+    def select(self, names) -> "Campaign":
+        """Returns a campaign restricted to the given system names"""
+        missing = [name for name in names if name not in self._sources]
+        if missing:
+            raise KeyError(f"Systems not part of the campaign: {missing}")
+        return self._subset(names)
+
+    def filter(self, pattern: str = "*", predicate=None) -> "Campaign":
+        """
+        Returns a campaign of the systems whose name matches the shell-style pattern.
+        A predicate, if given, is called with the settings map of every matching system,
+        so only systems passing the name pattern get materialized.
+        """
+        names = fnmatch.filter(self._sources, pattern)
+        if predicate is not None:
+            names = [name for name in names if predicate(self[name])]
+        return self._subset(names)
+
+    def _subset(self, names) -> "Campaign":
+        subset = Campaign(
+            self.defaults,
+            {name: self._sources[name] for name in names},
+            self.input_dir,
+            self.output_dir,
+            self.use_cache,
+            self.cache_dir,
+        )
+        subset._settings = {name: self._settings[name] for name in names if name in self._settings}
+        return subset
+
+
+def _entry_from_campaign_file(entry: dict) -> dict:
+    """Brings a system entry of a campaign file into the layout of a single-system config"""
+    entry = dict(entry)
+    structure = entry.pop("structure")
+    system = entry.pop("system", {})
+    return _merge({"system": {**system, "structure": structure}}, entry)
+
+
+def load_campaign(config: str, input_dir: str, output_dir: str, use_cache: bool = True, cache_dir: str = None):
+    """
+    Loads a campaign, either a single yaml with a ``systems`` list next to the shared sections
+    or a directory of single-system fragments with the shared sections in defaults.yaml.
+    Systems of a directory are named after their fragment file and are not parsed before use.
+    Parameters
+    ----------
+    config: str
+        path to the campaign yaml or the fragment directory
+    input_dir: str
+        directory the input data is read from
+    output_dir: str
+        directory the systems are set up in
+    Returns
+    ----------
+    campaign: Campaign
+    """
+
+    if os.path.isdir(config):
+        defaults_path = os.path.join(config, DEFAULTS_FILE)
+        defaults = load_yaml(defaults_path, use_cache, cache_dir) if os.path.isfile(defaults_path) else {}
+        sources = {}
+        for file_name in sorted(os.listdir(config)):
+            stem, ext = os.path.splitext(file_name)
+            if ext not in (".yaml", ".yml") or file_name == DEFAULTS_FILE or stem.startswith("."):
+                continue
+            if stem in sources:
+                raise ValueError(f"System {stem} is defined twice in {config}")
+            sources[stem] = os.path.join(config, file_name)
+    else:
+        data = load_yaml(config, use_cache, cache_dir)
+        defaults = {key: data[key] for key in SHARED_SECTIONS if key in data}
+        sources = {}
+        for entry in data.get("systems") or []:
+            name = f"{entry['structure']['name']}"
+            if name in sources:
+                raise ValueError(f"System {name} is defined twice in {config}")
+            sources[name] = _entry_from_campaign_file(entry)
+
+    logger.info(f"Campaign {config} with {len(sources)} systems")
+    return Campaign(defaults, sources, input_dir, output_dir, use_cache, cache_dir)
@@ -0,0 +1,170 @@
+"""
+Columnar on-disk cache of arrays parsed from a source file (e.g. an energy trajectory).
+
+Every column is stored as its own .npy file, so a cached column is memory-mapped instead of
+parsed again. By default the cache sits next to the source, in ``.constph_cache/<file name>/``.
+meta.json identifies the source the way constph.system does, by real path, device, inode, size
+and mtime: an entry is used as long as none of them changed, so a source is read once, by its
+parse, and never hashed. meta.json is written last, so an entry whose columns are incomplete is
+never picked up. The source is stamped before it is parsed and the entry is only written if the
+source is unchanged afterwards, so the columns of a file that grew while it was parsed (a
+running simulation) are never stored under the identity of the grown file.
+"""
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from constph.atomic import atomic_open, atomic_write
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR_NAME = ".constph_cache"
+META_FILE = "meta.json"
+# bump when the layout of the cache entries changes
+CACHE_FORMAT = 2
+HASH_BLOCK_SIZE = 1 << 20
+# what identifies the parsed version of a source
+STAMP_FIELDS = ("path", "dev", "ino", "size", "mtime_ns")
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_stamp(source: str) -> dict:
+    """Real path, device, inode, size and mtime of source; take it before parsing and pass it to write_columns"""
+    stat = os.stat(source)
+    return {
+        "path": os.path.realpath(source),
+        "dev": stat.st_dev,
+        "ino": stat.st_ino,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def _stamp_key(stamp: dict) -> tuple:
+    return tuple(stamp[name] for name in STAMP_FIELDS)
+
+
+def cache_location(source: str, cache_dir: str = None) -> str:
+    """Directory of the cache entry of source, next to it or in cache_dir"""
+    source = os.path.abspath(source)
+    if cache_dir is None:
+        return os.path.join(os.path.dirname(source), CACHE_DIR_NAME, os.path.basename(source))
+    return os.path.join(cache_dir, hashlib.sha256(source.encode()).hexdigest()[:16])
+
+
+def _read_meta(location: str):
+    try:
+        with open(os.path.join(location, META_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path: str, data):
+    atomic_write(path, json.dumps(data, indent=1), durable=False)
+
+
+def read_columns(source: str, kind: str, cache_dir: str = None, mmap: bool = True):
+    """
+    Returns the cached columns of source, None if there is no valid entry.
+    Parameters
+    ----------
+    source: str
+        the parsed file
+    kind: str
+        what the columns were parsed as, e.g. "tre"; entries of another kind are ignored
+    cache_dir: str
+        directory of the cache, None is next to source
+    mmap: bool
+        memory-map the columns instead of reading them
+    Returns
+    ----------
+    columns: dict
+        name -> np.ndarray, read-only if memory-mapped
+    """
+    location = cache_location(source, cache_dir)
+    meta = _read_meta(location)
+    if meta is None or meta.get("format") != CACHE_FORMAT or meta.get("kind") != kind:
+        return None
+    if _stamp_key(meta["stamp"]) != _stamp_key(source_stamp(source)):
+        logger.debug(f"Cache entry of {source} is stale")
+        return None
+
+    try:
+        columns = {
+            name: np.load(os.path.join(location, file_name), mmap_mode="r" if mmap else None)
+            for name, file_name in meta["columns"].items()
+        }
+    except (OSError, ValueError):
+        logger.warning(f"Cache entry of {source} in {location} is damaged, parsing again")
+        return None
+    logger.debug(f"Columns of {source} loaded from {location}")
+    return columns
+
+
+def write_columns(source: str, kind: str, columns: dict, cache_dir: str = None, stamp: dict = None):
+    """
+    Stores the columns parsed from source. A source that can not be cached (read-only run
+    directory) is only logged, as is a source that changed since stamp.
+    Parameters
+    ----------
+    source: str
+        the parsed file
+    kind: str
+        what the columns were parsed as, e.g. "tre"
+    columns: dict
+        name -> np.ndarray
+    cache_dir: str
+        directory of the cache, None is next to source
+    stamp: dict
+        source_stamp of source taken before it was parsed, None stamps it now
+    Returns
+    ----------
+    location: str
+        directory of the entry, None if it could not be written
+    """
+    location = cache_location(source, cache_dir)
+    stamp = stamp or source_stamp(source)
+    if _stamp_key(source_stamp(source)) != _stamp_key(stamp):
+        logger.debug(f"{source} changed while it was parsed, its columns are not cached")
+        return None
+    # the stamp is part of the file names, so readers of a previous entry are not affected
+    prefix = hashlib.sha256(repr(_stamp_key(stamp)).encode()).hexdigest()[:16]
+    try:
+        os.makedirs(location, exist_ok=True)
+        previous = _read_meta(location)
+        files = {}
+        for name, values in columns.items():
+            file_name = f"{prefix}.{name}.npy"
+            with atomic_open(os.path.join(location, file_name), "wb", durable=False) as f:
+                np.save(f, np.ascontiguousarray(values))
+            files[name] = file_name
+        meta = {
+            "format": CACHE_FORMAT,
+            "kind": kind,
+            "stamp": stamp,
+            "columns": files,
+        }
+        _write_json(os.path.join(location, META_FILE), meta)
+    except OSError as e:
+        logger.warning(f"Could not cache the columns of {source}: {e}")
+        return None
+
+    if previous is not None:
+        for file_name in set(previous.get("columns", {}).values()) - set(files.values()):
+            try:
+                os.remove(os.path.join(location, file_name))
+            except OSError:
+                pass
+    logger.debug(f"Columns of {source} cached in {location}")
+    return location
@@ -0,0 +1,11 @@
+"""Physical constants and simulation defaults shared by the constph modules"""
+import math
+
+# Boltzmann constant in GROMOS units, kJ/(mol K)
+BOLTZMANN = 0.00831446261815324
+# ln(10), converts between free energies and pH/pKa units: dG = kT ln(10) dpH
+LN10 = math.log(10.0)
+# bath temperature of the generated inputs (MULTIBATH TEMP0), K
+DEFAULT_TEMPERATURE = 300.0
+# random seed of the INITIALISE block (IG) if none is configured
+DEFAULT_SEED = 210185
@@ -0,0 +1,157 @@
+"""
+Convergence-driven early termination of A-EDS search runs.
+
+A ConvergenceMonitor follows the energy trajectories of a segmented search run (see
+constph.segments) while it runs. Every poll reads only the newly written frames and updates a
+running EXP estimate of the offsets; EMAX and EMIN are the latest values the search wrote. The
+search counts as converged once the offsets, EMAX and EMIN of all estimates over the last
+window of frames agree with the current ones within the tolerances. The chain is then asked to
+stop at the next segment boundary and the production input is written from the current
+estimates.
+"""
+import logging
+import os
+import time
+
+import numpy as np
+
+from constph.analysis import RunningExp
+from constph.constants import DEFAULT_TEMPERATURE
+from constph.pipeline import write_production_input
+from constph.segments import read_chain, request_stop, stop_requested
+from constph.tail import TailMonitor
+from constph.tre import DEFAULT_PROPERTIES
+
+logger = logging.getLogger(__name__)
+
+# largest change of the offsets (kJ/mol) over the window at convergence
+DEFAULT_OFFSET_TOLERANCE = 0.5
+# largest change of EMAX and EMIN (kJ/mol) over the window at convergence
+DEFAULT_ENERGY_TOLERANCE = 2.0
+# part of the frames read so far over which the estimates have to be stable
+DEFAULT_WINDOW = 0.25
+# frames needed before convergence is tested
+DEFAULT_MIN_FRAMES = 2000
+# seconds between polls of watch
+DEFAULT_INTERVAL = 60.0
+
+
+class ConvergenceMonitor(object):
+    def __init__(
+        self,
+        chain_dir: str,
+        temperature: float = DEFAULT_TEMPERATURE,
+        offset_tolerance: float = DEFAULT_OFFSET_TOLERANCE,
+        energy_tolerance: float = DEFAULT_ENERGY_TOLERANCE,
+        window: float = DEFAULT_WINDOW,
+        min_frames: int = DEFAULT_MIN_FRAMES,
+    ):
+        """
+        Follows a running search chain and decides when its parameters are converged.
+        Parameters
+        ----------
+        chain_dir: str
+            directory of the search chain (chain_manifest.json)
+        temperature: float
+            temperature in K
+        offset_tolerance: float
+            largest change of the offsets over the window, kJ/mol
+        energy_tolerance: float
+            largest change of EMAX and EMIN over the window, kJ/mol
+        window: float
+            fraction of the frames read so far over which the estimates have to be stable
+        min_frames: int
+            frames needed before convergence is tested
+        """
+
+        self.chain_dir = chain_dir
+        self.offset_tolerance = offset_tolerance
+        self.energy_tolerance = energy_tolerance
+        self.window = window
+        self.min_frames = min_frames
+        self.estimate = RunningExp(temperature)
+        self.tails = TailMonitor(DEFAULT_PROPERTIES, keep=False)
+        for segment in read_chain(chain_dir):
+            self.tails.add(os.path.join(chain_dir, segment["tre"]))
+        self.emax = None
+        self.emin = None
+        # (frames, offsets, EMAX, EMIN) after every poll with new frames
+        self.history = []
+        self.converged = False
+
+    @property
+    def n_frames(self) -> int:
+        return self.estimate.n
+
+    @property
+    def parameters(self) -> dict:
+        """The current A-EDS parameters: EMIN, EMAX and offsets"""
+        return {"EMIN": self.emin, "EMAX": self.emax, "offsets": self.estimate.relative_free_energies().tolist()}
+
+    def poll(self) -> bool:
+        """Reads the new frames and returns True once the search is converged"""
+        updates = self.tails.poll()
+        if not updates:
+            return self.converged
+        for tre in updates.values():
+            self.estimate.update(tre.states, tre.e_ref)
+            self.emax = float(tre.properties["eds_emax"][-1])
+            self.emin = float(tre.properties["eds_emin"][-1])
+        self.history.append((self.n_frames, self.estimate.relative_free_energies(), self.emax, self.emin))
+        self.converged = self._stable()
+        return self.converged
+
+    def _stable(self) -> bool:
+        if self.n_frames < self.min_frames:
+            return False
+        start = self.n_frames * (1.0 - self.window)
+        # the window has to reach back to an estimate made before it
+        if self.history[0][0] > start:
+            return False
+        window = [entry for entry in self.history if entry[0] >= start]
+        window.insert(0, [entry for entry in self.history if entry[0] < start][-1])
+        _, offsets, emax, emin = self.history[-1]
+        for _, old_offsets, old_emax, old_emin in window:
+            if np.max(np.abs(old_offsets - offsets)) > self.offset_tolerance:
+                return False
+            if max(abs(old_emax - emax), abs(old_emin - emin)) > self.energy_tolerance:
+                return False
+        return True
+
+    def __call__(self, segment: dict = None) -> bool:
+        """Stop callback of constph.segments.run_chain: polls and stops the chain once converged"""
+        if self.poll() and not stop_requested(self.chain_dir):
+            request_stop(self.chain_dir, dict(self.parameters, frames=self.n_frames, reason="converged"))
+        return self.converged
+
+    def hand_off(self, factory, output_file: str) -> dict:
+        """
+        Writes the production input from the current estimates, see
+        constph.pipeline.write_production_input.
+        """
+        parameters = self.parameters
+        write_production_input(factory, parameters, output_file)
+        logger.info(f"Search in {self.chain_dir} converged after {self.n_frames} frames, production input written")
+        return parameters
+
+
+def watch(monitor: ConvergenceMonitor, factory, output_file: str, interval: float = DEFAULT_INTERVAL):
+    """
+    Polls a running search until it converges or its chain ends, e.g. from a login-node
+    process next to the scheduled segments. On convergence the chain is stopped at the next
+    segment boundary and the production input is written.
+    Returns
+    ----------
+    parameters: dict
+        the parameters handed to production, None if the search ended unconverged
+    """
+    while True:
+        if monitor():
+            return monitor.hand_off(factory, output_file)
+        if all(segment["status"] == "finished" for segment in read_chain(monitor.chain_dir)):
+            # the last segment may have finished between the poll and the manifest check
+            if monitor():
+                return monitor.hand_off(factory, output_file)
+            logger.info(f"Search in {monitor.chain_dir} finished without converging")
+            return None
+        time.sleep(interval)
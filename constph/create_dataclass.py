@@ -1,5 +1,8 @@
 from constph import load_config_yaml
 from constph import create_dataclass_file
+from constph import setup_logging
+
+setup_logging()
 
    
 configuration = load_config_yaml(config='constph/bin/dataclass_structure.yaml',
@@ -1,77 +1,21 @@
 import datetime
-from os import stat
+import logging
+import os
 
-class GromosFactory:
-    """Class to build the string needed to create a Gromos input file (*.imd), a make_script fiel (*.arg) and a job file (*.job)"""
-
-    def __init__(self, configuration: dict, structure: str) -> None:
-
-        self.configuration = configuration
-        self.structure = structure
-
-    def _get_search_run_parameters(self):
-        prms = {}
-        for key in self.configuration["search_run"]["search_parameters"]:
-            prms[key] = self.configuration["search_run"]["search_parameters"][key]
-        return prms
-
-    def _get_production_run_parameters(self):
-        prms = {}
-        for key in self.configuration["production_run"]["production_parameters"]:
-            prms[key] = self.configuration["production_run"]["production_parameters"][key]
-        return prms
-
-
-    def generate_Gromos_search_input(self, env: str) -> str:
+from constph.constants import DEFAULT_SEED
+from constph.imd import ImdFile
+from constph.imd_template import ImdTemplate
+from constph.output_budget import OutputPlan, plan_output, read_atom_count
+from constph.segments import segment_imds, split_nstlim, write_stride
+from constph.tuning import DEFAULT_GRID_SPACING, DEFAULT_PAIRLIST, read_box, tune_nonbonded
 
-        gromos_search_script = self._get_Gromos_input_header(env)
-        if env == "search":
-            gromos_search_script += (
-                self._get_Gromos_search_body()
-            )
-        else:
-            raise NotImplementedError(f"Something went wrong with {env} input.")
+logger = logging.getLogger(__name__)
 
-        return gromos_search_script
-
-    def generate_Gromos_production_input(self, env: str) -> str:
+# TITLE line with the date of generation, ignored when inputs are compared
+VERSION_LINE = "Version "
 
-        gromos_search_script = self._get_Gromos_input_header(env)
-        if env == "production":
-            gromos_search_script += (
-                self._get_Gromos_production_body()
-            )
-        else:
-            raise NotImplementedError(f"Something went wrong with {env} input.")
-
-        return gromos_search_script
-
-    def _get_Gromos_input_header(self, env: str) -> str:
-        date = datetime.date.today()
-        header = f"""TITLE
-Automatically generated input file for {env} run with constph
-Version {date}
-END
-"""
-        return header
-        
-    def _get_Gromos_search_body(self) -> str:
-
-        NSM = self.configuration["search_run"]["search_parameters"]["NSM"]
-        NSTLIM = self.configuration["search_run"]["search_parameters"]["NSTLIM"]
-        DT = self.configuration["search_run"]["search_parameters"]["dt"]
-        ATMNR1 = self.configuration["search_run"]["search_parameters"]["ATMNR1"]
-        ATMNR2 = self.configuration["search_run"]["search_parameters"]["ATMNR2"]
-        NTWX = self.configuration["search_run"]["search_parameters"]["NTWX"]
-        NTWE = self.configuration["search_run"]["search_parameters"]["NTWE"]
-        FORM = "4"
-        NSTATES = self.configuration["search_run"]["search_parameters"]["NSTATES"]
-        OFFSETS = "0   " * int(NSTATES)
-        SIGMA = self.configuration["search_run"]["search_parameters"]["sigma"] 
-        ASTEPS = self.configuration["search_run"]["search_parameters"]["asteps"]
-        BSTEPS = self.configuration["search_run"]["search_parameters"]["bsteps"]
-        
-        body = f"""SYSTEM
+# body templates of the GROMOS inputs, compiled once into static blocks and blocks with fields
+SEARCH_TEMPLATE = ImdTemplate("""SYSTEM
 #      NPM      NSM
          1     {NSM}
 END
@@ -136,19 +80,19 @@ CONSTRAINT
 END
 PAIRLIST
 # algorithm    NSNB   RCUTP   RCUTL    SIZE    TYPE
-          1       5     0.8     1.4     0.4       0
+          1       5     {RCUTP}     {RCUTL}     {SIZE}       0
 END
 NONBONDED
 # NLRELE
          1
 #  APPAK    RCRF   EPSRF    NSLFEXCL
-         0       1.4      78.5         1
+         0       {RCRF}      78.5         1
 # NSHAPE  ASHAPE  NA2CLC   TOLA2   EPSLS
          3       1.4         2     1e-10         0
 #    NKX     NKY     NKZ   KCUT
         10        10        10       100
 #    NGX     NGY     NGZ  NASORD  NFDORD  NALIAS  NSPORD
-        32        32        32         3         2         3         4
+        {NGX}        {NGY}        {NGZ}         3         2         3         4
 # NQEVAL  FACCUR  NRDGRD  NWRGRD
     100000       1.6         0         0
 #  NLRLJ  SLVDNS
@@ -163,7 +107,7 @@ INITIALISE
 #   NTISTI
          0
 #       IG     TEMPI
-    210185         0
+    {IG}         0
 END
 COMTRANSROT
 #     NSCM
@@ -177,7 +121,7 @@ PRINTOUT
 END
 WRITETRAJ
 #    NTWX     NTWSE      NTWV      NTWF      NTWE      NTWG      NTWB
-    {NTWX}         0         0         0     {NTWE}        0         0
+    {NTWX}         0         0         0     {NTWE}        {NTWG}         0
 END
 AEDS
 #     AEDS
@@ -190,28 +134,9 @@ AEDS
         {OFFSETS}
 # NTIAEDSS  RESTREMIN  BMAXTYPE      BMAX    ASTEPS    BSTEPS
          1          1   {SIGMA}         2    {ASTEPS}  {BSTEPS}
-END"""
-
-        return body
-
+END""")
 
-    def _get_Gromos_production_body(self) -> str:
-
-        NSM = self.configuration["production_run"]["_parameters"]["NSM"]
-        NSTLIM = self.configuration["production_run"]["production_parameters"]["NSTLIM"]
-        DT = self.configuration["production_run"]["production_parameters"]["dt"]
-        ATMNR1 = self.configuration["production_run"]["production_parameters"]["ATMNR1"]
-        ATMNR2 = self.configuration["production_run"]["production_parameters"]["ATMNR2"]
-        NTWX = self.configuration["production_run"]["production_parameters"]["NTWX"]
-        NTWE = self.configuration["production_run"]["production_parameters"]["NTWE"]
-        FORM = "4"
-        NSTATES = self.configuration["production_run"]["production_parameters"]["NSTATES"]
-        OFFSETS = "0   {new_offset}"
-        SIGMA = self.configuration["production_run"]["production_parameters"]["sigma"] 
-        EMIN = "found in search"
-        EMAX = "found in search"
-
-        body = f"""SYSTEM
+PRODUCTION_TEMPLATE = ImdTemplate("""SYSTEM
 #      NPM      NSM
          1     {NSM}
 END
@@ -276,19 +201,19 @@ CONSTRAINT
 END
 PAIRLIST
 # algorithm    NSNB   RCUTP   RCUTL    SIZE    TYPE
-          1       5     0.8     1.4     0.4       0
+          1       5     {RCUTP}     {RCUTL}     {SIZE}       0
 END
 NONBONDED
 # NLRELE
          1
 #  APPAK    RCRF   EPSRF    NSLFEXCL
-         0       1.4      78.5         1
+         0       {RCRF}      78.5         1
 # NSHAPE  ASHAPE  NA2CLC   TOLA2   EPSLS
          3       1.4         2     1e-10         0
 #    NKX     NKY     NKZ   KCUT
         10        10        10       100
 #    NGX     NGY     NGZ  NASORD  NFDORD  NALIAS  NSPORD
-        32        32        32         3         2         3         4
+        {NGX}        {NGY}        {NGZ}         3         2         3         4
 # NQEVAL  FACCUR  NRDGRD  NWRGRD
     100000       1.6         0         0
 #  NLRLJ  SLVDNS
@@ -303,7 +228,7 @@ INITIALISE
 #   NTISTI
          0
 #       IG     TEMPI
-    210185         0
+    {IG}         0
 END
 COMTRANSROT
 #     NSCM
@@ -317,7 +242,7 @@ PRINTOUT
 END
 WRITETRAJ
 #    NTWX     NTWSE      NTWV      NTWF      NTWE      NTWG      NTWB
-    {NTWX}         0         0         0     {NTWE}        0         0
+    {NTWX}         0         0         0     {NTWE}        {NTWG}         0
 END
 AEDS
 #     AEDS
@@ -330,8 +255,224 @@ AEDS
         {OFFSETS}
 # NTIAEDSS  RESTREMIN  BMAXTYPE      BMAX    ASTEPS    BSTEPS
          1          1   {SIGMA}         2         0         0 
-END"""
+END""")
+
 
-        return body
+def stable_text(text: str) -> str:
+    """A generated input without the date line of its TITLE, for comparisons across days"""
+    title, end, body = text.partition("\nEND\n")
+    lines = [line for line in title.split("\n") if not line.startswith(VERSION_LINE)]
+    return "\n".join(lines) + end + body
 
 
+class GromosFactory:
+    """
+    Class to build the string needed to create a Gromos input file (*.imd), a make_script fiel (*.arg)
+    and a job file (*.job)
+    """
+
+    def __init__(self, configuration: dict, structure: str) -> None:
+
+        self.configuration = configuration
+        self.structure = structure
+        # PAIRLIST/NONBONDED values, replaced by tune_for_box
+        self.nonbonded = dict(DEFAULT_PAIRLIST)
+        self.tuning_note = ""
+        # WRITETRAJ frequencies per env, set by budget_output
+        self.output_plans = {}
+
+    def _get_search_run_parameters(self):
+        return dict(self.configuration["search_run"]["search_parameters"])
+
+    def _get_production_run_parameters(self):
+        return dict(self.configuration["production_run"]["production_parameters"])
+
+
+    def generate_Gromos_search_input(self, env: str) -> str:
+
+        gromos_search_script = self._get_Gromos_input_header(env)
+        if env == "search":
+            gromos_search_script += (
+                self._get_Gromos_search_body()
+            )
+        else:
+            raise NotImplementedError(f"Something went wrong with {env} input.")
+
+        return gromos_search_script
+
+    def generate_Gromos_production_input(self, env: str, aeds_parameters: dict = None) -> str:
+        """
+        Builds the production input. Without aeds_parameters EMIN, EMAX and the offsets are left
+        as placeholders; pass the dict returned by constph.pipeline.aeds_parameters_from_search
+        (keys EMIN, EMAX, offsets) to fill them in.
+        """
+
+        gromos_search_script = self._get_Gromos_input_header(env)
+        if env == "production":
+            gromos_search_script += (
+                self._get_Gromos_production_body(aeds_parameters)
+            )
+        else:
+            raise NotImplementedError(f"Something went wrong with {env} input.")
+
+        return gromos_search_script
+
+    def generate_Gromos_search_imd(self, env: str) -> ImdFile:
+        """The search input as an ImdFile, e.g. as reference for patched variants"""
+        return ImdFile.parse(self.generate_Gromos_search_input(env))
+
+    def generate_Gromos_production_imd(self, env: str, aeds_parameters: dict = None) -> ImdFile:
+        """The production input as an ImdFile"""
+        return ImdFile.parse(self.generate_Gromos_production_input(env, aeds_parameters))
+
+    def generate_Gromos_segments(self, env: str, n_segments: int, aeds_parameters: dict = None) -> list:
+        """
+        Splits the run into n_segments chained inputs, see constph.segments.
+        The segment lengths are multiples of the write frequencies, every segment after the
+        first continues from the final configuration of the one before.
+        Returns
+        ----------
+        imds: list
+            one ImdFile per segment
+        """
+        if env == "search":
+            imd = self.generate_Gromos_search_imd(env)
+        elif env == "production":
+            imd = self.generate_Gromos_production_imd(env, aeds_parameters)
+        else:
+            raise NotImplementedError(f"Something went wrong with {env} input.")
+        writetraj = imd["WRITETRAJ"]
+        stride = write_stride(writetraj["NTWX"], writetraj["NTWE"], writetraj["NTWG"])
+        lengths = split_nstlim(int(imd.get("STEP", "NSTLIM")), n_segments, stride)
+        return segment_imds(imd, lengths, float(imd.get("STEP", "DT")))
+
+    def tune_for_box(self, box: tuple = None, grid_spacing: float = DEFAULT_GRID_SPACING) -> dict:
+        """
+        Adapts the PAIRLIST cutoffs and the lattice-sum grid to the simulation box.
+        Parameters
+        ----------
+        box: tuple
+            box edge lengths in nm, read from the GENBOX block of structure.coord if not given
+        grid_spacing: float
+            target grid spacing in nm
+        Returns
+        ----------
+        nonbonded: dict
+            the chosen values, also recorded in the TITLE of generated inputs
+        """
+        if box is None:
+            coord = self.configuration["system"]["structure"]["coord"]
+            box = read_box(os.path.join(self.configuration["data_dir_base"], coord))
+        self.nonbonded = tune_nonbonded(box, grid_spacing)
+        values = " ".join(f"{key} {value}" for key, value in self.nonbonded.items())
+        self.tuning_note = f"Box-tuned for box {box[0]:g} {box[1]:g} {box[2]:g} nm: {values}\n"
+        logger.info(self.tuning_note.strip())
+        return self.nonbonded
+
+    def budget_output(
+        self, budget_bytes: float, env: str = "search", n_runs: int = 1, n_atoms: int = None
+    ) -> OutputPlan:
+        """
+        Picks the WRITETRAJ frequencies of a run so that its output stays within a budget.
+        Parameters
+        ----------
+        budget_bytes: float
+            bytes available, for a single run or for n_runs runs sharing the budget
+        env: str
+            search or production
+        n_runs: int
+            number of runs sharing budget_bytes, e.g. all runs of a campaign
+        n_atoms: int
+            number of atoms, counted from the topology (structure.topo) and NSM if not given
+        Returns
+        ----------
+        plan: OutputPlan
+            NTWX, NTWE, NTWG and the expected bytes written per run
+        """
+        prms = self._get_run_parameters(env)
+        if n_atoms is None:
+            topo = self.configuration["system"]["structure"]["topo"]
+            n_atoms = read_atom_count(os.path.join(self.configuration["data_dir_base"], topo), int(prms["NSM"]))
+        plan = plan_output(
+            int(prms["NSTLIM"]), n_atoms, int(prms["NSTATES"]), budget_bytes / n_runs, prms["NTWX"], prms["NTWE"]
+        )
+        self.output_plans[env] = plan
+        logger.info(
+            f"{env} output: NTWX {plan.NTWX} NTWE {plan.NTWE} NTWG {plan.NTWG}, "
+            f"expected {plan.total_bytes / 1e6:.1f} MB per run"
+        )
+        return plan
+
+    def _get_run_parameters(self, env: str) -> dict:
+        if env == "search":
+            return self.configuration["search_run"]["search_parameters"]
+        elif env == "production":
+            return self.configuration["production_run"]["production_parameters"]
+        raise NotImplementedError(f"Something went wrong with {env} input.")
+
+    def _get_output_fields(self, env: str, prms: dict) -> dict:
+        plan = self.output_plans.get(env)
+        if plan is None:
+            return {"NTWX": prms["NTWX"], "NTWE": prms["NTWE"], "NTWG": prms.get("NTWG", 0)}
+        return {"NTWX": plan.NTWX, "NTWE": plan.NTWE, "NTWG": plan.NTWG}
+
+    def _get_Gromos_input_header(self, env: str) -> str:
+        date = datetime.date.today()
+        header = f"""TITLE
+Automatically generated input file for {env} run with constph
+{VERSION_LINE}{date}
+{self.tuning_note}END
+"""
+        return header
+
+    def _get_search_fields(self) -> dict:
+        """Values of the search template fields"""
+        prms = self.configuration["search_run"]["search_parameters"]
+        fields = {
+            "NSM": prms["NSM"],
+            "NSTLIM": prms["NSTLIM"],
+            "DT": prms["dt"],
+            "ATMNR1": prms["ATMNR1"],
+            "ATMNR2": prms["ATMNR2"],
+            "FORM": "4",
+            "NSTATES": prms["NSTATES"],
+            "OFFSETS": "0   " * int(prms["NSTATES"]),
+            "SIGMA": prms["sigma"],
+            "ASTEPS": prms["asteps"],
+            "BSTEPS": prms["bsteps"],
+            "IG": prms.get("IG", DEFAULT_SEED),
+        }
+        fields.update(self._get_output_fields("search", prms))
+        fields.update(self.nonbonded)
+        return fields
+
+    def _get_production_fields(self, aeds_parameters: dict = None) -> dict:
+        """Values of the production template fields, EMIN/EMAX/offsets from aeds_parameters if given"""
+        prms = self.configuration["production_run"]["production_parameters"]
+        fields = {
+            "NSM": prms["NSM"],
+            "NSTLIM": prms["NSTLIM"],
+            "DT": prms["dt"],
+            "ATMNR1": prms["ATMNR1"],
+            "ATMNR2": prms["ATMNR2"],
+            "FORM": "4",
+            "NSTATES": prms["NSTATES"],
+            "OFFSETS": "0   {new_offset}",
+            "SIGMA": prms["sigma"],
+            "EMIN": "found in search",
+            "EMAX": "found in search",
+            "IG": prms.get("IG", DEFAULT_SEED),
+        }
+        fields.update(self._get_output_fields("production", prms))
+        fields.update(self.nonbonded)
+        if aeds_parameters is not None:
+            fields["EMIN"] = f"{aeds_parameters['EMIN']:.4f}"
+            fields["EMAX"] = f"{aeds_parameters['EMAX']:.4f}"
+            fields["OFFSETS"] = "   ".join(f"{offset:.4f}" for offset in aeds_parameters["offsets"])
+        return fields
+
+    def _get_Gromos_search_body(self) -> str:
+        return SEARCH_TEMPLATE.render(self._get_search_fields())
+
+    def _get_Gromos_production_body(self, aeds_parameters: dict = None) -> str:
+        return PRODUCTION_TEMPLATE.render(self._get_production_fields(aeds_parameters))
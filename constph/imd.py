@@ -0,0 +1,216 @@
+"""
+In-memory model of GROMOS block files (*.imd, and the block layout of *.top/*.cnf).
+
+A file is an ordered set of blocks. Each block keeps its lines as they were read and resolves
+named fields from the comment line above a data row (``#   NSTLIM   T   DT`` names the three
+values below it). Copies share their unmodified blocks and each block caches its serialized
+text, so thousands of patched variants of one reference input cost one parse and only
+re-serialize the blocks that were patched.
+"""
+import re
+
+from constph.atomic import atomic_write
+
+_token = re.compile(r"\S+")
+_field_name = re.compile(r"^[A-Za-z][A-Za-z0-9_.]*$")
+
+
+class ImdBlock(object):
+    __slots__ = ("name", "lines", "_fields", "_text")
+
+    def __init__(self, name: str, lines: list):
+        """
+        One block of a GROMOS block file.
+        Parameters
+        ----------
+        name: str
+            block name, e.g. STEP
+        lines: list
+            the lines between the name and END, comments included
+        """
+
+        self.name = name
+        self.lines = lines
+        self._fields = None
+        self._text = None
+
+    def __repr__(self):
+        return f"ImdBlock({self.name!r}, {len(self.lines)} lines)"
+
+    @property
+    def data_rows(self) -> list:
+        """Indices of the non-comment lines"""
+        return [i for i, line in enumerate(self.lines) if line.strip() and not line.lstrip().startswith("#")]
+
+    @property
+    def fields(self) -> dict:
+        """Field name -> (line index, token index), named by the comment line above each data row"""
+        if self._fields is None:
+            fields = {}
+            header = None
+            for i, line in enumerate(self.lines):
+                stripped = line.strip()
+                if not stripped:
+                    continue
+                if stripped.startswith("#"):
+                    header = stripped.lstrip("#").split()
+                    continue
+                tokens = stripped.split()
+                if header and len(header) == len(tokens) and all(_field_name.match(name) for name in header):
+                    for j, name in enumerate(header):
+                        fields.setdefault(name, (i, j))
+                header = None
+            self._fields = fields
+        return self._fields
+
+    def __contains__(self, field: str) -> bool:
+        return field in self.fields
+
+    def __getitem__(self, field: str) -> str:
+        line, token = self.fields[field]
+        return self.lines[line].split()[token]
+
+    def __setitem__(self, field: str, value):
+        """Replaces one value in place, right-aligned into its column as far as it fits"""
+        line, token = self.fields[field]
+        text = self.lines[line]
+        spans = [match.span() for match in _token.finditer(text)]
+        end = spans[token][1]
+        # the column reaches back to the previous value, keeping one blank as separator
+        column_start = spans[token - 1][1] + 1 if token > 0 else 0
+        value = str(value)
+        if len(value) > end - column_start:
+            value = (" " if token > 0 else "") + value
+            column_start -= 1 if token > 0 else 0
+        self.lines = self.lines[:line] + [text[:column_start] + value.rjust(end - column_start) + text[end:]] \
+            + self.lines[line + 1:]
+        self._text = None
+
+    def row(self, index: int) -> list:
+        """Tokens of the index-th data row"""
+        return self.lines[self.data_rows[index]].split()
+
+    def set_row(self, index: int, values):
+        """Replaces the index-th data row, e.g. the EIR offsets of the AEDS block"""
+        line = self.data_rows[index]
+        self.lines = self.lines[:line] + ["".join(f"{value:>10}" for value in values)] + self.lines[line + 1:]
+        self._fields = None
+        self._text = None
+
+    def copy(self) -> "ImdBlock":
+        block = ImdBlock(self.name, self.lines)
+        block._fields = self._fields
+        block._text = self._text
+        return block
+
+    def to_string(self) -> str:
+        if self._text is None:
+            self._text = "\n".join([self.name] + self.lines + ["END"])
+        return self._text
+
+
+class ImdFile(object):
+    def __init__(self, blocks: list = None):
+        """
+        An ordered collection of ImdBlocks.
+        Parameters
+        ----------
+        blocks: list
+            ImdBlock objects in file order
+        """
+
+        self.blocks = {}
+        for block in blocks or []:
+            self.blocks[block.name] = block
+
+    def __repr__(self):
+        return f"ImdFile({list(self.blocks)})"
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.blocks
+
+    def __iter__(self):
+        return iter(self.blocks.values())
+
+    def __getitem__(self, name: str) -> ImdBlock:
+        return self.blocks[name]
+
+    @classmethod
+    def parse(cls, lines) -> "ImdFile":
+        """
+        Streams blocks out of an iterable of lines (an open file or a list) or a string.
+        Lines outside of blocks (comments, blank lines) are dropped.
+        """
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        blocks = []
+        name = None
+        content = []
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if name is None:
+                stripped = line.strip()
+                if stripped and not stripped.startswith("#"):
+                    name = stripped
+                    content = []
+            elif line.strip() == "END":
+                blocks.append(ImdBlock(name, content))
+                name = None
+            else:
+                content.append(line)
+        if name is not None:
+            raise ValueError(f"Block {name} is not closed by END")
+        return cls(blocks)
+
+    @classmethod
+    def read(cls, path: str) -> "ImdFile":
+        with open(path) as f:
+            return cls.parse(f)
+
+    def get(self, block: str, field: str) -> str:
+        return self.blocks[block][field]
+
+    def copy(self) -> "ImdFile":
+        """A copy sharing all blocks, blocks are only copied once they are patched"""
+        imd = ImdFile()
+        imd.blocks = dict(self.blocks)
+        return imd
+
+    def set(self, block: str, field: str, value):
+        """Sets one field, copying the block first so copies of this file are not affected"""
+        patched = self.blocks[block].copy()
+        patched[field] = value
+        self.blocks[block] = patched
+
+    def set_row(self, block: str, index: int, values):
+        patched = self.blocks[block].copy()
+        patched.set_row(index, values)
+        self.blocks[block] = patched
+
+    def patched(self, patches: dict) -> "ImdFile":
+        """
+        Returns a variant of this file.
+        Parameters
+        ----------
+        patches: dict
+            (block, field) -> value, e.g. {("STEP", "NSTLIM"): 5000, ("INITIALISE", "IG"): 1234}
+        """
+        imd = self.copy()
+        copied = set()
+        for (block, field), value in patches.items():
+            if block not in copied:
+                imd.blocks[block] = imd.blocks[block].copy()
+                copied.add(block)
+            imd.blocks[block][field] = value
+        return imd
+
+    def to_string(self) -> str:
+        return "\n".join(block.to_string() for block in self.blocks.values()) + "\n"
+
+    def write(self, path: str):
+        atomic_write(path, self.to_string())
+
+
+def read_imd(path: str) -> ImdFile:
+    """Reads a GROMOS input file into an ImdFile"""
+    return ImdFile.read(path)
@@ -0,0 +1,90 @@
+"""
+Block-level template engine for GROMOS input files (*.imd).
+
+A template is split into its blocks (SYSTEM ... END, STEP ... END, ...) once. Blocks without
+placeholders are kept as finished strings, the others are split into literal segments and
+field slots, and each rendered block is memoized by the values of its own fields. Rendering
+many variants of an input therefore only re-renders the blocks whose fields changed.
+"""
+import re
+import string
+
+# rendered variants kept per block before the memo is reset
+BLOCK_CACHE_SIZE = 4096
+
+_block_end = re.compile(r"(?<=\nEND)\n")
+
+
+class ImdTemplateBlock(object):
+    __slots__ = ("name", "fields", "_segments", "_static", "_cache")
+
+    def __init__(self, text: str):
+        """
+        One block of an IMD template with str.format style placeholders, e.g. {NSTLIM}.
+        Parameters
+        ----------
+        text: str
+            the block from its name up to and including END
+        """
+
+        self.name = text.split("\n", 1)[0].strip()
+        self._segments = []
+        fields = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(text):
+            if format_spec or conversion:
+                raise ValueError(f"Only plain placeholders are supported in IMD templates: {field}")
+            self._segments.append((literal, field))
+            if field is not None and field not in fields:
+                fields.append(field)
+        self.fields = tuple(fields)
+        self._static = text if not fields else None
+        self._cache = {}
+
+    def render(self, values: dict) -> str:
+        if self._static is not None:
+            return self._static
+        key = tuple(str(values[field]) for field in self.fields)
+        rendered = self._cache.get(key)
+        if rendered is None:
+            filled = dict(zip(self.fields, key))
+            rendered = "".join(
+                literal if field is None else literal + filled[field] for literal, field in self._segments
+            )
+            if len(self._cache) >= BLOCK_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[key] = rendered
+        return rendered
+
+
+class ImdTemplate(object):
+    def __init__(self, text: str):
+        """
+        An IMD body template, compiled block by block.
+        Parameters
+        ----------
+        text: str
+            blocks separated by newlines, every block closed by a line END
+        """
+
+        self.blocks = [ImdTemplateBlock(block) for block in _block_end.split(text)]
+        self.fields = tuple(dict.fromkeys(field for block in self.blocks for field in block.fields))
+
+    @property
+    def static_blocks(self) -> list:
+        return [block.name for block in self.blocks if not block.fields]
+
+    def render(self, values: dict) -> str:
+        """
+        Renders the template.
+        Parameters
+        ----------
+        values: dict
+            field name -> value, every field of the template has to be present
+        Returns
+        ----------
+        body: str
+        """
+        missing = [field for field in self.fields if field not in values]
+        if missing:
+            raise KeyError(f"Missing IMD template fields: {missing}")
+        return "\n".join(block.render(values) for block in self.blocks)
@@ -0,0 +1,223 @@
+"""
+Multistate Bennett acceptance ratio (MBAR) for A-EDS production data.
+
+With several runs (replicas, pH values, offset sets), each run samples its own reference
+Hamiltonian. MBAR combines all frames of all runs: given the reduced energies u_kn of every
+frame n in every sampled state k, the free energies f_k solve
+
+    f_k = -ln sum_n exp(-u_kn) / sum_j N_j exp(f_j - u_jn)
+
+and the end states, which are not sampled directly, are reweighted from the pooled frames.
+The equations are solved by self-consistent iteration (vectorized over states and frames),
+switching to Newton steps on the convex MBAR objective when the iteration is slow. Frames are
+subsampled by the statistical inefficiency of each run to keep the u_kn matrix small and the
+samples uncorrelated.
+"""
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+
+from constph.analysis import logsumexp
+from constph.constants import BOLTZMANN, DEFAULT_TEMPERATURE
+from constph.uncertainty import subsample_indices
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOLERANCE = 1e-8
+# self-consistent iterations before switching to Newton steps
+SCI_ITERATIONS = 100
+MAX_ITERATIONS = 10000
+
+
+@dataclass
+class MBARResult:
+    # reduced free energies of the sampled states, f_k[0] = 0
+    f_k: np.ndarray
+    # ln of the frame weights, -ln sum_k N_k exp(f_k - u_kn)
+    log_weights: np.ndarray
+    iterations: int
+    method: str
+    converged: bool
+
+    def target_free_energies(self, u_ln: np.ndarray) -> np.ndarray:
+        """
+        Reduced free energies of further states (e.g. the end states) relative to sampled
+        state 0, u_ln: their reduced energies, states x frames
+        """
+        return -logsumexp(self.log_weights[None, :] - np.asarray(u_ln, dtype=float), axis=1)
+
+
+def _log_denominator(u_kn, log_n_k, f_k):
+    return logsumexp(log_n_k[:, None] + f_k[:, None] - u_kn, axis=0)
+
+
+def _self_consistent_step(u_kn, log_n_k, f_k):
+    log_denominator = _log_denominator(u_kn, log_n_k, f_k)
+    f_new = -logsumexp(-u_kn - log_denominator[None, :], axis=1)
+    return f_new - f_new[0]
+
+
+def _newton_step(u_kn, n_k, log_n_k, f_k):
+    """Newton step on f_k[1:] with backtracking, None if the Hessian is singular"""
+
+    def objective(f):
+        log_denominator = _log_denominator(u_kn, log_n_k, f)
+        return float(np.sum(log_denominator) - np.dot(n_k, f)), log_denominator
+
+    value, log_denominator = objective(f_k)
+    w = np.exp(f_k[:, None] - u_kn - log_denominator[None, :])
+    w_sum = w.sum(axis=1)
+    gradient = n_k * w_sum - n_k
+    hessian = np.diag(n_k * w_sum) - n_k[:, None] * (w @ w.T) * n_k[None, :]
+    try:
+        delta = np.linalg.solve(hessian[1:, 1:], gradient[1:])
+    except np.linalg.LinAlgError:
+        return None
+    step = 1.0
+    for _ in range(30):
+        f_new = f_k.copy()
+        f_new[1:] -= step * delta
+        if objective(f_new)[0] <= value + 1e-12 * abs(value):
+            return f_new
+        step /= 2
+    return None
+
+
+def mbar(
+    u_kn: np.ndarray,
+    n_k,
+    f_init: np.ndarray = None,
+    tolerance: float = DEFAULT_TOLERANCE,
+    max_iterations: int = MAX_ITERATIONS,
+    sci_iterations: int = SCI_ITERATIONS,
+) -> MBARResult:
+    """
+    Solves the MBAR equations.
+    Parameters
+    ----------
+    u_kn: np.ndarray
+        reduced energies of every frame in every sampled state, states x frames; the frames
+        are ordered by the state that sampled them
+    n_k: list
+        frames sampled from each state, all > 0
+    f_init: np.ndarray
+        initial reduced free energies, e.g. EXP offsets; by default EXP from the frames of state 0
+    tolerance: float
+        largest change of f_k at convergence
+    max_iterations: int
+        most iterations in total
+    sci_iterations: int
+        self-consistent iterations before Newton steps take over
+    Returns
+    ----------
+    result: MBARResult
+    """
+    u_kn = np.asarray(u_kn, dtype=float)
+    n_k = np.asarray(n_k, dtype=float)
+    if u_kn.ndim != 2 or len(n_k) != len(u_kn) or n_k.sum() != u_kn.shape[1]:
+        raise ValueError(f"u_kn of shape {u_kn.shape} does not match {n_k.size} states with {n_k.sum():.0f} frames")
+    if np.any(n_k <= 0):
+        raise ValueError("Every state of u_kn needs samples, reweight unsampled states with target_free_energies")
+    log_n_k = np.log(n_k)
+
+    if f_init is None:
+        # EXP from the frames of state 0
+        own = u_kn[:, :int(n_k[0])]
+        f_k = -logsumexp(-(own - own[0]), axis=1) + np.log(n_k[0])
+    else:
+        f_k = np.asarray(f_init, dtype=float).copy()
+    f_k -= f_k[0]
+
+    method = "self-consistent"
+    converged = False
+    iteration = 0
+    while iteration < max_iterations:
+        iteration += 1
+        f_new = None
+        if method == "newton":
+            f_new = _newton_step(u_kn, n_k, log_n_k, f_k)
+            if f_new is None:
+                logger.debug("Newton step failed, continuing with self-consistent iteration")
+                method = "self-consistent"
+        if f_new is None:
+            f_new = _self_consistent_step(u_kn, log_n_k, f_k)
+        change = np.max(np.abs(f_new - f_k))
+        f_k = f_new
+        if change < tolerance:
+            converged = True
+            break
+        if method == "self-consistent" and iteration == sci_iterations:
+            method = "newton"
+
+    if not converged:
+        logger.warning(f"MBAR did not converge in {max_iterations} iterations")
+    log_weights = -_log_denominator(u_kn, log_n_k, f_k)
+    return MBARResult(f_k, log_weights, iteration, method, converged)
+
+
+def eds_reference_energies(
+    e_states: np.ndarray,
+    offsets,
+    temperature: float = DEFAULT_TEMPERATURE,
+    emin: float = None,
+    emax: float = None,
+) -> np.ndarray:
+    """
+    Energy of the EDS reference state, V_R = -kT ln sum_i exp(-(V_i - E_i) / kT), of every
+    frame for the offsets E_i. With emin and emax it is accelerated as in A-EDS: unchanged
+    below emin, lowered by (V_R - emin)^2 / (2 (emax - emin)) up to emax and by
+    (emax - emin) / 2 above.
+    """
+    kT = BOLTZMANN * temperature
+    e_states = np.asarray(e_states, dtype=float)
+    v_r = -kT * logsumexp(-(e_states - np.asarray(offsets, dtype=float)[None, :]) / kT, axis=1)
+    if emin is not None and emax is not None and emax > emin:
+        width = emax - emin
+        between = (v_r > emin) & (v_r < emax)
+        v_r[between] -= (v_r[between] - emin) ** 2 / (2.0 * width)
+        v_r[v_r >= emax] -= width / 2.0
+    return v_r
+
+
+def aeds_mbar(runs: list, temperature: float = DEFAULT_TEMPERATURE, subsample: bool = True, **kwargs) -> np.ndarray:
+    """
+    Free energies of the end states from the production runs of one system.
+    Parameters
+    ----------
+    runs: list
+        one dict per run with its end-state energies (e_states, frames x states) and the
+        A-EDS parameters it ran with (offsets, optionally EMIN and EMAX), e.g. the dict of
+        aeds_parameters_from_search extended by e_states
+    temperature: float
+        temperature in K
+    subsample: bool
+        keep only uncorrelated frames of each run, by the statistical inefficiency of its
+        reference energy
+    kwargs:
+        passed to mbar
+    Returns
+    ----------
+    free_energies: np.ndarray
+        end-state free energies relative to the first end state, kJ/mol
+    """
+    kT = BOLTZMANN * temperature
+    parameters = [(run["offsets"], run.get("EMIN"), run.get("EMAX")) for run in runs]
+    e_states = []
+    for run, (offsets, emin, emax) in zip(runs, parameters):
+        energies = np.asarray(run["e_states"], dtype=float)
+        if subsample:
+            energies = energies[subsample_indices(eds_reference_energies(energies, offsets, temperature, emin, emax))]
+        e_states.append(energies)
+    n_k = [len(energies) for energies in e_states]
+    e_states = np.concatenate(e_states)
+
+    u_kn = np.empty((len(runs), len(e_states)))
+    for k, (offsets, emin, emax) in enumerate(parameters):
+        u_kn[k] = eds_reference_energies(e_states, offsets, temperature, emin, emax) / kT
+    result = mbar(u_kn, n_k, **kwargs)
+    logger.info(
+        f"MBAR over {len(runs)} runs and {len(e_states)} frames: {result.method}, {result.iterations} iterations"
+    )
+    f_l = result.target_free_energies(e_states.T / kT)
+    return kT * (f_l - f_l[0])
@@ -0,0 +1,163 @@
+"""
+Output-volume budgeting of the WRITETRAJ block.
+
+The write frequencies NTWX (coordinates, *.trc), NTWE (energies, *.tre) and NTWG (free-energy
+derivatives, *.trg) are chosen as divisors of NSTLIM so that the expected bytes of a run stay
+within a budget. The energies needed for the A-EDS statistics are mandatory, a minimal
+coordinate trajectory is reserved if it fits next to them, then the energies and the
+coordinates are refined in that order and the free-energy trajectory is only written if there
+is room left.
+The frame sizes are estimates of the uncompressed md++ text output.
+"""
+import logging
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# POSITIONRED line per atom: 3 x %15.9f plus newline
+COORDINATE_BYTES_PER_ATOM = 46
+# TIMESTEP and GENBOX blocks of every coordinate frame
+COORDINATE_BYTES_PER_FRAME = 300
+# ENERGY03 and VOLUMEPRESSURE03 blocks, plus the eds section per end state
+ENERGY_BYTES_PER_FRAME = 5000
+ENERGY_BYTES_PER_STATE = 100
+# FREEENERDERIVS03 block
+FREE_ENERGY_BYTES_PER_FRAME = 2000
+
+# frames needed for the A-EDS statistics and for a usable trajectory
+MIN_ENERGY_FRAMES = 2000
+MIN_COORDINATE_FRAMES = 100
+
+
+@dataclass
+class OutputPlan:
+    NTWX: int
+    NTWE: int
+    NTWG: int
+    n_atoms: int
+    coordinate_bytes: int
+    energy_bytes: int
+    free_energy_bytes: int
+
+    @property
+    def total_bytes(self) -> int:
+        return self.coordinate_bytes + self.energy_bytes + self.free_energy_bytes
+
+
+def read_atom_count(top_file: str, nsm: int) -> int:
+    """
+    Returns the number of atoms of a system from its GROMOS topology: the solute atoms
+    (first value of SOLUTEATOM) plus nsm times the atoms per solvent molecule (SOLVENTATOM).
+    The topology is streamed and only the first value of the two blocks is read.
+    """
+    counts = {}
+    with open(top_file) as f:
+        block = None
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            if block is None:
+                block = stripped
+            elif stripped == "END":
+                block = None
+            elif block in ("SOLUTEATOM", "SOLVENTATOM") and block not in counts:
+                counts[block] = int(stripped.split()[0])
+                if len(counts) == 2:
+                    break
+    if "SOLUTEATOM" not in counts:
+        raise ValueError(f"No SOLUTEATOM block in {top_file}")
+    return counts["SOLUTEATOM"] + nsm * counts.get("SOLVENTATOM", 0)
+
+
+def _divisors(n: int) -> list:
+    small = [d for d in range(1, int(n ** 0.5) + 1) if n % d == 0]
+    return sorted(set(small + [n // d for d in small]))
+
+
+def _finest_stride(nstlim: int, min_stride: int, bytes_per_frame: int, budget: float):
+    """Smallest divisor of nstlim >= min_stride whose frames fit into budget, None if none fits"""
+    for stride in _divisors(nstlim):
+        if stride >= min_stride and nstlim // stride * bytes_per_frame <= budget:
+            return stride
+    return None
+
+
+def _coarsest_stride(nstlim: int, min_frames: int):
+    """Largest divisor of nstlim that still yields min_frames frames, None if there is none"""
+    strides = [stride for stride in _divisors(nstlim) if nstlim // stride >= min_frames]
+    return strides[-1] if strides else None
+
+
+def plan_output(
+    nstlim: int,
+    n_atoms: int,
+    nstates: int,
+    budget_bytes: float,
+    ntwx: int = 1,
+    ntwe: int = 1,
+    min_energy_frames: int = MIN_ENERGY_FRAMES,
+    min_coordinate_frames: int = MIN_COORDINATE_FRAMES,
+) -> OutputPlan:
+    """
+    Picks NTWX, NTWE and NTWG for one run.
+    Parameters
+    ----------
+    nstlim: int
+        number of steps of the run
+    n_atoms: int
+        number of atoms of the system
+    nstates: int
+        number of A-EDS end states
+    budget_bytes: float
+        bytes the run may write
+    ntwx, ntwe: int
+        finest write frequencies wanted (the configured ones), 0 switches the output off
+    min_energy_frames: int
+        energy frames needed for the A-EDS statistics
+    min_coordinate_frames: int
+        smallest trajectory worth writing, reserved before the energies get the rest
+    Returns
+    ----------
+    plan: OutputPlan
+    Raises
+    ----------
+    ValueError
+        if not even min_energy_frames fit into the budget of a run that writes energies
+    """
+    energy_frame = ENERGY_BYTES_PER_FRAME + ENERGY_BYTES_PER_STATE * nstates
+    coordinate_frame = COORDINATE_BYTES_PER_FRAME + COORDINATE_BYTES_PER_ATOM * n_atoms
+    min_energy_bytes = 0
+    if ntwe:
+        min_energy_frames = min(min_energy_frames, nstlim // ntwe)
+        needed = _coarsest_stride(nstlim, min_energy_frames)
+        if needed is None or nstlim // needed * energy_frame > budget_bytes:
+            raise ValueError(
+                f"An output budget of {budget_bytes:.0f} bytes can not hold {min_energy_frames} energy frames "
+                f"of {energy_frame} bytes"
+            )
+        min_energy_bytes = nstlim // needed * energy_frame
+
+    # keep the smallest useful trajectory, if it fits next to the minimal energies
+    reserved = 0
+    coarsest = _coarsest_stride(nstlim, min(min_coordinate_frames, nstlim // ntwx)) if ntwx else None
+    if coarsest is not None and coarsest >= ntwx:
+        reserved = nstlim // coarsest * coordinate_frame
+        if reserved + min_energy_bytes > budget_bytes:
+            reserved = 0
+
+    NTWE = _finest_stride(nstlim, ntwe, energy_frame, budget_bytes - reserved) if ntwe else 0
+    energy_bytes = nstlim // NTWE * energy_frame if NTWE else 0
+    remaining = budget_bytes - energy_bytes
+
+    NTWX = _finest_stride(nstlim, ntwx, coordinate_frame, remaining) if reserved else None
+    NTWX = NTWX or 0
+    coordinate_bytes = nstlim // NTWX * coordinate_frame if NTWX else 0
+    remaining -= coordinate_bytes
+
+    free_energy_bytes = nstlim // NTWE * FREE_ENERGY_BYTES_PER_FRAME if NTWE else 0
+    NTWG = NTWE if free_energy_bytes <= remaining else 0
+    if not NTWG:
+        free_energy_bytes = 0
+
+    return OutputPlan(NTWX, NTWE, NTWG, n_atoms, coordinate_bytes, energy_bytes, free_energy_bytes)
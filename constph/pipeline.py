@@ -0,0 +1,152 @@
+"""
+Chaining of the A-EDS search run into the production run.
+
+Once a search run has finished, its energy output provides EMIN, EMAX and the end-state offsets
+(EIR) the production run needs. The energies are read as time series extracted with ene_ana
+(one ``<property>.dat`` file per property, time in the first and the value in the last column).
+If the search run wrote its final EMAX/EMIN/EIR, those are taken directly; otherwise they are
+estimated from the end-state and reference energies.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+from constph.analysis import relative_free_energies
+from constph.atomic import atomic_write, sync_pending
+from constph.constants import DEFAULT_TEMPERATURE
+from constph.gromos_factory import GromosFactory
+
+logger = logging.getLogger(__name__)
+
+# ene_ana property names of the search run output
+REFERENCE_ENERGY = "eds_vr"
+STATE_ENERGY = "e{}"
+EMAX_PROPERTY = "eds_emax"
+EMIN_PROPERTY = "eds_emin"
+OFFSET_PROPERTY = "eir{}"
+
+
+def read_ene_ana_series(path: str) -> np.ndarray:
+    """Returns the values (last column) of an ene_ana time series file"""
+    data = np.loadtxt(path, comments="#", ndmin=2)
+    return data[:, -1]
+
+
+def aeds_parameters_from_energies(
+    e_states: np.ndarray,
+    e_ref: np.ndarray,
+    temperature: float = DEFAULT_TEMPERATURE,
+    emax_width: float = 3.0,
+) -> dict:
+    """
+    Estimates the A-EDS production parameters from the energies of a search run.
+    The offsets are the EXP free energies of the end states relative to state 1 (see
+    constph.analysis). EMIN is the highest mean offset-corrected energy of the end states, each
+    averaged over the frames in which it is the lowest state; EMAX lies emax_width standard
+    deviations of the broadest state above EMIN.
+    Parameters
+    ----------
+    e_states: np.ndarray
+        end-state energies, frames x states
+    e_ref: np.ndarray
+        reference-state energies, frames
+    temperature: float
+        temperature in K
+    emax_width: float
+        distance of EMAX above EMIN, in standard deviations of the end-state energies
+    Returns
+    ----------
+    parameters: dict
+        EMIN, EMAX and offsets (list, one per state, first one 0)
+    """
+    e_states = np.asarray(e_states, dtype=float)
+    e_ref = np.asarray(e_ref, dtype=float)
+    offsets = relative_free_energies(e_states, e_ref, temperature)
+
+    shifted = e_states - offsets
+    lowest = np.argmin(shifted, axis=1)
+    means = np.empty(shifted.shape[1])
+    stds = np.empty(shifted.shape[1])
+    for state in range(shifted.shape[1]):
+        own = shifted[lowest == state, state]
+        if len(own) == 0:
+            own = shifted[:, state]
+        means[state] = own.mean()
+        stds[state] = own.std()
+
+    emin = float(means.max())
+    return {"EMIN": emin, "EMAX": emin + emax_width * float(stds.max()), "offsets": offsets.tolist()}
+
+
+def aeds_parameters_from_search(search_dir: str, nstates: int, temperature: float = DEFAULT_TEMPERATURE) -> dict:
+    """
+    Returns EMIN, EMAX and the offsets for the production run from a finished search run.
+    The final values written by the search are used if all of them are present, otherwise they
+    are estimated from the end-state and reference energies with aeds_parameters_from_energies.
+    Parameters
+    ----------
+    search_dir: str
+        directory with the ene_ana time series of the search run
+    nstates: int
+        number of end states
+    """
+
+    def series(prop):
+        return os.path.join(search_dir, f"{prop}.dat")
+
+    final = [series(EMAX_PROPERTY), series(EMIN_PROPERTY)]
+    final += [series(OFFSET_PROPERTY.format(i)) for i in range(1, nstates + 1)]
+    if all(os.path.isfile(path) for path in final):
+        values = [float(read_ene_ana_series(path)[-1]) for path in final]
+        offsets = np.array(values[2:]) - values[2]
+        logger.info(f"Taking EMAX/EMIN/EIR of the search run in {search_dir}")
+        return {"EMIN": values[1], "EMAX": values[0], "offsets": offsets.tolist()}
+
+    logger.info(f"Estimating EMAX/EMIN/EIR from the energies of the search run in {search_dir}")
+    e_ref = read_ene_ana_series(series(REFERENCE_ENERGY))
+    e_states = np.column_stack(
+        [read_ene_ana_series(series(STATE_ENERGY.format(i))) for i in range(1, nstates + 1)]
+    )
+    return aeds_parameters_from_energies(e_states, e_ref, temperature)
+
+
+def write_production_from_search(
+    factory: GromosFactory, search_dir: str, output_file: str, temperature: float = DEFAULT_TEMPERATURE
+) -> dict:
+    """
+    Renders the production input of a system directly from its finished search run.
+    The parameters are stored next to the input as aeds_parameters.json.
+    Parameters
+    ----------
+    factory: GromosFactory
+        factory of the system
+    search_dir: str
+        directory with the ene_ana time series of the search run
+    output_file: str
+        path of the production input
+    Returns
+    ----------
+    parameters: dict
+        EMIN, EMAX and offsets written to the input
+    """
+
+    nstates = int(factory.configuration["production_run"]["production_parameters"]["NSTATES"])
+    parameters = aeds_parameters_from_search(search_dir, nstates, temperature)
+    write_production_input(factory, parameters, output_file)
+    return parameters
+
+
+def write_production_input(factory: GromosFactory, parameters: dict, output_file: str):
+    """
+    Writes the production input for the A-EDS parameters (EMIN, EMAX, offsets) and stores them
+    next to it as aeds_parameters.json.
+    """
+    atomic_write(output_file, factory.generate_Gromos_production_input("production", parameters))
+    atomic_write(
+        os.path.join(os.path.dirname(os.path.abspath(output_file)), "aeds_parameters.json"),
+        json.dumps(parameters, indent=1),
+    )
+    sync_pending()
+    logger.info(f"Production input written to {output_file}")
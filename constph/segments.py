@@ -0,0 +1,262 @@
+"""
+Segmented runs with restart chaining.
+
+A long run is split into segments of whole write intervals. The first segment starts from the
+configured coordinates with the settings of the template, every later segment continues from
+the final configuration of the one before: its INITIALISE block reads velocities and lattice
+shifts instead of generating them, the A-EDS parameters (EMAX/EMIN or the search state) are
+read from the configuration, and the start time is the end time of the previous segment.
+
+The chain is described by ``chain_manifest.json`` next to the segment inputs, one entry per
+segment with its md++ command line. A segment counts as finished once its final configuration
+is complete, so an interrupted chain is resumed from the last finished segment. A chain with a
+stop request (chain_stop.json) does not start further segments.
+"""
+import json
+import logging
+import math
+import os
+import subprocess
+
+from constph.atomic import atomic_write, sync_pending
+from constph.imd import ImdFile
+
+logger = logging.getLogger(__name__)
+
+CHAIN_MANIFEST = "chain_manifest.json"
+# written to stop a chain at the next segment boundary, e.g. by a convergence monitor
+STOP_FILE = "chain_stop.json"
+
+# INITIALISE and AEDS values of a continuation: read everything from the previous configuration.
+# The A-EDS settings themselves (RESTREMIN, BMAXTYPE, ...) stay those of the first segment.
+CONTINUATION_FLAGS = {
+    ("INITIALISE", "NTIVEL"): 0,
+    ("INITIALISE", "NTISHK"): 0,
+    ("INITIALISE", "NTINHT"): 0,
+    ("INITIALISE", "NTINHB"): 0,
+    ("INITIALISE", "NTISHI"): 0,
+    ("INITIALISE", "NTIRTC"): 0,
+    ("INITIALISE", "NTICOM"): 0,
+    ("INITIALISE", "NTISTI"): 0,
+    ("AEDS", "NTIAEDSS"): 0,
+}
+
+
+def split_nstlim(nstlim: int, n_segments: int, stride: int = 1) -> list:
+    """
+    Splits nstlim steps into n_segments lengths that are multiples of stride.
+    Longer segments come first when the steps do not divide evenly.
+    Parameters
+    ----------
+    nstlim: int
+        steps of the whole run
+    n_segments: int
+        number of segments
+    stride: int
+        the segment lengths are multiples of it, e.g. the write frequencies
+    Returns
+    ----------
+    lengths: list
+        steps per segment, summing to nstlim
+    """
+    if n_segments < 1:
+        raise ValueError(f"Expected at least one segment, got {n_segments}")
+    if nstlim % stride:
+        raise ValueError(f"NSTLIM {nstlim} is not a multiple of the write interval {stride}")
+    units = nstlim // stride
+    if units < n_segments:
+        raise ValueError(f"NSTLIM {nstlim} can not be split into {n_segments} segments of whole {stride} steps")
+    base, extra = divmod(units, n_segments)
+    return [(base + (i < extra)) * stride for i in range(n_segments)]
+
+
+def write_stride(*frequencies) -> int:
+    """Least common multiple of the write frequencies that are switched on"""
+    return math.lcm(*[int(frequency) for frequency in frequencies if frequency and int(frequency) > 0] or [1])
+
+
+def segment_imds(reference: ImdFile, lengths: list, dt: float) -> list:
+    """
+    The inputs of a chain of segments.
+    Parameters
+    ----------
+    reference: ImdFile
+        input of the whole run
+    lengths: list
+        steps per segment, see split_nstlim
+    dt: float
+        time step in ps
+    Returns
+    ----------
+    imds: list
+        one ImdFile per segment, sharing the blocks they do not change
+    """
+    imds = []
+    step = 0
+    for i, nstlim in enumerate(lengths):
+        patches = {("STEP", "NSTLIM"): nstlim}
+        if i > 0:
+            # full precision, a rounded start time shifts the time axis of the joined trajectories
+            patches[("STEP", "T")] = f"{step * dt:.10g}"
+            patches.update({key: value for key, value in CONTINUATION_FLAGS.items() if key[0] in reference})
+        imds.append(reference.patched(patches))
+        step += nstlim
+    return imds
+
+
+def configuration_complete(path: str) -> bool:
+    """True if a final configuration exists and has its POSITION and GENBOX blocks closed"""
+    if not os.path.isfile(path):
+        return False
+    try:
+        cnf = ImdFile.read(path)
+    except ValueError:
+        return False
+    return "POSITION" in cnf and "GENBOX" in cnf
+
+
+def write_segment_chain(
+    factory, env: str, n_segments: int, out_dir: str, prefix: str = None, aeds_parameters: dict = None
+) -> list:
+    """
+    Writes the segment inputs of a run and the chain manifest.
+    Parameters
+    ----------
+    factory: GromosFactory
+        factory of the system
+    env: str
+        search or production
+    n_segments: int
+        number of segments
+    out_dir: str
+        directory of the inputs, the outputs of the segments and chain_manifest.json
+    prefix: str
+        file name prefix, defaults to env
+    aeds_parameters: dict
+        EMIN, EMAX and offsets of a production run, see GromosFactory.generate_Gromos_production_input
+    Returns
+    ----------
+    manifest: list
+        one dict per segment: index, input, steps, start time, coordinates in and out, command
+    """
+    prefix = prefix or env
+    imds = factory.generate_Gromos_segments(env, n_segments, aeds_parameters)
+    structure = factory.configuration["system"]["structure"]
+    base = factory.configuration["data_dir_base"]
+    md = factory.configuration["config"]["paths"]["gromos_bin"]
+    conf = os.path.abspath(os.path.join(base, structure["coord"]))
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = []
+    for i, imd in enumerate(imds, start=1):
+        name = f"{prefix}_seg{i:03d}"
+        imd.write(os.path.join(out_dir, f"{name}.imd"))
+        files = {"input": f"{name}.imd", "fin": f"{name}.cnf", "trc": f"{name}.trc", "tre": f"{name}.tre"}
+        command = [
+            md,
+            "@topo", os.path.abspath(os.path.join(base, structure["topo"])),
+            "@pttopo", os.path.abspath(os.path.join(base, structure["pttopo"])),
+            "@conf", conf,
+            "@input", files["input"],
+            "@fin", files["fin"],
+            "@trc", files["trc"],
+            "@tre", files["tre"],
+        ]
+        manifest.append(dict(
+            index=i,
+            steps=int(imd.get("STEP", "NSTLIM")),
+            time=float(imd.get("STEP", "T")),
+            conf=conf,
+            log=f"{name}.omd",
+            command=command,
+            status="pending",
+            **files,
+        ))
+        conf = files["fin"]
+
+    _write_manifest(out_dir, manifest)
+    sync_pending()
+    logger.info(f"Wrote a chain of {len(manifest)} {env} segments to {out_dir}")
+    return manifest
+
+
+def _write_manifest(out_dir: str, manifest: list):
+    atomic_write(os.path.join(out_dir, CHAIN_MANIFEST), json.dumps(manifest, indent=1))
+
+
+def read_chain(out_dir: str) -> list:
+    with open(os.path.join(out_dir, CHAIN_MANIFEST)) as f:
+        return json.load(f)
+
+
+def resume_chain(out_dir: str) -> list:
+    """
+    Marks the segments with a complete final configuration as finished, up to the first one
+    without, and returns the segments left to run. Outputs of segments after an unfinished one
+    are not trusted, they did not start from this chain.
+    """
+    manifest = read_chain(out_dir)
+    pending = []
+    for segment in manifest:
+        if not pending and configuration_complete(os.path.join(out_dir, segment["fin"])):
+            segment["status"] = "finished"
+        else:
+            if segment["status"] != "failed" or pending:
+                segment["status"] = "pending"
+            pending.append(segment)
+    _write_manifest(out_dir, manifest)
+    if pending and pending[0]["index"] > 1:
+        logger.info(f"Resuming the chain in {out_dir} at segment {pending[0]['index']}")
+    return pending
+
+
+def request_stop(out_dir: str, reason: dict = None):
+    """Asks the chain to stop at the next segment boundary, reason is stored in the stop file"""
+    atomic_write(os.path.join(out_dir, STOP_FILE), json.dumps(reason or {}, indent=1))
+    logger.info(f"Stop requested for the chain in {out_dir}")
+
+
+def stop_requested(out_dir: str) -> bool:
+    return os.path.isfile(os.path.join(out_dir, STOP_FILE))
+
+
+def run_chain(out_dir: str, stop=None) -> list:
+    """
+    Runs the segments left in a chain back-to-back, resuming after the last finished one.
+    Parameters
+    ----------
+    out_dir: str
+        directory of the chain
+    stop: callable
+        called with the manifest entry of each finished segment, the chain stops at that
+        segment boundary if it returns True; a stop request (request_stop) has the same effect
+    Returns
+    ----------
+    pending: list
+        segments that are still to run
+    Raises
+    ----------
+    RuntimeError
+        if md++ fails or does not write a complete final configuration, the segment is
+        marked as failed and the chain can be resumed
+    """
+    pending = resume_chain(out_dir)
+    manifest = read_chain(out_dir)
+    while pending:
+        segment = pending[0]
+        if stop_requested(out_dir):
+            logger.info(f"Chain in {out_dir} stopped before segment {segment['index']} on request")
+            break
+        logger.info(f"Running segment {segment['index']} of {len(manifest)} in {out_dir}")
+        with open(os.path.join(out_dir, segment["log"]), "w") as log:
+            result = subprocess.run(segment["command"], cwd=out_dir, stdout=log, stderr=subprocess.STDOUT)
+        finished = result.returncode == 0 and configuration_complete(os.path.join(out_dir, segment["fin"]))
+        manifest[segment["index"] - 1]["status"] = "finished" if finished else "failed"
+        _write_manifest(out_dir, manifest)
+        if not finished:
+            raise RuntimeError(f"Segment {segment['index']} in {out_dir} failed, see {segment['log']}")
+        pending.pop(0)
+        if stop is not None and stop(segment):
+            logger.info(f"Chain in {out_dir} stopped after segment {segment['index']}")
+            break
+    return pending
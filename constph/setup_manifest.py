@@ -0,0 +1,258 @@
+"""
+Incremental setup of system directories.
+
+A SetupManifest records every file the setup generated below a system directory with the
+sha256 of its content and the size and mtime it had after writing; staged copies additionally
+record their source and its size and mtime. A re-setup renders the inputs again in memory and
+only writes the files whose content changed or that were changed or removed on disk, so an
+unchanged setup costs one stat per file. Files the setup did not generate (run outputs, notes)
+are never touched. Directories that already hold run outputs keep their inputs: a changed
+input is reported instead of rewritten, so a finished or running simulation stays consistent
+with its input. Generated files that are no longer part of the setup are removed, unless they
+were modified or their run has started.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from constph.atomic import atomic_copy, atomic_write
+from constph.column_cache import file_sha256
+from constph.segments import CHAIN_MANIFEST, read_chain
+
+logger = logging.getLogger(__name__)
+
+SETUP_MANIFEST = "setup_manifest.json"
+SETUP_MANIFEST_FORMAT = 1
+# files md++ writes into a run directory
+RUN_OUTPUT_SUFFIXES = (".omd", ".tre", ".tre.gz", ".trc", ".trc.gz", ".trg", ".trg.gz")
+
+
+@dataclass
+class SetupReport:
+    written: int = 0
+    unchanged: int = 0
+    # changed or new inputs of runs that already started, not written
+    kept: int = 0
+    removed: int = 0
+    # wall-clock time of the setup and the time spent per stage, summed over threads
+    wall_time: float = 0.0
+    stage_times: dict = field(default_factory=dict)
+
+    def __str__(self) -> str:
+        stages = ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in sorted(self.stage_times.items()))
+        return (
+            f"{self.written} written, {self.unchanged} unchanged, {self.kept} kept, {self.removed} removed "
+            f"in {self.wall_time:.2f} s ({stages})"
+        )
+
+
+def _stat(path: str) -> list:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def run_started(directory: str) -> bool:
+    """True if md++ wrote into the directory: a chain past its first segment or run output files"""
+    if not os.path.isdir(directory):
+        return False
+    if os.path.isfile(os.path.join(directory, CHAIN_MANIFEST)):
+        if any(segment["status"] != "pending" for segment in read_chain(directory)):
+            return True
+    return any(name.endswith(RUN_OUTPUT_SUFFIXES) for name in os.listdir(directory))
+
+
+class SetupManifest(object):
+    def __init__(self, root: str):
+        """
+        The generated files below root, read from root/setup_manifest.json if it exists.
+        Files of different directories can be written from several threads.
+        Parameters
+        ----------
+        root: str
+            system directory, paths in the manifest are relative to it
+        """
+
+        self.root = root
+        self.files = {}
+        self.report = SetupReport()
+        self._seen = set()
+        self._started = {}
+        self._changed = False
+        self._lock = threading.Lock()
+        try:
+            with open(os.path.join(root, SETUP_MANIFEST)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            # emptied by a crash of the machine before its batched fsync, see constph.atomic
+            logger.warning(f"{SETUP_MANIFEST} of {root} is damaged, every input is checked again")
+            return
+        if manifest.get("format") == SETUP_MANIFEST_FORMAT:
+            self.files = manifest["files"]
+
+    def __contains__(self, relative: str) -> bool:
+        return relative in self.files
+
+    def _run_started(self, relative: str) -> bool:
+        directory = os.path.dirname(relative)
+        if directory not in self._started:
+            self._started[directory] = run_started(os.path.join(self.root, directory))
+        return self._started[directory]
+
+    def _count(self, name: str):
+        with self._lock:
+            setattr(self.report, name, getattr(self.report, name) + 1)
+
+    @contextmanager
+    def timed(self, stage: str):
+        """Adds the time spent in the block to the stage times of the report"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.report.stage_times[stage] = self.report.stage_times.get(stage, 0.0) + elapsed
+
+    def _unchanged(self, relative: str, digest: str, target: str) -> bool:
+        entry = self.files.get(relative)
+        return entry is not None and entry["sha256"] == digest and entry["stat"] == _stat(target)
+
+    def _keep(self, relative: str, target: str) -> bool:
+        """True if a changed or new file is not written because the run of its directory started"""
+        if self._run_started(relative):
+            if os.path.exists(target):
+                logger.warning(f"{relative} changed, but its run has started: the file is kept")
+            else:
+                logger.warning(f"{relative} is new, but the run of its directory has started: it is not written")
+            self._count("kept")
+            return True
+        return False
+
+    def _record(self, relative: str, entry: dict):
+        with self._lock:
+            self.files[relative] = entry
+            self._changed = True
+        self._count("written")
+
+    def write_text(self, relative: str, content: str, target: str = None, compare: str = None) -> bool:
+        """
+        Writes a generated file unless the same content is already in place.
+        Parameters
+        ----------
+        relative: str
+            path of the file below root
+        content: str
+            content of the file
+        target: str
+            where the file is written now, e.g. in a directory that is renamed to its place
+            below root afterwards; defaults to root/relative
+        compare: str
+            the part of content that decides whether the file changed, e.g. without a date;
+            defaults to content
+        Returns
+        ----------
+        written: bool
+        """
+        self._seen.add(relative)
+        data = content.encode()
+        digest = hashlib.sha256((content if compare is None else compare).encode()).hexdigest()
+        target = target or os.path.join(self.root, relative)
+        if self._unchanged(relative, digest, target):
+            self._count("unchanged")
+            return False
+        if self._keep(relative, target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        atomic_write(target, data)
+        self._record(relative, {"sha256": digest, "stat": _stat(target)})
+        return True
+
+    def copy_file(self, relative: str, source: str, store=None, target: str = None) -> bool:
+        """
+        Stages source unless the same content is already in place. Sources whose size and
+        mtime did not change since the last setup are not read again.
+        Parameters
+        ----------
+        relative: str
+            path of the staged file below root
+        source: str
+            file to stage
+        store: constph.assets.AssetStore
+            places the file as a link to the shared store, None copies it
+        target: str
+            where the file is placed now, see write_text
+        Returns
+        ----------
+        written: bool
+        """
+        self._seen.add(relative)
+        source = os.path.abspath(source)
+        source_stat = _stat(source)
+        if source_stat is None:
+            raise FileNotFoundError(f"{source} can not be staged, it does not exist")
+        target = target or os.path.join(self.root, relative)
+        entry = self.files.get(relative)
+        if entry is not None and entry.get("source") == source and entry.get("source_stat") == source_stat:
+            digest = entry["sha256"]
+        else:
+            digest = file_sha256(source)
+        if self._unchanged(relative, digest, target):
+            if entry.get("source") != source or entry.get("source_stat") != source_stat:
+                with self._lock:
+                    entry.update(source=source, source_stat=source_stat)
+                    self._changed = True
+            self._count("unchanged")
+            return False
+        if self._keep(relative, target):
+            return False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if store is not None:
+            store.stage(source, target, digest)
+        else:
+            atomic_copy(source, target)
+        self._record(relative, {"sha256": digest, "stat": _stat(target), "source": source, "source_stat": source_stat})
+        return True
+
+    def prune(self):
+        """Removes the generated files that were not part of this setup, if unmodified and not started"""
+        for relative in sorted(set(self.files) - self._seen):
+            target = os.path.join(self.root, relative)
+            stat = _stat(target)
+            if stat is None:
+                del self.files[relative]
+                self._changed = True
+                continue
+            if self.files[relative]["stat"] != stat or self._run_started(relative):
+                logger.info(f"{relative} is no longer generated, but modified or in use: the file is kept")
+                continue
+            os.remove(target)
+            del self.files[relative]
+            self._changed = True
+            self.report.removed += 1
+            try:
+                # a state directory left empty goes with its last file
+                os.rmdir(os.path.dirname(target))
+            except OSError:
+                pass
+
+    def save(self) -> SetupReport:
+        """Writes the manifest if anything changed and returns the report of this setup"""
+        if self._changed:
+            os.makedirs(self.root, exist_ok=True)
+            atomic_write(
+                os.path.join(self.root, SETUP_MANIFEST),
+                json.dumps({"format": SETUP_MANIFEST_FORMAT, "files": self.files}, indent=1, sort_keys=True),
+            )
+            self._changed = False
+        logger.info(f"Setup of {self.root}: {self.report}")
+        return self.report
@@ -1,86 +1,325 @@
+import glob
 import logging
 import os
 import shutil
-from io import StringIO
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 
 import constph
 
-from constph.gromos_factory import GromosFactory
-from typing import List
+from constph.assets import DEFAULT_STAGING, AssetStore, default_asset_store
+from constph.atomic import sync_directory, sync_pending
+from constph.batch import ParameterGrid, render_batch
+from constph.gromos_factory import GromosFactory, stable_text
+from constph.setup_manifest import SetupManifest, SetupReport
+from constph.validation import validate_configurations
 
 logger = logging.getLogger(__name__)
 
+# structure files staged into every intermediate state directory
+STAGED_FILES = ("topo", "pttopo", "coord")
+# threads of a setup, filesystem latency rather than CPU bound
+DEFAULT_SETUP_WORKERS = 8
+# seconds without a change after which a build directory belongs to a setup that was killed,
+# younger ones may still be assembled by another setup of the same system
+STALE_BUILD_AGE = 3600
+
 
 class StateFactory(object):
     def __init__(
-        self, system: constph.system.SystemStructure, configuration: dict
+        self,
+        system: "constph.system.SystemStructure",
+        configuration: dict,
+        asset_store: AssetStore = None,
+        staging: str = DEFAULT_STAGING,
+        aeds_parameters: dict = None,
     ):
         """
         Generate the directories for the search and production runs for the provided systems.
+        The setup is incremental: existing directories are kept and only files whose content
+        changed are written again, see constph.setup_manifest.
         Parameters
         ----------
         system : constph.system
             definition of the two end states for a given system
         configuration : dict
             configuration dictionary
+        asset_store: AssetStore
+            store of the shared structure files, e.g. one for all systems of a campaign; by
+            default the store in the output directory of the configuration
+        staging: str
+            hardlink, symlink or copy, how the default store places the structure files
+        aeds_parameters: dict
+            EMIN, EMAX and offsets of the search run the production runs are set up with, see
+            constph.pipeline.aeds_parameters_from_search
+        Raises
+        ----------
+        ConfigValidationError
+            if the configuration is incomplete, before any directory is touched
         """
 
+        validate_configurations([configuration])
         self.system = system
+        self.configuration = configuration
         self.path = f"{configuration['system_dir']}/{self.system.name}"
+        self.asset_store = asset_store or default_asset_store(configuration, staging)
+        self.aeds_parameters = aeds_parameters
+        # production runs left out of the last setup for want of aeds_parameters
+        self.production_pending = False
         self._init_base_dir()
-        self.configuration = configuration
         self.vdw_switch: str
         self.charmm_factory = GromosFactory(configuration, self.system.structure)
-    
+
     def _get_simulations_parameters(self):
         prms = {}
         for key in self.configuration["simulation"]["parameters"]:
             prms[key] = self.configuration["simulation"]["parameters"][key]
         return prms
-    
-    
-    def _copy_files(self, intermediate_state_file_path: str):
+
+    def _copy_files(self, intermediate_state_file_path: str, build_path: str = None):
         """
-        Copy the files from the original CHARMM-GUI output folder in the intermediate directories.
+        Stage the topology, perturbation topology and coordinates of the system in the
+        intermediate directory as links to the asset store; unchanged files are not staged again.
+        build_path is where the directory is assembled if it is renamed into place afterwards.
         """
 
-        basedir = self.system.charmm_gui_base
+        structure = self.configuration["system"]["structure"]
+        relative_dir = os.path.relpath(intermediate_state_file_path, self.path)
+        for key in STAGED_FILES:
+            source = os.path.join(self.configuration["data_dir_base"], structure[key])
+            name = os.path.basename(source)
+            self.manifest.copy_file(
+                os.path.join(relative_dir, name),
+                source,
+                self.asset_store,
+                os.path.join(build_path, name) if build_path else None,
+            )
+
+    def _init_base_dir(self):
+        """
+        Generates the base directory which all intermediate states are located, keeping what
+        an earlier setup left in it.
+        """
 
-        self._copy_ligand_specific_top_and_par(basedir, intermediate_state_file_path)
+        os.makedirs(self.path, exist_ok=True)
+        self.manifest = SetupManifest(self.path)
 
-        # copy central toppar folder
-        toppar_dir = get_toppar_dir()
-        toppar_source = f"{toppar_dir}"
-        toppar_target = f"{intermediate_state_file_path}/toppar"
-        shutil.copytree(toppar_source, toppar_target)
+    def _init_intermediate_state_dir(self, nr: int):
+        """
+        Generates the intermediate state directory. A new directory is assembled under a
+        temporary name next to it.
+        Returns
+        ----------
+        output_file_base, build_path: tuple
+            the directory and where it is assembled, None for an existing directory
+        """
+        output_file_base = f"{self.path}/intst{nr}"
+        if os.path.isdir(output_file_base):
+            return output_file_base, None
+        build_path = f"{output_file_base}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(build_path)
+        return output_file_base, build_path
 
-        # copy crd file
-        self._copy_crd_file((intermediate_state_file_path))
+    def _remove_stale_builds(self):
+        """Removes the state directories a killed setup left half-assembled"""
+        for build_path in glob.glob(f"{glob.escape(self.path)}/intst*.tmp"):
+            try:
+                with os.scandir(build_path) as entries:
+                    changed = max([os.stat(build_path).st_mtime] + [entry.stat().st_mtime for entry in entries])
+            except FileNotFoundError:
+                continue
+            if time.time() - changed < STALE_BUILD_AGE:
+                continue
+            logger.info(f"Removing {build_path}, left behind by an interrupted setup")
+            shutil.rmtree(build_path, ignore_errors=True)
 
-        # copy openMM and charmm specific scripts
-        self._copy_omm_files(intermediate_state_file_path)
-        self._copy_charmm_files(intermediate_state_file_path)   
-   
-   
-    def _init_base_dir(self):
+    def write_intermediate_state(self, nr: int, files: dict) -> str:
         """
-        Generates the base directory which all intermediate states are located.
+        Writes the inputs of one intermediate state and stages the structure files next to them.
+        A new state directory only appears, by rename, once all of its files are in place; an
+        existing one is updated file by file.
+        Parameters
+        ----------
+        nr: int
+            number of the state, the directory is intst{nr}
+        files: dict
+            file name -> content of the generated inputs
+        Returns
+        ----------
+        output_file_base: str
+            directory of the state
         """
+        with self.manifest.timed("directories"):
+            output_file_base, build_path = self._init_intermediate_state_dir(nr)
+        try:
+            with self.manifest.timed("write"):
+                for file_name, content in files.items():
+                    target = os.path.join(build_path, file_name) if build_path else None
+                    self.manifest.write_text(f"intst{nr}/{file_name}", content, target, stable_text(content))
+            with self.manifest.timed("stage"):
+                self._copy_files(output_file_base, build_path)
+            if build_path:
+                with self.manifest.timed("directories"):
+                    os.rename(build_path, output_file_base)
+                    sync_directory(output_file_base)
+                    sync_directory(self.path)
+        except BaseException:
+            if build_path:
+                shutil.rmtree(build_path, ignore_errors=True)
+            raise
+        logger.debug(f" - Wrote {output_file_base}")
+        return output_file_base
 
-        if os.path.isdir(self.path):
-            shutil.rmtree(self.path)
-            os.makedirs(self.path)
-        else:
-            os.makedirs(self.path)
+    def _state_numbers(self, file_names: list) -> list:
+        """
+        The intst number of the production input of every variant: the directory the manifest,
+        or failing that the disk, already has its input in, otherwise the first number not in
+        use. A directory belongs to its variant for good, so inserting a pH value never moves
+        an input into the directory of another run.
+        """
+        known = {}
+        for relative in sorted(self.manifest.files):
+            directory, name = os.path.split(relative)
+            known.setdefault(name, directory)
+        if any(file_name not in known for file_name in file_names):
+            # inputs of a setup whose manifest is lost
+            for directory in sorted(glob.glob(f"{glob.escape(self.path)}/intst*/")):
+                directory = os.path.basename(os.path.dirname(directory))
+                if directory[len("intst"):].isdigit():
+                    for name in os.listdir(os.path.join(self.path, directory)):
+                        known.setdefault(name, directory)
+        used = set(known.values())
+        numbers, nr = [], 0
+        for file_name in file_names:
+            if file_name in known:
+                numbers.append(int(known[file_name][len("intst"):]))
+                continue
+            nr += 1
+            while f"intst{nr}" in used or os.path.exists(f"{self.path}/intst{nr}"):
+                nr += 1
+            used.add(f"intst{nr}")
+            numbers.append(nr)
+        return numbers
 
-    def _init_intermediate_state_dir(self, nr: int):
+    def _intermediate_states(self, grid: ParameterGrid = None) -> list:
+        """
+        The search run in intst0 and one production run per variant of grid: (nr, files).
+        The production runs are left out, with a warning, until the A-EDS parameters of the
+        search run are known.
         """
-        Generates the intermediate state directory.
+        self.production_pending = grid is not None and self.aeds_parameters is None
+        with self.manifest.timed("render"):
+            states = [(0, {"search.imd": self.charmm_factory.generate_Gromos_search_input("search")})]
+            if self.production_pending:
+                logger.warning(
+                    f"{self.system.name}: no A-EDS parameters of the search run yet, setting up the search run only"
+                )
+            elif grid is not None:
+                rendered = [
+                    (file_name, text)
+                    for _, file_name, text in render_batch(
+                        self.charmm_factory, "production", grid, aeds_parameters=self.aeds_parameters
+                    )
+                ]
+                for nr, (file_name, text) in zip(self._state_numbers([name for name, _ in rendered]), rendered):
+                    states.append((nr, {file_name: text}))
+        return states
+
+    def setup(
+        self,
+        grid: ParameterGrid = None,
+        prune: bool = True,
+        n_workers: int = DEFAULT_SETUP_WORKERS,
+        aeds_parameters: dict = None,
+    ) -> SetupReport:
         """
-        output_file_base = f"{self.path}/intst{nr}/"
+        Sets up the search run in intst0 and one production run per variant of grid in
+        intst1, intst2, ...; only changed files are written, see setup_systems. A variant keeps
+        its directory across setups, new variants get the next free number. The production runs
+        need the A-EDS parameters of the search run and are only set up once they are given.
+        Parameters
+        ----------
+        grid: ParameterGrid
+            production variants (pH values, seeds, offsets), None sets up the search run only
+        aeds_parameters: dict
+            EMIN, EMAX and offsets of the search run, replaces the ones given to the constructor
+        prune: bool
+            remove generated files that are no longer part of the setup
+        n_workers: int
+            threads writing the state directories
+        Returns
+        ----------
+        report: SetupReport
+            files written, unchanged, kept because their run started, and removed; timings
+        """
+        if aeds_parameters is not None:
+            self.aeds_parameters = aeds_parameters
+        return setup_systems([self], grid, prune, n_workers)[0]
+
+
+def setup_systems(
+    factories: list, grid: ParameterGrid = None, prune: bool = True, n_workers: int = DEFAULT_SETUP_WORKERS
+) -> list:
+    """
+    Sets up the intermediate states of many systems with one bounded thread pool.
+    The inputs are rendered in order in the calling thread; creating the directories, writing
+    the files and staging the structure files of all states of all systems fan out over the
+    pool. The files, the manifests and the counts of the reports do not depend on n_workers.
+    Parameters
+    ----------
+    factories: list
+        StateFactory per system
+    grid: ParameterGrid
+        production variants, see StateFactory.setup
+    prune: bool
+        remove generated files that are no longer part of the setup; not done for systems whose
+        production runs wait for the A-EDS parameters of their search run
+    n_workers: int
+        threads, 1 sets up everything in the calling thread
+    Returns
+    ----------
+    reports: list
+        SetupReport per system, with the wall-clock time of the whole setup
+    """
+    start = time.perf_counter()
+    tasks = []
+    for factory in factories:
+        factory._remove_stale_builds()
+        factory.manifest = SetupManifest(factory.path)
+        tasks.extend((factory, nr, files) for nr, files in factory._intermediate_states(grid))
+
+    def run(task):
+        factory, nr, files = task
+        return factory.write_intermediate_state(nr, files)
+
+    if n_workers <= 1:
+        for task in tasks:
+            run(task)
+    else:
+        with ThreadPoolExecutor(n_workers) as pool:
+            # list() waits for every task and raises the first error in task order
+            list(pool.map(run, tasks))
 
-        logger.info(f" - Created directory: - {os.path.abspath(output_file_base)}")
-        os.makedirs(output_file_base)
-        logger.info(f" - Writing in - {os.path.abspath(output_file_base)}")
-        return output_file_base
\ No newline at end of file
+    reports = []
+    for factory in factories:
+        with factory.manifest.timed("prune"):
+            if prune and not factory.production_pending:
+                factory.manifest.prune()
+        with factory.manifest.timed("manifest"):
+            report = factory.manifest.save()
+        reports.append(report)
+    if factories:
+        # one batched fsync of everything the setup wrote, see constph.atomic
+        with factories[0].manifest.timed("sync"):
+            sync_pending()
+    wall_time = time.perf_counter() - start
+    for report in reports:
+        report.wall_time = wall_time
+    if factories:
+        logger.info(
+            f"Set up {len(tasks)} states of {len(factories)} systems in {wall_time:.2f} s on {n_workers} threads; "
+            f"asset store {factories[0].asset_store.root}: {factories[0].asset_store.report}"
+        )
+    return reports
@@ -1,17 +1,108 @@
+"""
+The structure files of a system, loaded on first use.
+
+SystemStructure only resolves the paths of the topology, the perturbation topology and the
+coordinates when it is created. Each file is parsed when it is first accessed and memoized on
+the instance, and so is everything derived from it (box, end states, perturbed atoms). Parsed
+files are also kept in a process-wide cache keyed by the identity of the file (device, inode,
+size and mtime): systems sharing a topology parse it once, and a file that changed on disk is
+parsed again. Parsed files are shared between systems, treat them as read-only and use
+ImdFile.copy or ImdFile.patched for variants.
+"""
 import logging
 import os
-from collections import namedtuple
+import threading
+from functools import cached_property
 
-from typing import Tuple
-from collections import defaultdict
-import re
+from constph.imd import ImdFile
 
 logger = logging.getLogger(__name__)
 
+# parsed block files: file identity -> _CacheEntry
+_file_cache = {}
+# path -> identity of its cached version, older versions are dropped
+_latest = {}
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+# reads of a file that is replaced while it is read
+MAX_READ_ATTEMPTS = 3
+
+
+class _CacheEntry(object):
+    __slots__ = ("lock", "value")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+
+
+def file_identity(path: str) -> tuple:
+    """Real path, device, inode, size and mtime of a file"""
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return path, stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def load_block_file(path: str) -> ImdFile:
+    """
+    A GROMOS block file (topology, perturbation topology, coordinates) parsed once per
+    process and file identity. Threads asking for the same file wait for one parse. A file
+    replaced while it is read is read again, so a parse is never cached under the identity
+    of another version of the file.
+    """
+    for _ in range(MAX_READ_ATTEMPTS):
+        key = file_identity(path)
+        with _cache_lock:
+            entry = _file_cache.get(key)
+            if entry is None:
+                entry = _file_cache[key] = _CacheEntry()
+                previous = _latest.get(key[0])
+                if previous is not None:
+                    _file_cache.pop(previous, None)
+                _latest[key[0]] = key
+        with entry.lock:
+            hit = entry.value is not None
+            if not hit:
+                logger.debug(f"Parsing {key[0]}")
+                value = ImdFile.read(key[0])
+                if file_identity(path) != key:
+                    _discard(key, entry)
+                    continue
+                entry.value = value
+        with _cache_lock:
+            _cache_stats["hits" if hit else "misses"] += 1
+        return entry.value
+    logger.warning(f"{path} kept changing while it was read, using the last read without caching it")
+    return value
+
+
+def _discard(key: tuple, entry: _CacheEntry):
+    """Drops the entry of a file version that changed while it was read"""
+    with _cache_lock:
+        if _file_cache.get(key) is entry:
+            del _file_cache[key]
+        if _latest.get(key[0]) == key:
+            del _latest[key[0]]
+
+
+def cache_info() -> dict:
+    """Hits, misses (parses) and entries of the process-wide file cache"""
+    with _cache_lock:
+        return dict(_cache_stats, entries=len(_file_cache))
+
+
+def clear_cache():
+    with _cache_lock:
+        _file_cache.clear()
+        _latest.clear()
+        _cache_stats.update(hits=0, misses=0)
+
+
 class SystemStructure(object):
     def __init__(self, configuration: dict):
         """
-        A class that contains all informations for the system.
+        A class that contains all informations for the system. Nothing is read from disk
+        until a structure property is accessed.
         Parameters
         ----------
         configuration: dict
@@ -20,191 +111,50 @@ class SystemStructure(object):
 
         self.name: str = configuration["system"]["structure"]["name"]
         self.work_dir_base: str = configuration["config"]["paths"]["work_dir"]
-        self.offset: defaultdict = defaultdict(int)
-        self.parameter = self._read_parameters("waterbox")
-        self.cgenff_version: float
-        self.envs: set
-        # running a binding-free energy calculation?
-        if configuration["simulation"]["free-energy-type"] == "binding-free-energy":
-            self.envs = set(["complex", "waterbox"])
-            for env in self.envs:
-                parameter = self._read_parameters(env)
-                # set up system
-                self.psfs[env] = self._initialize_system(configuration, env)
-                # load parameters
-                self.psfs[env].load_parameters(parameter)
-                # get offset
-                self.offset[
-                    env
-                ] = self._determine_offset_and_set_possible_dummy_properties(
-                    self.psfs[env]
-                )
-
-            # generate rdkit mol object of small molecule
-            self.mol: Chem.Mol = self._generate_rdkit_mol(
-                "complex", self.psfs["complex"][f":{self.tlc}"]
-            )
-            self.graph: nx.Graph = self._mol_to_nx(self.mol)
-
-        elif configuration["simulation"]["free-energy-type"] == "solvation-free-energy":
-            self.envs = set(["waterbox", "vacuum"])
-            for env in self.envs:
-                parameter = self._read_parameters(env)
-                # set up system
-                self.psfs[env] = self._initialize_system(configuration, env)
-                # load parameters
-                self.psfs[env].load_parameters(parameter)
-                # get offset
-                self.offset[
-                    env
-                ] = self._determine_offset_and_set_possible_dummy_properties(
-                    self.psfs[env]
-                )
-
-            # generate rdkit mol object of small molecule
-            self.mol: Chem.Mol = self._generate_rdkit_mol(
-                "waterbox", self.psfs["waterbox"][f":{self.tlc}"]
-            )
-            self.graph: nx.Graph = self._mol_to_nx(self.mol)
-        else:
-            raise NotImplementedError(
-                "only binding and solvation free energy implemented."
-            )
-
-    def _read_parameters(self, env: str) 
-        """
-        Reads in topparameters from a toppar dir and ligand specific parameters.
-        Parameters
-        ----------
-        env: str
-            waterbox,complex or vacuum
-        Returns
-        ----------
-        parameter : pm.charmm.CharmmParameterSet
-            parameters obtained from the CHARMM-GUI output dir.
-        """
-
-        # the parameters for the vacuum system is parsed from the waterbox charmm-gui directory
-        if env == "vacuum":
-            env = "waterbox"
-
-        charmm_gui_env = self.charmm_gui_base + env
-        tlc = self.tlc
-        tlc_lower = str(tlc).lower()
-
-
-        # if custom parameter are added they are located in l1,l2
-        parameter_files = tuple()
-        l1 = f"{charmm_gui_env}/{tlc_lower}/{tlc_lower}.rtf"
-        l2 = f"{charmm_gui_env}/{tlc_lower}/{tlc_lower}.prm"
-
-        for file_path in [l1, l2]:
-            if os.path.isfile(file_path):
-                parameter_files += (file_path,)
-            else:
-                logger.critical(
-                    f"Custom ligand parameters are not present in {file_path}"
-                )
-
-        # check cgenff versions
-        if parameter_files:
-            with open(parameter_files[0]) as f:
-                _ = f.readline()
-                cgenff = f.readline().rstrip()
-                logger.info(f"CGenFF version: {cgenff}")
-                cgenff_version = re.findall("\d+\.\d+", cgenff)[0]
-                self.cgenff_version = float(cgenff_version)
-
-        parameter_files += (f"{toppar_dir}/top_all36_prot.rtf",)
-        parameter_files += (f"{toppar_dir}/par_all36m_prot.prm",)
-        parameter_files += (f"{toppar_dir}/par_all36_na.prm",)
-        parameter_files += (f"{toppar_dir}/top_all36_na.rtf",)
-        parameter_files += (f"{toppar_dir}/top_all36_cgenff.rtf",)
-        parameter_files += (f"{toppar_dir}/par_all36_cgenff.prm",)
-        parameter_files += (f"{toppar_dir}/par_all36_lipid.prm",)
-        parameter_files += (f"{toppar_dir}/top_all36_lipid.rtf",)
-        parameter_files += (f"{toppar_dir}/toppar_water_ions.str",)
-
-        # set up parameter objec
-        parameter = "ah"#pm.charmm.CharmmParameterSet(*parameter_files)
-        return parameter
-
-    def _initialize_system(self, configuration: dict, env: str) 
-        """
-        Generates the psf file and sets the coordinates from the CHARMM-GUI files.
-        Parameters
-        ----------
-        configuration: dict
-            the configuration dictionary obtained with utils.load_config_yaml
-        env: str
-            waterbox,complex or vacuum
-        Returns
-        ----------
-        psf : pm.charmm.CharmmPsfFile
-        """
-
-        if env == "vacuum":
-            # take the structures from the waterbox system and extract only the ligand
-            taken_from = "waterbox"
-            psf_file_name = configuration["system"][self.structure][taken_from][
-                "psf_file_name"
-            ]
-            crd_file_name = configuration["system"][self.structure][taken_from][
-                "crd_file_name"
-            ]
-
-            psf_file_path = (
-                f"{self.charmm_gui_base}/{taken_from}/openmm/{psf_file_name}.psf"
-            )
-            crd_file_path = (
-                f"{self.charmm_gui_base}/{taken_from}/openmm/{crd_file_name}.crd"
-            )
-            psf = pm.charmm.CharmmPsfFile(psf_file_path)
-            coord = pm.charmm.CharmmCrdFile(crd_file_path)
-            psf.coordinates = coord.coordinates
-            # extract only ligand to generate vacuum system
-            psf = psf[f":{self.tlc}"]
-        else:
-            psf_file_name = configuration["system"][self.structure][env][
-                "psf_file_name"
-            ]
-            crd_file_name = configuration["system"][self.structure][env][
-                "crd_file_name"
-            ]
-
-            psf_file_path = f"{self.charmm_gui_base}/{env}/openmm/{psf_file_name}.psf"
-            crd_file_path = f"{self.charmm_gui_base}/{env}/openmm/{crd_file_name}.crd"
-            psf = pm.charmm.CharmmPsfFile(psf_file_path)
-            coord = pm.charmm.CharmmCrdFile(crd_file_path)
-            psf.coordinates = coord.coordinates
-
-        return psf
-
-    def _determine_offset_and_set_possible_dummy_properties(self, psf: pm.charmm.CharmmPsfFile) -> int:
-        """
-        Determines the offset and sets possible properties on the psf.
-        Parameters
-        ----------
-        psf : pm.charmm.CharmmPsfFile
-        env: str
-            waterbox,complex or vacuum
-        Returns
-        ----------
-        """
-        assert type(psf) == pm.charmm.CharmmPsfFile
-        if len(psf.view[f":{self.tlc}"].atoms) < 1:
-            raise RuntimeError(f"No ligand selected for tlc: {self.tlc}")
-
-        psf.number_of_dummys = 0
-        psf.mutations_to_default = 0
-
-        idx_list = []
-        for atom in psf.view[f":{self.tlc}"].atoms:
-            idx_list.append(int(atom.idx))
-
-            # charge, epsilon and rmin are directly modiefied
-            atom.initial_charge = atom.charge
-            atom.initial_epsilon = atom.epsilon
-            atom.initial_rmin = atom.rmin
-
-        return min(idx_list)
\ No newline at end of file
+        self.structure: dict = configuration["system"]["structure"]
+        self.data_dir_base: str = configuration["data_dir_base"]
+
+    def path(self, key: str) -> str:
+        """Absolute path of a structure file: topo, pttopo or coord"""
+        return os.path.abspath(os.path.join(self.data_dir_base, self.structure[key]))
+
+    @cached_property
+    def topology(self) -> ImdFile:
+        """The molecular topology, with the force-field parameters of the system"""
+        return load_block_file(self.path("topo"))
+
+    @cached_property
+    def perturbation_topology(self) -> ImdFile:
+        """The EDS perturbation topology: the end states of the titratable sites"""
+        return load_block_file(self.path("pttopo"))
+
+    @cached_property
+    def coordinates(self) -> ImdFile:
+        return load_block_file(self.path("coord"))
+
+    @cached_property
+    def box(self) -> tuple:
+        """Box edge lengths (nm) of the GENBOX block of the coordinates"""
+        return tuple(float(length) for length in self.coordinates["GENBOX"].row(1))
+
+    @cached_property
+    def solute_atoms(self) -> int:
+        """Number of solute atoms, first value of SOLUTEATOM"""
+        return int(self.topology["SOLUTEATOM"].row(0)[0])
+
+    @cached_property
+    def state_names(self) -> list:
+        """Names of the end states of the MPERTATOM block"""
+        return self.perturbation_topology["MPERTATOM"].row(1)
+
+    @cached_property
+    def nstates(self) -> int:
+        return int(self.perturbation_topology["MPERTATOM"].row(0)[1])
+
+    @cached_property
+    def perturbed_atoms(self) -> list:
+        """Numbers of the atoms whose parameters differ between the end states"""
+        block = self.perturbation_topology["MPERTATOM"]
+        rows = block.data_rows
+        n_atoms = int(block.lines[rows[0]].split()[0])
+        return [int(block.lines[row].split()[0]) for row in rows[2:2 + n_atoms]]
@@ -0,0 +1,183 @@
+"""
+Incremental reading of the outputs of running simulations.
+
+A FileTail remembers the byte offset up to which a file has been consumed and only reads what
+was appended since, in whole lines; a partially written last line stays in the file until it is
+complete. TreTail feeds those lines to the energy-trajectory parser of constph.tre, whose state
+carries a partially written frame over to the next poll, and collects the frames in growing
+arrays. A TailMonitor polls many files from one process: unchanged files cost one stat call,
+and no file is kept open between polls.
+
+Files that shrink or are replaced (a segment restarted from scratch) are read again from the
+beginning. Gzipped files can not be tailed.
+"""
+import logging
+import os
+
+from constph.tre import (
+    DEFAULT_CHUNK_FRAMES,
+    DEFAULT_PROPERTIES,
+    EnergyTrajectory,
+    _FrameBuffer,
+    _FrameParser,
+    _iter_arrays,
+)
+
+logger = logging.getLogger(__name__)
+
+# bytes read per call, larger appends are consumed over several polls
+MAX_READ_BYTES = 1 << 26
+
+
+class FileTail(object):
+    def __init__(self, path: str, max_read_bytes: int = MAX_READ_BYTES):
+        """
+        Hands out the complete lines appended to a file since the last read.
+        Parameters
+        ----------
+        path: str
+            the file, it does not have to exist yet
+        max_read_bytes: int
+            most bytes consumed per read
+        """
+
+        self.path = path
+        self.max_read_bytes = max_read_bytes
+        self.offset = 0
+        # (inode, size, mtime) at the last read
+        self._stat = None
+        # set by read_lines when the file was read from the beginning again
+        self.restarted = False
+
+    def changed(self) -> bool:
+        """True if the file has grown or been replaced since the last read"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns) != self._stat
+
+    def read_lines(self) -> list:
+        """The complete lines (without line breaks) appended since the last call"""
+        self.restarted = False
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            stat = os.fstat(f.fileno())
+            if self._stat is not None and (stat.st_ino != self._stat[0] or stat.st_size < self.offset):
+                logger.info(f"{self.path} was replaced, reading it from the start")
+                self.offset = 0
+                self.restarted = True
+            f.seek(self.offset)
+            data = f.read(self.max_read_bytes)
+        end = data.rfind(b"\n") + 1
+        self.offset += end
+        # a read that hit the limit leaves the file marked as changed, the rest follows next call
+        self._stat = (stat.st_ino, stat.st_size, stat.st_mtime_ns) if len(data) < self.max_read_bytes else None
+        if not end:
+            return []
+        return data[:end].decode(errors="replace").splitlines()
+
+
+class TreTail(object):
+    def __init__(self, path: str, properties=DEFAULT_PROPERTIES, keep: bool = True):
+        """
+        Incremental reader of an energy trajectory that is still being written.
+        Parameters
+        ----------
+        path: str
+            *.tre file (not gzipped)
+        properties: tuple
+            names of the totals values to keep, see constph.tre.TOTALS
+        keep: bool
+            collect all frames read so far in trajectory, otherwise poll only returns the new ones
+        """
+
+        self.file = FileTail(path)
+        self.properties = tuple(properties)
+        self.keep = keep
+        self._reset()
+
+    def _reset(self):
+        self.parser = _FrameParser(self.properties)
+        self.frames = _FrameBuffer(self.properties)
+
+    @property
+    def path(self) -> str:
+        return self.file.path
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def changed(self) -> bool:
+        return self.file.changed()
+
+    def poll(self) -> EnergyTrajectory:
+        """The frames completed since the last poll, possibly none"""
+        lines = self.file.read_lines()
+        if self.file.restarted:
+            self._reset()
+        new = _FrameBuffer(self.properties)
+        for arrays in _iter_arrays(lines, self.parser, DEFAULT_CHUNK_FRAMES):
+            new.append(*arrays)
+            if self.keep:
+                self.frames.append(*arrays)
+        return new.trajectory(copy=False)
+
+    @property
+    def trajectory(self) -> EnergyTrajectory:
+        """All frames read so far (views, valid until the next poll)"""
+        return self.frames.trajectory(copy=False)
+
+
+class TailMonitor(object):
+    def __init__(self, properties=DEFAULT_PROPERTIES, keep: bool = True):
+        """
+        Follows the energy trajectories of many running simulations.
+        Parameters
+        ----------
+        properties: tuple
+            names of the totals values to keep, see constph.tre.TOTALS
+        keep: bool
+            collect all frames of every run, see TreTail
+        """
+
+        self.properties = tuple(properties)
+        self.keep = keep
+        self.tails = {}
+
+    def __len__(self) -> int:
+        return len(self.tails)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.tails
+
+    def __getitem__(self, path: str) -> TreTail:
+        return self.tails[path]
+
+    def add(self, path: str) -> TreTail:
+        if path not in self.tails:
+            self.tails[path] = TreTail(path, self.properties, self.keep)
+        return self.tails[path]
+
+    def remove(self, path: str):
+        self.tails.pop(path, None)
+
+    def poll(self) -> dict:
+        """
+        Reads what was appended to the followed files.
+        Returns
+        ----------
+        updates: dict
+            path -> EnergyTrajectory of the new frames, for the files with new frames only
+        """
+        updates = {}
+        for path, tail in self.tails.items():
+            if not tail.changed():
+                continue
+            new = tail.poll()
+            if len(new):
+                updates[path] = new
+        return updates
@@ -3,19 +3,26 @@ Unit and regression test for constant_pH.
 """
 
 import copy
+import datetime
+import json
 import logging
 import os
 import pathlib
+import pickle
 import shutil
 import subprocess
 import sys
+import time
+import types
 
 import constph
 import pytest
 
 from constph import (
+    load_campaign,
     load_config_yaml)
 
+
 def test_read_yaml():
     """Sample test, will check ability to read yaml files"""
     settingsMap = load_config_yaml(
@@ -27,3 +34,1044 @@ def test_read_yaml():
     assert settingsMap["system"]["structure"]["name"] == '2OJ9-test1'
     settingsMap['bin_dir'] == 'constph/bin'
     
+
+def test_read_yaml_cached(tmp_path, monkeypatch):
+    """The resolved settings map is cached on disk and handed out as independent copies"""
+    from constph import utils
+
+    utils._settings_cache.clear()
+    kwargs = dict(config="constph/test_suite/test_data/example.yaml", input_dir=".",
+                  output_dir='data/', cache_dir=str(tmp_path))
+    settingsMap = load_config_yaml(**kwargs)
+    assert len(list((tmp_path / 'config').glob('*.json'))) == 1
+    settingsMap["system"]["name"] = 'changed'
+
+    # a new process only has the on-disk cache, the yaml must not be parsed again
+    utils._settings_cache.clear()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached config was parsed again")
+    monkeypatch.setattr(utils.yaml, 'load', fail)
+    cached = load_config_yaml(**kwargs)
+    assert cached["system"]["name"] == '2OJ9-test1'
+    assert cached['system_dir'] == os.path.abspath('data/') + '/2OJ9-test1'
+    assert load_config_yaml(**kwargs) is not cached
+
+    # the cache holds data only: a planted pickle is not loaded, a damaged entry is parsed again
+    monkeypatch.undo()
+    entry = next((tmp_path / 'config').glob('*.json'))
+    entry.write_bytes(pickle.dumps({"system": "planted"}))
+    utils._settings_cache.clear()
+    assert load_config_yaml(**kwargs)["system"]["name"] == '2OJ9-test1'
+    assert json.loads(entry.read_text())["system"]["name"] == '2OJ9-test1'
+
+
+def test_load_campaign():
+    """A campaign file shares its defaults and materializes every system on its own"""
+    campaign = load_campaign(
+        config="constph/test_suite/test_data/example_campaign.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+
+    assert campaign.names == ['propionic_acid', 'acetic_acid']
+    settingsMap = campaign['acetic_acid']
+    assert settingsMap["search_run"]["search_parameters"]["NSTLIM"] == 500000
+    assert settingsMap["search_run"]["search_parameters"]["NTWX"] == 1000
+    assert settingsMap["system_dir"] == os.path.abspath('data/') + '/acetic_acid'
+    assert campaign['propionic_acid']["search_run"]["search_parameters"]["NSTLIM"] == 1000000
+    assert campaign.filter('acet*').names == ['acetic_acid']
+
+
+def test_load_campaign_fragments(tmp_path):
+    """Fragments of a campaign directory are only parsed when their system is requested"""
+    shutil.copy("constph/test_suite/test_data/example.yaml", tmp_path / "2OJ9-test1.yaml")
+    (tmp_path / "broken.yaml").write_text("system: [")
+    (tmp_path / "defaults.yaml").write_text("search_run:\n  search_parameters:\n    NTWG: 10\n    NSTLIM: 10\n")
+
+    campaign = load_campaign(config=str(tmp_path), input_dir=".", output_dir='data/', use_cache=False)
+    assert sorted(campaign) == ['2OJ9-test1', 'broken']
+    settingsMap = campaign['2OJ9-test1']
+    assert settingsMap["search_run"]["search_parameters"]["NTWG"] == 10
+    assert settingsMap["search_run"]["search_parameters"]["NSTLIM"] == 1000000
+    assert settingsMap["system"]["name"] == '2OJ9-test1'
+
+
+def test_typed_config(tmp_path):
+    """The generated slotted dataclasses match what dacite builds and are generated once per schema"""
+    from dacite import from_dict
+    from constph.typed_config import (ROOT_CLASS, build_typed_config, default_schema,
+                                      load_typed_config_module, schema_version)
+
+    schema = default_schema()
+    module = load_typed_config_module(schema)
+    assert module.SCHEMA_VERSION == schema_version(schema)
+    assert load_typed_config_module(schema) is module
+
+    settingsMap = load_config_yaml(config="constph/bin/dataclass_structure.yaml", input_dir=".", output_dir='data/')
+    config = build_typed_config(settingsMap, module)
+    assert config == from_dict(data_class=getattr(module, ROOT_CLASS), data=settingsMap)
+    assert config.search_run.search_parameters.NSTLIM == settingsMap["search_run"]["search_parameters"]["NSTLIM"]
+    assert not hasattr(config.system.structure, '__dict__')
+
+    # a changed schema gets its own module in the cache directory
+    schema[ROOT_CLASS]["search_run"]["search_parameters"]["NRE"] = 2
+    changed = load_typed_config_module(schema, cache_dir=str(tmp_path))
+    assert changed is not module
+    assert (tmp_path / "typed_config" / f"typed_config_{changed.SCHEMA_VERSION}.py").is_file()
+    assert 'NRE' in changed.search_parameters.__slots__
+
+
+def test_validate_configurations():
+    """All problems of a campaign are reported in one go, before anything is generated"""
+    from constph.validation import ConfigValidationError, validate_configurations
+
+    campaign = load_campaign(
+        config="constph/test_suite/test_data/example_campaign.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+    campaign.validate()
+
+    settingsMap = copy.deepcopy(campaign['acetic_acid'])
+    search = settingsMap["search_run"]["search_parameters"]
+    search["dt"] = -0.002
+    search["NTWX"] = 300
+    search["NSTATES"] = "2"
+    del settingsMap["production_run"]["production_parameters"]["NSM"]
+    with pytest.raises(ConfigValidationError) as excinfo:
+        validate_configurations([campaign['propionic_acid'], settingsMap])
+
+    assert sorted(excinfo.value.errors) == [
+        "acetic_acid: production_run.production_parameters.NSM is missing",
+        "acetic_acid: search_run.search_parameters.NSTATES must be Integral, got '2'",
+        "acetic_acid: search_run.search_parameters.NSTLIM must be divisible by NTWX",
+        "acetic_acid: search_run.search_parameters.dt must be > 0",
+    ]
+
+
+def test_import_time():
+    """Importing constph stays cheap: no heavy dependencies, no git calls, no logging setup"""
+    code = (
+        "import json, sys\n"
+        "import constph\n"
+        "heavy = [m for m in ('yaml', 'dacite', 'numpy', 'subprocess', 'constph.utils') if m in sys.modules]\n"
+        "handlers = len(sys.modules['logging'].root.handlers) if 'logging' in sys.modules else 0\n"
+        "print(json.dumps([heavy, handlers]))\n"
+    )
+    env = dict(os.environ, PYTHONPATH=str(pathlib.Path(constph.__file__).parents[1]))
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    assert json.loads(output.stdout) == [[], 0]
+
+
+def test_version_cache_key(tmp_path):
+    """The version cache key follows commits and tags and is withheld while the working tree has edits"""
+    from constph._version_cache import _git_state
+
+    def git(*args):
+        subprocess.run(["git", "-C", str(tmp_path), *args], check=True, capture_output=True)
+
+    git("init", "-q")
+    git("config", "user.email", "test@example.com")
+    git("config", "user.name", "test")
+    (tmp_path / "module.py").write_text("x = 1\n")
+    git("add", "module.py")
+    git("commit", "-q", "-m", "initial")
+    # files written in the same second as the index count as modified
+    old = time.time() - 10
+    os.utime(tmp_path / "module.py", (old, old))
+    git("update-index", "--really-refresh")
+    committed = _git_state(str(tmp_path))
+    assert committed is not None and committed == _git_state(str(tmp_path))
+
+    git("tag", "v1.2")
+    tagged = _git_state(str(tmp_path))
+    assert tagged not in (None, committed)
+
+    (tmp_path / "module.py").write_text("x = 2\n")
+    assert _git_state(str(tmp_path)) is None
+
+
+def test_gromos_template_rendering():
+    """The compiled IMD templates render the reference bodies and only re-render changed blocks"""
+    from constph.gromos_factory import GromosFactory, SEARCH_TEMPLATE
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+    with open("constph/test_suite/test_data/search_body.imd") as f:
+        assert factory._get_Gromos_search_body() == f.read()
+    with open("constph/test_suite/test_data/production_body.imd") as f:
+        assert factory._get_Gromos_production_body() == f.read()
+    assert factory.generate_Gromos_search_input("search").startswith("TITLE\n")
+
+    assert {'BOUNDCOND', 'COVALENTFORM', 'CONSTRAINT'} <= set(SEARCH_TEMPLATE.static_blocks)
+    fields = factory._get_search_fields()
+    step = next(block for block in SEARCH_TEMPLATE.blocks if block.name == 'STEP')
+    system = next(block for block in SEARCH_TEMPLATE.blocks if block.name == 'SYSTEM')
+    unchanged = system.render(fields)
+    fields["NSTLIM"] = 20000
+    body = SEARCH_TEMPLATE.render(fields)
+    assert "   20000        0      0.002\n" in body
+    assert system.render(fields) is unchanged
+    assert step.render(fields) is step.render(dict(fields))
+
+
+def test_imd_model(tmp_path):
+    """IMD files round-trip through the block model and patched variants share untouched blocks"""
+    from constph.imd import ImdFile, read_imd
+
+    with open("constph/test_suite/test_data/search_body.imd") as f:
+        text = f.read()
+    imd = ImdFile.parse(text)
+    assert imd.to_string() == text + "\n"
+    assert list(imd.blocks)[:3] == ['SYSTEM', 'STEP', 'BOUNDCOND']
+    assert imd.get('STEP', 'NSTLIM') == '1000000'
+    assert imd['AEDS']['NUMSTATES'] == '2'
+    assert imd['PAIRLIST']['RCUTL'] == '1.4'
+
+    variant = imd.patched({('STEP', 'NSTLIM'): 5000, ('INITIALISE', 'IG'): 4711})
+    variant.set_row('AEDS', 3, [0, -12.5])
+    assert variant['STEP'].lines[1] == '      5000        0      0.002'
+    assert variant['INITIALISE']['IG'] == '4711'
+    assert variant['AEDS'].row(3) == ['0', '-12.5']
+    assert imd.get('STEP', 'NSTLIM') == '1000000'
+    assert variant['NONBONDED'] is imd['NONBONDED']
+
+    variant.write(tmp_path / "variant.imd")
+    assert read_imd(tmp_path / "variant.imd").to_string() == variant.to_string()
+
+
+def test_batch_ph_ladder(tmp_path):
+    """A pH ladder with replicas is written in one call with unique, reproducible seeds"""
+    from constph.batch import ParameterGrid, write_batch
+    from constph.constants import BOLTZMANN, LN10
+    from constph.gromos_factory import GromosFactory
+    from constph.imd import read_imd
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+    grid = ParameterGrid(nstates=2, ph_values=[4.0, 5.0, 6.0], n_replicas=3, offsets=[(0.0, 10.0)])
+    manifest = write_batch(factory, "search", grid, str(tmp_path))
+
+    assert len(manifest) == len(grid) == 9
+    assert len({variant["seed"] for variant in manifest}) == 9
+    assert [variant["seed"] for variant in manifest] == [variant.seed for variant in grid]
+    assert sorted(p.name for p in tmp_path.iterdir())[:2] == ['batch_manifest.json', 'search_pH4.00_r0.imd']
+
+    imd = read_imd(tmp_path / "search_pH5.00_r1.imd")
+    assert imd['INITIALISE']['IG'] == str(manifest[4]["seed"])
+    offsets = [float(offset) for offset in imd['AEDS'].row(3)]
+    assert offsets == pytest.approx([0.0, 10.0 + 5.0 * BOLTZMANN * 300.0 * LN10], abs=1e-4)
+    assert imd['STEP']['NSTLIM'] == '1000000'
+
+    # production variants start from the offsets of the search run
+    with pytest.raises(ValueError):
+        write_batch(factory, "production", grid, str(tmp_path))
+    search = {"EMIN": -320.0, "EMAX": -280.0, "offsets": [0.0, 12.5]}
+    manifest = write_batch(factory, "production", grid, str(tmp_path), aeds_parameters=search)
+    imd = read_imd(tmp_path / "production_pH6.00_r2.imd")
+    assert imd['AEDS'].row(2) == ['-280.0000', '-320.0000']
+    offsets = [float(offset) for offset in imd['AEDS'].row(3)]
+    assert offsets == pytest.approx([0.0, 22.5 + 6.0 * BOLTZMANN * 300.0 * LN10], abs=1e-4)
+    assert manifest[-1]["offsets"] == pytest.approx(offsets, abs=1e-4)
+    assert "found in search" not in (tmp_path / "production_pH4.00_r0.imd").read_text()
+
+
+def _write_ene_ana(path, values):
+    with open(path, "w") as f:
+        f.write("# time value\n")
+        for i, value in enumerate(values):
+            f.write(f"{i * 0.2:10.3f} {value:15.6f}\n")
+
+
+def test_production_from_search(tmp_path):
+    """EMIN, EMAX and the offsets of the production run are filled in from the search output"""
+    import numpy as np
+    from constph.gromos_factory import GromosFactory
+    from constph.imd import read_imd
+    from constph.pipeline import write_production_from_search
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+
+    # constant end-state energies: the offsets are the energy differences
+    rng = np.random.default_rng(1)
+    e1 = -100.0 + rng.normal(0.0, 1e-9, 50)
+    e2 = -80.0 + rng.normal(0.0, 1e-9, 50)
+    _write_ene_ana(tmp_path / "e1.dat", e1)
+    _write_ene_ana(tmp_path / "e2.dat", e2)
+    _write_ene_ana(tmp_path / "eds_vr.dat", np.minimum(e1, e2 - 20.0))
+    parameters = write_production_from_search(factory, str(tmp_path), str(tmp_path / "production.imd"))
+    assert parameters["offsets"] == pytest.approx([0.0, 20.0])
+    assert parameters["EMIN"] == pytest.approx(-100.0)
+
+    imd = read_imd(tmp_path / "production.imd")
+    assert float(imd['AEDS']['EMIN']) == pytest.approx(-100.0)
+    assert [float(o) for o in imd['AEDS'].row(3)] == pytest.approx([0.0, 20.0])
+    assert os.path.isfile(tmp_path / "aeds_parameters.json")
+
+    # final values written by the search run take precedence
+    _write_ene_ana(tmp_path / "eds_emax.dat", [10.0, 12.0])
+    _write_ene_ana(tmp_path / "eds_emin.dat", [-90.0, -95.0])
+    _write_ene_ana(tmp_path / "eir1.dat", [1.0, 2.0])
+    _write_ene_ana(tmp_path / "eir2.dat", [3.0, 7.5])
+    parameters = write_production_from_search(factory, str(tmp_path), str(tmp_path / "production.imd"))
+    assert parameters == {"EMIN": -95.0, "EMAX": 12.0, "offsets": [0.0, 5.5]}
+
+
+def test_box_tuning(tmp_path):
+    """PAIRLIST cutoffs and the lattice-sum grid follow the box of the coordinate file"""
+    from constph.gromos_factory import GromosFactory
+    from constph.imd import ImdFile
+    from constph.tuning import fft_friendly, tune_nonbonded
+
+    assert [fft_friendly(n) for n in (7, 24, 25, 63, 97)] == [8, 24, 25, 64, 100]
+    assert tune_nonbonded((6.3, 6.3, 4.0))["NGX"] == 64
+    assert tune_nonbonded((6.3, 6.3, 4.0))["RCUTL"] == 1.4
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=str(tmp_path),
+        output_dir='data/',
+    )
+    settingsMap["system"]["structure"]["coord"] = "small.cnf"
+    (tmp_path / "small.cnf").write_text(
+        "TITLE\nsmall box\nEND\nPOSITION\n    1 PRO   CH3      1    0.1 0.1 0.1\nEND\n"
+        "GENBOX\n    1\n    2.4000000    2.4000000    2.5000000\n   90.0 90.0 90.0\n"
+        "    0.0 0.0 0.0\n    0.0 0.0 0.0\nEND\n"
+    )
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+    nonbonded = factory.tune_for_box()
+    assert nonbonded == {"RCUTP": 0.8, "RCUTL": 1.2, "SIZE": 0.4, "RCRF": 1.2, "NGX": 24, "NGY": 24, "NGZ": 25}
+
+    text = factory.generate_Gromos_search_input("search")
+    imd = ImdFile.parse(text)
+    assert imd['PAIRLIST']['RCUTL'] == '1.2'
+    assert imd['NONBONDED']['RCRF'] == '1.2'
+    assert imd['NONBONDED'].row(4)[:3] == ['24', '24', '25']
+    assert "Box-tuned for box 2.4 2.4 2.5 nm" in imd['TITLE'].lines[2]
+
+
+def test_output_budget(tmp_path):
+    """WRITETRAJ frequencies are chosen to keep the expected output within the budget"""
+    from constph.gromos_factory import GromosFactory
+    from constph.imd import ImdFile
+    from constph.output_budget import plan_output
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=str(tmp_path),
+        output_dir='data/',
+    )
+    settingsMap["system"]["structure"]["topo"] = "system.top"
+    (tmp_path / "system.top").write_text(
+        "TITLE\ntopology\nEND\nSOLUTEATOM\n#   NRP: number of solute atoms\n     6\n"
+        "    1    1   16   15.03500  0.00000  1   3   2   3   4\nEND\n"
+        "SOLVENTATOM\n#  NRAM: number of atoms per solvent molecule\n    3\nEND\n"
+    )
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+
+    plan = factory.budget_output(100e6)
+    assert plan.n_atoms == 6 + 1010 * 3
+    assert (plan.NTWE, plan.NTWX, plan.NTWG) == (100, 3125, 0)
+    assert plan.total_bytes <= 100e6
+    imd = ImdFile.parse(factory.generate_Gromos_search_input("search"))
+    assert (imd['WRITETRAJ']['NTWX'], imd['WRITETRAJ']['NTWE']) == ('3125', '100')
+
+    # a campaign budget is shared by its runs
+    plan = factory.budget_output(40 * 20e6, n_runs=40)
+    assert (plan.NTWE, plan.NTWX) == (320, 0) and plan.total_bytes <= 20e6
+    assert factory.budget_output(40 * 40e6, n_runs=40).NTWX == 10000
+    with pytest.raises(ValueError):
+        factory.budget_output(10e6)
+
+    # a configured 0 keeps that output off
+    plan = plan_output(1000000, 5000, 2, 50e9, ntwx=0, ntwe=250)
+    assert (plan.NTWX, plan.coordinate_bytes, plan.NTWE) == (0, 0, 250)
+    plan = plan_output(1000000, 5000, 2, 1e9, ntwx=1000, ntwe=0)
+    assert (plan.NTWE, plan.NTWG, plan.energy_bytes, plan.free_energy_bytes) == (0, 0, 0, 0)
+    assert plan.NTWX == 1000 and plan.total_bytes == plan.coordinate_bytes <= 1e9
+
+
+def test_segment_chain(tmp_path):
+    """A long run is split into chained segments that resume after the last finished one"""
+    from constph.gromos_factory import GromosFactory
+    from constph.imd import read_imd
+    from constph.segments import (
+        CONTINUATION_FLAGS, read_chain, resume_chain, run_chain, segment_imds, split_nstlim, write_segment_chain
+    )
+
+    assert split_nstlim(1000000, 3, 1000) == [334000, 333000, 333000]
+    with pytest.raises(ValueError):
+        split_nstlim(5000, 6, 1000)
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+    # a stand-in for md++ that writes the final configuration
+    md = tmp_path / "md"
+    md.write_text(f"#!{sys.executable}\nimport shutil, sys\n"
+                  "shutil.copy(sys.argv[sys.argv.index('@conf') + 1], sys.argv[sys.argv.index('@fin') + 1])\n")
+    md.chmod(0o755)
+    settingsMap["config"]["paths"]["gromos_bin"] = str(md)
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+    manifest = write_segment_chain(factory, "search", 4, str(tmp_path))
+    assert [segment["steps"] for segment in manifest] == [250000] * 4
+    assert [segment["time"] for segment in manifest] == [0.0, 500.0, 1000.0, 1500.0]
+    assert manifest[1]["conf"] == "search_seg001.cnf"
+    assert manifest[0]["command"][manifest[0]["command"].index("@conf") + 1] == manifest[0]["conf"]
+
+    first, second = read_imd(tmp_path / "search_seg001.imd"), read_imd(tmp_path / "search_seg002.imd")
+    assert first['AEDS']['NTIAEDSS'] == '1' and second['AEDS']['NTIAEDSS'] == '0'
+    assert second['AEDS']['RESTREMIN'] == first['AEDS']['RESTREMIN'] == '1'
+    assert second['STEP']['T'] == '500'
+    # a continuation only differs from the first segment in its restart flags and STEP
+    restored = {key: first[key[0]][key[1]] for key in CONTINUATION_FLAGS}
+    restored.update({("STEP", "T"): first['STEP']['T'], ("STEP", "NSTLIM"): first['STEP']['NSTLIM']})
+    assert second.patched(restored).to_string() == first.to_string()
+    # long chains keep the full start time
+    reference = factory.generate_Gromos_search_imd("search")
+    assert segment_imds(reference, [1234567, 1000], 0.002)[1]['STEP']['T'] == '2469.134'
+
+    # segment 2 left a truncated configuration, segment 3 output is not from this chain
+    cnf = "TITLE\nfinal\nEND\nPOSITION\n    1 PRO   CH3      1    0.1 0.1 0.1\nEND\nGENBOX\n    1\nEND\n"
+    (tmp_path / "search_seg001.cnf").write_text(cnf)
+    (tmp_path / "search_seg002.cnf").write_text(cnf[:40])
+    (tmp_path / "search_seg003.cnf").write_text(cnf)
+    pending = resume_chain(str(tmp_path))
+    assert [segment["index"] for segment in pending] == [2, 3, 4]
+    assert [segment["status"] for segment in read_chain(str(tmp_path))][:2] == ["finished", "pending"]
+
+    # segment 2 starts from the finished segment 1, the chain stops at the boundary after 3
+    assert [segment["index"] for segment in run_chain(str(tmp_path), stop=lambda s: s["index"] == 3)] == [4]
+    assert run_chain(str(tmp_path)) == []
+    assert {segment["status"] for segment in read_chain(str(tmp_path))} == {"finished"}
+
+
+def _write_tre(path, e_states, e_ref, dt=0.2, start=0):
+    """An md++ style energy trajectory: 45 totals with eds_vr at 34, then the eds section"""
+    import gzip
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "wt") as f:
+        f.write("TITLE\nsynthetic\nEND\nENEVERSION\n 2015-06-23-A\nEND\n")
+        for i, (states, ref) in enumerate(zip(e_states, e_ref), start=start):
+            totals = [0.0] * 45
+            totals[34], totals[35], totals[36] = ref, 10.0, -10.0
+            f.write(f"TIMESTEP\n{i * 100:15d} {i * dt:15.9f}\nEND\nENERGY03\n# totals\n")
+            f.write("".join(f"{value:18.9e}\n" for value in totals))
+            f.write("# baths\n# numbaths\n 2\n# kinetic total, centre of mass, internal/rotational\n")
+            f.write(f"{1.0:18.9e}{2.0:18.9e}{3.0:18.9e}\n" * 2)
+            f.write(f"# eds\n# numstates\n{len(states)}\n# total nonbonded special\n")
+            f.write("".join(f"{value:18.9e}{value:18.9e}{0.0:18.9e}\n" for value in states))
+            f.write("END\nVOLUMEPRESSURE03\n# mass\n   3.0e+04\nEND\n")
+
+
+def test_tre_reader(tmp_path):
+    """Energy trajectories are streamed in chunks of whole frames, gzipped or not"""
+    import numpy as np
+    from constph.tre import iter_tre, read_tre
+
+    rng = np.random.default_rng(3)
+    e_states = rng.normal(-100.0, 5.0, (250, 2))
+    e_ref = e_states.min(axis=1)
+    _write_tre(tmp_path / "run.tre", e_states, e_ref)
+    _write_tre(tmp_path / "run.tre.gz", e_states, e_ref)
+
+    for name in ("run.tre", "run.tre.gz"):
+        tre = read_tre(tmp_path / name, chunk_frames=16)
+        assert len(tre) == 250
+        assert tre.step[-1] == 24900 and tre.time[1] == pytest.approx(0.2)
+        assert np.allclose(tre.states, e_states) and np.allclose(tre.e_ref, e_ref)
+        assert np.all(tre.properties["eds_emax"] == 10.0)
+    assert [len(chunk) for chunk in iter_tre(tmp_path / "run.tre", chunk_frames=100)] == [1, 100, 100, 49]
+
+    # a truncated last frame is dropped, a change of layout is picked up
+    text = (tmp_path / "run.tre").read_text()
+    (tmp_path / "truncated.tre").write_text(text[:-200])
+    assert len(read_tre(tmp_path / "truncated.tre")) == 249
+    _write_tre(tmp_path / "three.tre", np.full((10, 3), -5.0), np.full(10, -5.0), start=250)
+    three = (tmp_path / "three.tre").read_text().split("TIMESTEP", 1)[1]
+    (tmp_path / "mixed.tre").write_text(text + "TIMESTEP" + three)
+    with pytest.raises(ValueError):
+        read_tre(tmp_path / "mixed.tre", chunk_frames=16)
+    chunks = list(iter_tre(tmp_path / "mixed.tre", chunk_frames=16))
+    assert sum(len(chunk) for chunk in chunks) == 260 and chunks[-1].states.shape[1] == 3
+
+
+def test_tre_cache(tmp_path, monkeypatch):
+    """Parsed trajectories are cached column-wise next to the run and memory-mapped"""
+    import numpy as np
+    from constph import tre
+    from constph.column_cache import read_columns
+
+    e_states = np.arange(40.0).reshape(20, 2)
+    _write_tre(tmp_path / "run.tre", e_states, e_states.min(axis=1))
+    parsed = tre.read_tre(tmp_path / "run.tre")
+    meta = json.loads((tmp_path / ".constph_cache" / "run.tre" / "meta.json").read_text())
+    assert meta["stamp"]["size"] == os.path.getsize(tmp_path / "run.tre")
+    assert meta["stamp"]["ino"] == os.stat(tmp_path / "run.tre").st_ino and "sha256" not in meta["stamp"]
+
+    parse = tre._parse_tre
+
+    def fail(*args, **kwargs):
+        raise AssertionError("cached trajectory was parsed again")
+    monkeypatch.setattr(tre, "_parse_tre", fail)
+    cached = tre.read_tre(tmp_path / "run.tre")
+    assert isinstance(cached.states, np.memmap)
+    assert np.array_equal(cached.states, parsed.states) and np.array_equal(cached.step, parsed.step)
+    # the source is read once: the first read parses it without hashing it
+    monkeypatch.setattr(tre, "_parse_tre", parse)
+    monkeypatch.setattr("constph.column_cache.file_sha256", fail)
+    _write_tre(tmp_path / "fresh.tre", e_states, e_states.min(axis=1))
+    assert np.array_equal(tre.read_tre(tmp_path / "fresh.tre").e_ref, parsed.e_ref)
+    # a new mtime invalidates the entry
+    os.utime(tmp_path / "fresh.tre", ns=(0, 10 ** 18))
+    assert read_columns(str(tmp_path / "fresh.tre"), tre.CACHE_KIND) is None
+
+    _write_tre(tmp_path / "run.tre", e_states + 1.0, e_states.min(axis=1))
+    assert np.array_equal(tre.read_tre(tmp_path / "run.tre").states, e_states + 1.0)
+    extended = tre.read_tre(tmp_path / "run.tre", properties=("potential",))
+    assert set(extended.properties) == {"potential"}
+    meta = json.loads((tmp_path / ".constph_cache" / "run.tre" / "meta.json").read_text())
+    assert "totals.eds_vr" in meta["columns"] and "totals.potential" in meta["columns"]
+    assert len(list((tmp_path / ".constph_cache" / "run.tre").glob("*.npy"))) == len(meta["columns"])
+
+    # a trajectory that grows while it is parsed is not cached with the frames read so far
+    _write_tre(tmp_path / "growing.tre", e_states[:10], e_states[:10].min(axis=1))
+
+    def parse_while_growing(path, properties, chunk_frames):
+        trajectory = parse(path, properties, chunk_frames)
+        _write_tre(tmp_path / "growing.tre", e_states, e_states.min(axis=1))
+        return trajectory
+    monkeypatch.setattr(tre, "_parse_tre", parse_while_growing)
+    assert len(tre.read_tre(tmp_path / "growing.tre").step) == 10
+    monkeypatch.setattr(tre, "_parse_tre", parse)
+    assert len(tre.read_tre(tmp_path / "growing.tre").step) == 20
+    assert len(tre.read_tre(tmp_path / "growing.tre").step) == 20
+
+
+def test_tail_monitor(tmp_path):
+    """Growing trajectories are read incrementally, partially written frames are completed later"""
+    import numpy as np
+    from constph.tail import FileTail, TailMonitor
+
+    e_states = np.arange(60.0).reshape(30, 2)
+    _write_tre(tmp_path / "full.tre", e_states, e_states.min(axis=1))
+    text = (tmp_path / "full.tre").read_bytes()
+
+    monitor = TailMonitor()
+    runs = [tmp_path / f"run{i}.tre" for i in range(3)]
+    for run in runs:
+        monitor.add(str(run))
+    assert monitor.poll() == {}
+
+    # appends cut inside a frame and inside a line
+    cuts = [0, 1000, len(text) // 2 + 7, len(text) - 30, len(text)]
+    frames = 0
+    for start, end in zip(cuts, cuts[1:]):
+        with open(runs[0], "ab") as f:
+            f.write(text[start:end])
+        updates = monitor.poll()
+        assert set(updates) <= {str(runs[0])}
+        frames += sum(len(new) for new in updates.values())
+        assert frames == len(monitor[str(runs[0])])
+    tail = monitor[str(runs[0])]
+    assert frames == 30 and np.array_equal(tail.trajectory.states, e_states)
+    assert np.array_equal(tail.trajectory.step, np.arange(30) * 100)
+    assert monitor.poll() == {}
+
+    # a restarted run is read from the start
+    runs[0].write_bytes(text[:2000])
+    monitor.poll()
+    assert len(monitor[str(runs[0])]) < 30 and monitor[str(runs[0])].file.restarted
+
+    (tmp_path / "log.omd").write_text("MD++\nstep 1")
+    log = FileTail(str(tmp_path / "log.omd"))
+    assert log.read_lines() == ["MD++"]
+    with open(tmp_path / "log.omd", "a") as f:
+        f.write("0\nMD++ finished successfully\n")
+    assert log.read_lines() == ["step 10", "MD++ finished successfully"]
+
+
+def test_exp_free_energies():
+    """EXP reweighting is stable for large energy gaps and gives the pKa from the deprotonation free energy"""
+    import numpy as np
+    from constph.analysis import logsumexp, pka_from_free_energy, pka_from_reference, relative_free_energies
+    from constph.constants import BOLTZMANN, LN10
+
+    assert logsumexp(np.array([1000.0, 1000.0])) == pytest.approx(1000.0 + np.log(2.0))
+    kT = BOLTZMANN * 300.0
+    rng = np.random.default_rng(7)
+    e_ref = rng.normal(0.0, 2.0, 200000)
+    # state 2 is shifted by 5000 kJ/mol: the plain exponential under- or overflows
+    e_states = np.column_stack([e_ref + rng.normal(0.0, 1.0, len(e_ref)), e_ref + 5000.0])
+    delta = relative_free_energies(e_states, e_ref)
+    # for Gaussian fluctuations with variance s^2 the EXP estimate is -s^2 / (2 kT)
+    assert delta == pytest.approx([0.0, 5000.0 + 1.0 / (2 * kT)], abs=0.05)
+
+    dg = kT * LN10 * 2.5
+    assert pka_from_free_energy(dg, ph=4.0) == pytest.approx(6.5)
+    assert pka_from_reference(dg, dg - kT * LN10, 4.87) == pytest.approx(5.87)
+
+
+def test_mbar():
+    """MBAR recovers analytic free energies, through self-consistent iteration and Newton steps"""
+    import numpy as np
+    from constph.analysis import relative_free_energies
+    from constph.mbar import aeds_mbar, mbar
+    from constph.uncertainty import statistical_inefficiency
+
+    # harmonic states u_k(x) = (x - mu_k)^2 / (2 s_k^2), f_k - f_0 = -ln(s_k / s_0)
+    rng = np.random.default_rng(11)
+    mu, sigma, n_k = np.array([0.0, 1.0, 2.5]), np.array([1.0, 0.7, 1.3]), [4000, 3000, 5000]
+    x = np.concatenate([rng.normal(m, s, n) for m, s, n in zip(mu, sigma, n_k)])
+    u_kn = (x[None, :] - mu[:, None]) ** 2 / (2 * sigma[:, None] ** 2)
+    expected = -np.log(sigma / sigma[0])
+    for sci_iterations in (100, 2):
+        result = mbar(u_kn, n_k, sci_iterations=sci_iterations)
+        assert result.converged and result.f_k == pytest.approx(expected, abs=0.05)
+    assert result.method == "newton" and result.iterations < 20
+    u_target = ((x - 1.8) ** 2 / (2 * 0.9 ** 2))[None, :]
+    assert result.target_free_energies(u_target) == pytest.approx([-np.log(0.9)], abs=0.05)
+
+    # a single A-EDS run is EXP on the end states
+    e_states = rng.normal(0.0, 2.0, (5000, 3)) + [0.0, 10.0, 20.0]
+    offsets = [0.0, 10.0, 20.0]
+    kT = 0.00831446261815324 * 300.0
+    e_ref = -kT * np.log(np.exp(-(e_states - offsets) / kT).sum(axis=1))
+    free_energies = aeds_mbar([{"e_states": e_states, "offsets": offsets}], subsample=False)
+    assert free_energies == pytest.approx(relative_free_energies(e_states, e_ref), abs=1e-6)
+
+    # AR(1) with phi = 0.9: g = (1 + phi) / (1 - phi) = 19
+    noise = rng.normal(size=200000)
+    series = np.empty_like(noise)
+    series[0] = noise[0]
+    for i in range(1, len(noise)):
+        series[i] = 0.9 * series[i - 1] + noise[i]
+    assert statistical_inefficiency(series) == pytest.approx(19.0, rel=0.15)
+
+
+def test_bootstrap_uncertainty():
+    """Bootstrap error bars are reproducible for any worker count, block averaging finds g"""
+    from functools import partial
+
+    import numpy as np
+    from constph.analysis import relative_free_energies
+    from constph.uncertainty import block_average, bootstrap, exp_statistic, index_statistic
+
+    rng = np.random.default_rng(5)
+    e_ref = rng.normal(0.0, 1.0, 20000)
+    e_states = np.column_stack([e_ref, e_ref + rng.normal(3.0, 1.0, len(e_ref))])
+    kwargs = dict(n_resamples=40, seed=42, batch_size=8)
+    serial = bootstrap(exp_statistic, [e_states, e_ref], n_workers=1, **kwargs)
+    parallel = bootstrap(exp_statistic, [e_states, e_ref], n_workers=3, **kwargs)
+    assert serial.samples.shape == (40, 2)
+    assert np.array_equal(serial.samples, parallel.samples)
+    assert serial.mean[1] == pytest.approx(relative_free_energies(e_states, e_ref)[1], abs=0.05)
+    assert 0.0 < serial.std[1] < 0.05
+
+    # the weighted statistic is the index-based estimator on the same resamples
+    by_index = bootstrap(partial(index_statistic, function=relative_free_energies), [e_states, e_ref],
+                         n_workers=1, **kwargs)
+    assert by_index.samples == pytest.approx(serial.samples)
+
+    noise = rng.normal(size=100000)
+    series = np.empty_like(noise)
+    series[0] = noise[0]
+    for i in range(1, len(noise)):
+        series[i] = 0.8 * series[i - 1] + noise[i]
+    assert block_average(series).statistical_inefficiency == pytest.approx(9.0, rel=0.25)
+
+
+def test_convergence_monitor(tmp_path):
+    """A converged search is stopped at the next segment boundary and handed off to production"""
+    import numpy as np
+    from constph.analysis import RunningExp, relative_free_energies
+    from constph.convergence import ConvergenceMonitor, watch
+    from constph.gromos_factory import GromosFactory
+    from constph.imd import read_imd
+    from constph.segments import STOP_FILE, read_chain, run_chain, write_segment_chain
+
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=".",
+        output_dir='data/',
+    )
+    factory = GromosFactory(settingsMap, settingsMap["system"]["structure"])
+    chain = tmp_path / "search"
+    write_segment_chain(factory, "search", 4, str(chain))
+
+    rng = np.random.default_rng(5)
+    e_ref = rng.normal(-100.0, 1.0, 400)
+    e_states = np.column_stack([e_ref + rng.normal(0.0, 0.5, 400), e_ref + 20.0 + rng.normal(0.0, 0.5, 400)])
+    running = RunningExp()
+    for chunk in np.array_split(np.arange(400), 3):
+        running.update(e_states[chunk], e_ref[chunk])
+    assert running.relative_free_energies() == pytest.approx(relative_free_energies(e_states, e_ref))
+
+    _write_tre(tmp_path / "full.tre", e_states, e_ref)
+    text = (tmp_path / "full.tre").read_text()
+    frames = text.split("TIMESTEP")
+    monitor = ConvergenceMonitor(str(chain), min_frames=150)
+    # nothing written yet, then the first segment grows by 100 frames per poll
+    assert not monitor()
+    converged = []
+    for i in range(4):
+        with open(chain / "search_seg001.tre", "a") as f:
+            new = "".join("TIMESTEP" + frame for frame in frames[1 + i * 100:101 + i * 100])
+            f.write(("" if i else frames[0]) + new)
+        converged.append(monitor(read_chain(str(chain))[0]))
+    # the window needs an estimate from before it: not before the second poll
+    assert converged == [False, True, True, True] and monitor.n_frames == 400
+    assert json.loads((chain / STOP_FILE).read_text())["reason"] == "converged"
+    assert monitor.parameters["offsets"] == pytest.approx(relative_free_energies(e_states, e_ref))
+
+    # the chain does not start another segment, production gets the current parameters
+    assert len(run_chain(str(chain))) == 4
+    parameters = watch(monitor, factory, str(tmp_path / "production.imd"), interval=0)
+    imd = read_imd(tmp_path / "production.imd")
+    assert float(imd['AEDS']['EMAX']) == pytest.approx(10.0) and float(imd['AEDS']['EMIN']) == pytest.approx(-10.0)
+    assert [float(o) for o in imd['AEDS'].row(3)] == pytest.approx(parameters["offsets"], abs=1e-3)
+
+
+def test_titration_fits():
+    """pKa and Hill coefficients of many sites are fitted together, with gaps in the pH ladders"""
+    import numpy as np
+    from constph.titration import fit_titration_curves, hill_curve, stack_ladders
+
+    rng = np.random.default_rng(11)
+    ph = np.arange(0.0, 12.5, 0.5)
+    pka = rng.uniform(2.0, 10.0, 500)
+    hill = rng.uniform(0.6, 1.5, 500)
+    exact = hill_curve(ph, pka[:, None], hill[:, None])
+    fit = fit_titration_curves(ph, exact)
+    assert np.all(fit.converged)
+    assert fit.pka == pytest.approx(pka, abs=1e-6) and fit.hill == pytest.approx(hill, abs=1e-6)
+
+    errors = np.full(exact.shape, 0.01)
+    noisy = exact + rng.normal(0.0, 0.01, exact.shape)
+    noisy[::3, 5:9] = np.nan
+    fit = fit_titration_curves(ph, noisy, errors)
+    # the reported errors match the scatter of the fits
+    assert np.std((fit.pka - pka) / fit.pka_err) == pytest.approx(1.0, abs=0.15)
+    assert np.std((fit.hill - hill) / fit.hill_err) == pytest.approx(1.0, abs=0.15)
+    assert fit.points[0] == len(ph) - 4 and fit.points[1] == len(ph)
+
+    # Henderson-Hasselbalch: a single point gives a pKa without error, a site without points none
+    names, ladder_ph, fractions, ladder_errors = stack_ladders({
+        "ASP": ([2.0, 3.0, 4.0, 5.0], hill_curve(np.array([2.0, 3.0, 4.0, 5.0]), 3.9)),
+        "HIS": ([6.0], [0.5]),
+        "GLU": ([], []),
+    })
+    assert ladder_errors is None and np.isnan(ladder_ph[1, 1])
+    fit = fit_titration_curves(ladder_ph, fractions, fit_hill=False)
+    assert fit.pka[:2] == pytest.approx([3.9, 6.0]) and fit.hill[0] == 1.0
+    assert np.isnan(fit.pka_err[1]) and np.isnan(fit.pka[2])
+    table = fit.table(names).splitlines()
+    assert table[0].split() == ["site", "pKa", "pKa_err", "hill", "hill_err", "points", "rmsd", "converged"]
+    assert table[1].split()[:2] == ["ASP", "3.900"] and table[3].split()[1] == "nan"
+
+
+# A-EDS parameters of a finished search run
+_SEARCH_AEDS = {"EMIN": -320.0, "EMAX": -280.0, "offsets": [0.0, 12.5]}
+
+
+def _state_settings(tmp_path):
+    """example.yaml set up in tmp_path, with its structure files in place"""
+    settingsMap = load_config_yaml(
+        config="constph/test_suite/test_data/example.yaml",
+        input_dir=str(tmp_path / "input" / "a" / "b"),
+        output_dir=str(tmp_path / "systems"),
+    )
+    for key in ("topo", "pttopo", "coord"):
+        path = tmp_path / "input" / "a" / "b" / settingsMap["system"]["structure"][key]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(f"TITLE\n{key}\nEND\n")
+    structure = settingsMap["system"]["structure"]
+    system = type("System", (), {"name": settingsMap["system"]["name"], "structure": structure})
+    return settingsMap, system
+
+
+def test_incremental_setup(tmp_path, monkeypatch):
+    """A re-setup only writes changed inputs and leaves runs that started untouched"""
+    from constph.batch import ParameterGrid
+    from constph.state import StateFactory
+
+    settingsMap, system = _state_settings(tmp_path)
+    kwargs = dict(aeds_parameters=_SEARCH_AEDS)
+    grid = ParameterGrid(2, ph_values=[4.0, 5.0, 6.0])
+    report = StateFactory(system, settingsMap, **kwargs).setup(grid)
+    assert (report.written, report.unchanged) == (4 * 4, 0)
+    base = pathlib.Path(settingsMap["system_dir"]) / system.name
+    assert sorted(p.name for p in (base / "intst2").iterdir()) == [
+        "md_propionic_acid_20.cnf", "pert_eds.ptp", "production_pH5.00_r0.imd", "propionic_acid_54a8_pH.top"
+    ]
+    mtimes = {p: p.stat().st_mtime_ns for p in base.rglob("*")}
+
+    report = StateFactory(system, settingsMap, **kwargs).setup(grid)
+    assert (report.written, report.unchanged) == (0, 16)
+    assert {p: p.stat().st_mtime_ns for p in base.rglob("*")} == mtimes
+
+    # a setup on another day finds the same inputs, started runs included
+    (base / "intst2" / "production_pH5.00_r0.omd").write_text("MD++\n")
+    later = types.SimpleNamespace(date=types.SimpleNamespace(today=lambda: datetime.date(2031, 1, 1)))
+    monkeypatch.setattr("constph.gromos_factory.datetime", later)
+    report = StateFactory(system, settingsMap, **kwargs).setup(grid)
+    assert (report.written, report.kept, report.unchanged) == (0, 0, 16)
+    monkeypatch.undo()
+    (base / "intst2" / "production_pH5.00_r0.omd").unlink()
+
+    # intst1 has run; a changed production length rewrites the other production inputs only
+    (base / "intst1" / "production_pH4.00_r0.omd").write_text("MD++\n")
+    settingsMap["production_run"]["production_parameters"]["NSTLIM"] = 10000
+    report = StateFactory(system, settingsMap, **kwargs).setup(grid)
+    assert (report.written, report.unchanged, report.kept) == (2, 13, 1)
+    assert "5000" in (base / "intst1" / "production_pH4.00_r0.imd").read_text()
+    assert "10000" in (base / "intst3" / "production_pH6.00_r0.imd").read_text()
+
+    # a hand-edited input is written again, a dropped pH value is removed
+    (base / "intst0" / "search.imd").write_text("truncated")
+    report = StateFactory(system, settingsMap, **kwargs).setup(ParameterGrid(2, ph_values=[4.0, 5.0]))
+    assert (report.written, report.removed) == (1, 4)
+    assert "NSTLIM" in (base / "intst0" / "search.imd").read_text()
+    assert not (base / "intst3" / "production_pH6.00_r0.imd").exists()
+    assert (base / "intst1" / "production_pH4.00_r0.omd").exists()
+
+
+def test_setup_ph_insertion(tmp_path):
+    """Production variants keep their directories: an inserted pH value never lands in a started run"""
+    from constph.batch import ParameterGrid
+    from constph.state import StateFactory
+
+    settingsMap, system = _state_settings(tmp_path)
+    base = pathlib.Path(settingsMap["system_dir"]) / system.name
+
+    # without the parameters of the search run only the search run is set up
+    report = StateFactory(system, settingsMap).setup(ParameterGrid(2, ph_values=[5.0, 7.0]))
+    assert report.written == 4 and sorted(p.name for p in base.glob("intst*")) == ["intst0"]
+
+    factory = StateFactory(system, settingsMap, aeds_parameters=_SEARCH_AEDS)
+    factory.setup(ParameterGrid(2, ph_values=[5.0, 7.0]))
+    (base / "intst1" / "production_pH5.00_r0.tre").write_text("ENERYVERSION\n")
+    report = factory.setup(ParameterGrid(2, ph_values=[3.0, 5.0, 7.0]))
+    assert (report.written, report.unchanged, report.kept, report.removed) == (4, 12, 0, 0)
+    assert [sorted(p.name for p in (base / f"intst{nr}").glob("*.imd")) for nr in (1, 2, 3)] == [
+        ["production_pH5.00_r0.imd"], ["production_pH7.00_r0.imd"], ["production_pH3.00_r0.imd"]
+    ]
+
+    # a dropped variant frees its directory, the started run keeps its own
+    report = factory.setup(ParameterGrid(2, ph_values=[3.0, 5.0]))
+    assert report.removed == 4 and not (base / "intst2").exists()
+    report = factory.setup(ParameterGrid(2, ph_values=[3.0, 5.0, 6.0]))
+    assert (base / "intst2" / "production_pH6.00_r0.imd").exists()
+    assert (base / "intst1" / "production_pH5.00_r0.tre").read_text() == "ENERYVERSION\n"
+    # nothing is pruned while the production runs wait for the parameters
+    report = StateFactory(system, settingsMap).setup(ParameterGrid(2, ph_values=[3.0]))
+    assert report.removed == 0 and (base / "intst2" / "production_pH6.00_r0.imd").exists()
+
+    # a manifest emptied by a crash is rebuilt, the started run keeps its input
+    (base / "setup_manifest.json").write_text("")
+    report = factory.setup(ParameterGrid(2, ph_values=[3.0, 5.0, 6.0]))
+    assert report.kept == 4 and json.loads((base / "setup_manifest.json").read_text())["files"]
+
+
+def test_asset_staging(tmp_path, monkeypatch):
+    """Shared structure files are stored once and linked into every state directory"""
+    import errno
+    from constph.assets import AssetStore
+    from constph.batch import ParameterGrid
+    from constph.state import StateFactory
+
+    settingsMap, system = _state_settings(tmp_path)
+    store = AssetStore(tmp_path / "store")
+    factories = []
+    for name in ("sys1", "sys2"):
+        settings = copy.deepcopy(settingsMap)
+        settings["system_dir"] = str(tmp_path / "systems" / name)
+        factories.append(StateFactory(system, settings, asset_store=store, aeds_parameters=_SEARCH_AEDS))
+        factories[-1].setup(ParameterGrid(2, ph_values=[4.0, 5.0]))
+    topo = [pathlib.Path(f.path) / f"intst{nr}" / "propionic_acid_54a8_pH.top" for f in factories for nr in range(3)]
+    assert len({path.stat().st_ino for path in topo}) == 1
+    size = sum(path.stat().st_size for path in topo[0].parent.iterdir() if not path.name.endswith(".imd"))
+    # 3 files stored, each linked into 6 directories instead of copied
+    assert (store.report.stored_files, store.report.hardlinked, store.report.copied) == (3, 18, 0)
+    assert store.report.inodes_saved == 15 and store.report.bytes_saved == 5 * size
+
+    # a changed topology is restaged without writing through the link of the other system
+    source = tmp_path / "input" / "topo" / "propionic_acid_54a8_pH.top"
+    source.write_text("TITLE\nnew topology\nEND\n")
+    factories[0].setup(ParameterGrid(2, ph_values=[4.0, 5.0]))
+    assert topo[0].read_text() == source.read_text() and topo[3].read_text() == "TITLE\ntopo\nEND\n"
+
+    # links that can not be made fall back to copies
+    def cross_device(src, dst):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr("os.link", cross_device)
+    store = AssetStore(tmp_path / "store")
+    assert store.stage(str(source), str(tmp_path / "copy.top")) == "copy"
+    assert (tmp_path / "copy.top").read_text() == source.read_text() and store.report.inodes_saved == 0
+    symlinks = AssetStore(tmp_path / "store", mode="symlink")
+    assert symlinks.stage(str(source), str(tmp_path / "link.top")) == "symlink"
+    assert (tmp_path / "link.top").is_symlink() and symlinks.report.bytes_saved == source.stat().st_size
+
+
+def test_parallel_setup(tmp_path):
+    """State directories are set up on a thread pool, with the same result for any thread count"""
+    from constph.assets import AssetStore
+    from constph.batch import ParameterGrid
+    from constph.setup_manifest import SETUP_MANIFEST
+    from constph.state import STALE_BUILD_AGE, StateFactory, setup_systems
+
+    settingsMap, system = _state_settings(tmp_path)
+    grid = ParameterGrid(2, ph_values=[3.0, 4.0, 5.0, 6.0], n_replicas=2)
+    trees = []
+    for n_workers in (1, 8):
+        store = AssetStore(tmp_path / f"store{n_workers}")
+        factories = []
+        for name in ("sys1", "sys2", "sys3"):
+            settings = copy.deepcopy(settingsMap)
+            settings["system_dir"] = str(tmp_path / f"systems{n_workers}" / name)
+            factories.append(StateFactory(system, settings, asset_store=store, aeds_parameters=_SEARCH_AEDS))
+        reports = setup_systems(factories, grid, n_workers=n_workers)
+        assert [(r.written, r.unchanged) for r in reports] == [(9 * 4, 0)] * 3
+        assert set(reports[0].stage_times) == {"render", "directories", "write", "stage", "prune", "manifest", "sync"}
+        assert reports[0].wall_time > 0 and store.report.stored_files == 3
+        base = tmp_path / f"systems{n_workers}"
+        manifests = [json.loads((pathlib.Path(f.path) / SETUP_MANIFEST).read_text())["files"] for f in factories]
+        trees.append((
+            sorted((str(p.relative_to(base)), p.read_bytes() if p.suffix == ".imd" else b"") for p in base.rglob("*")),
+            [{name: entry["sha256"] for name, entry in files.items()} for files in manifests],
+        ))
+    assert trees[0] == trees[1]
+
+    # a state that fails to set up leaves no partial directory behind
+    settings = copy.deepcopy(settingsMap)
+    settings["system_dir"] = str(tmp_path / "broken")
+    settings["system"]["structure"]["pttopo"] = "missing.ptp"
+    factory = StateFactory(system, settings, aeds_parameters=_SEARCH_AEDS)
+    with pytest.raises(FileNotFoundError):
+        factory.setup(grid)
+    assert list(pathlib.Path(factory.path).iterdir()) == []
+
+    # nor does a setup that was killed, once the next one starts; a build another setup of
+    # the same system is still assembling is left alone
+    stale = pathlib.Path(factory.path) / "intst3.0123abcd.tmp"
+    active = pathlib.Path(factory.path) / "intst4.4567cdef.tmp"
+    for build in (stale, active):
+        build.mkdir()
+        (build / "production_pH4.00_r1.imd").write_text("partial")
+    past = time.time() - STALE_BUILD_AGE - 60
+    for path in (stale / "production_pH4.00_r1.imd", stale):
+        os.utime(path, (past, past))
+    settings["system"]["structure"]["pttopo"] = settingsMap["system"]["structure"]["pttopo"]
+    StateFactory(system, settings, aeds_parameters=_SEARCH_AEDS).setup(grid)
+    assert not stale.exists()
+    assert list(pathlib.Path(factory.path).glob("*.tmp")) == [active]
+    assert (active / "production_pH4.00_r1.imd").read_text() == "partial"
+
+
+def test_atomic_writer(tmp_path):
+    """Output replaces its destination only once complete; the fsync of a setup is batched"""
+    from constph.atomic import AtomicWriter, atomic_open, get_writer, set_fsync_policy, sync_pending
+    from constph.imd import ImdFile
+
+    job = tmp_path / "aeds.job"
+    job.write_text("#!/bin/sh\nmd @input search.imd\n")
+    job.chmod(0o750)
+    with pytest.raises(RuntimeError):
+        with atomic_open(job) as f:
+            f.write("#!/bin/sh\n")
+            raise RuntimeError("interrupted")
+    assert job.read_text() == "#!/bin/sh\nmd @input search.imd\n" and os.listdir(tmp_path) == ["aeds.job"]
+    with atomic_open(job) as f:
+        f.write("#!/bin/sh\nmd @input production.imd\n")
+    assert job.stat().st_mode & 0o777 == 0o750 and "production" in job.read_text()
+
+    # a hardlinked destination is replaced, not written through
+    os.link(job, tmp_path / "shared.job")
+    ImdFile.parse("TITLE\nnew\nEND\n").write(str(job))
+    assert "production" in (tmp_path / "shared.job").read_text() and "new" in job.read_text()
+
+    previous = set_fsync_policy("batch")
+    try:
+        sync_pending()
+        writer = get_writer()
+        (tmp_path / "runs").mkdir()
+        writer.write(str(tmp_path / "runs" / "a.json"), "{}")
+        writer.write(str(tmp_path / "runs" / "b.json"), "{}")
+        assert len(writer) == 2
+        # run inputs are synced before their rename, only their directory is left to the batch
+        ImdFile.parse("TITLE\nbatch\nEND\n").write(str(tmp_path / "a.imd"))
+        assert len(writer) == 2 and writer._pending_dirs == {str(tmp_path)}
+        assert sync_pending() == 2 and len(writer) == 0 and not writer._pending_dirs
+        always = AtomicWriter("always")
+        always.write(str(tmp_path / "c.imd"), b"TITLE\nalways\nEND\n")
+        assert len(always) == 0 and (tmp_path / "c.imd").read_bytes() == b"TITLE\nalways\nEND\n"
+        with pytest.raises(ValueError):
+            set_fsync_policy("sometimes")
+    finally:
+        set_fsync_policy(previous)
+
+
+def test_lazy_system_structure(tmp_path, monkeypatch):
+    """Structure files are parsed on first access, once per process for systems sharing them"""
+    from constph import system as system_module
+    from constph.system import SystemStructure, cache_info, clear_cache
+
+    settingsMap, _ = _state_settings(tmp_path)
+    base = pathlib.Path(settingsMap["data_dir_base"])
+    structure = settingsMap["system"]["structure"]
+    (base / structure["topo"]).write_text("TITLE\ntopology\nEND\nSOLUTEATOM\n# NRP\n   12\nEND\n")
+    (base / structure["pttopo"]).write_text(
+        "TITLE\neds\nEND\nMPERTATOM\n# NJLA NPTB\n    2    2\n   prot  deprot\n"
+        "    5 O1   1  -0.5   2  -0.8  1.0  1.0\n    6 H1  18   0.4  22   0.0  1.0  1.0\nEND\n"
+    )
+    (base / structure["coord"]).write_text(
+        "TITLE\ncoordinates\nEND\nGENBOX\n    1\n    3.1  3.2  3.3\n   90.0 90.0 90.0\nEND\n"
+    )
+
+    clear_cache()
+    systems = [SystemStructure(settingsMap) for _ in range(3)]
+    moved = copy.deepcopy(settingsMap)
+    moved["system"]["structure"]["coord"] = "missing.cnf"
+    lonely = SystemStructure(moved)
+    assert lonely.name == "2OJ9-test1" and cache_info()["misses"] == 0
+    assert [s.nstates for s in systems] == [2, 2, 2] and systems[0].state_names == ["prot", "deprot"]
+    assert systems[1].perturbed_atoms == [5, 6] and systems[2].solute_atoms == 12
+    assert systems[0].box == (3.1, 3.2, 3.3)
+    assert systems[0].topology is systems[2].topology is lonely.topology
+    assert cache_info() == {"hits": 4, "misses": 3, "entries": 3}
+    with pytest.raises(FileNotFoundError):
+        lonely.coordinates
+
+    # a changed file is parsed again by systems that did not load it yet, replacing the old entry
+    (base / structure["topo"]).write_text("TITLE\ntopology\nEND\nSOLUTEATOM\n# NRP\n   14\nEND\n")
+    assert SystemStructure(settingsMap).solute_atoms == 14 and systems[0].solute_atoms == 12
+    assert cache_info()["entries"] == 3 and len(system_module._latest) == 3
+
+    # a file replaced while it is read is read again instead of cached under its old identity
+    read = system_module.ImdFile.read
+
+    def read_while_replaced(path):
+        parsed = read(path)
+        if "   16" not in (base / structure["topo"]).read_text():
+            (base / structure["topo"]).write_text("TITLE\ntopology\nEND\nSOLUTEATOM\n# NRP\n   16\nEND\n")
+        return parsed
+    (base / structure["topo"]).write_text("TITLE\ntopology\nEND\nSOLUTEATOM\n# NRP\n   15\nEND\n")
+    monkeypatch.setattr(system_module.ImdFile, "read", read_while_replaced)
+    assert SystemStructure(settingsMap).solute_atoms == 16
+    assert SystemStructure(settingsMap).topology is system_module.load_block_file(systems[0].path("topo"))
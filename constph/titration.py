@@ -0,0 +1,243 @@
+"""
+Batch fits of titration curves: pKa and Hill coefficient of many sites over their pH ladders.
+
+The protonated fraction of a site follows the Hill equation
+
+    f(pH) = 1 / (1 + 10^(n (pH - pKa)))
+
+with n = 1 for Henderson-Hasselbalch. All sites are fitted together: the data are sites x pH
+arrays (missing points are NaN), and every Levenberg-Marquardt iteration updates the sites that
+have not converged with one batch of 2 x 2 normal equations. The start values come from the
+linear fit of the Hill plot, log10((1 - f) / f) = n (pH - pKa). Standard errors are taken from
+the covariance of the fit, scaled by the residual variance when the fractions come without
+errors.
+"""
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+
+from constph.atomic import atomic_write
+from constph.constants import LN10
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOLERANCE = 1e-10
+MAX_ITERATIONS = 100
+# fractions are clipped to [CLIP, 1 - CLIP] for the Hill plot of the start values
+CLIP = 0.02
+# smallest Hill coefficient of a fit
+MIN_HILL = 1e-3
+
+TABLE_COLUMNS = ("site", "pKa", "pKa_err", "hill", "hill_err", "points", "rmsd", "converged")
+
+
+@dataclass
+class TitrationFit:
+    pka: np.ndarray
+    pka_err: np.ndarray
+    hill: np.ndarray
+    hill_err: np.ndarray
+    # points per site and root mean square deviation of the fitted fractions
+    points: np.ndarray
+    rmsd: np.ndarray
+    converged: np.ndarray
+    iterations: int
+
+    def __len__(self) -> int:
+        return len(self.pka)
+
+    def protonated_fraction(self, ph) -> np.ndarray:
+        """Fitted protonated fractions, sites x pH values"""
+        return hill_curve(np.asarray(ph, dtype=float), self.pka[:, None], self.hill[:, None])
+
+    def table(self, names=None) -> str:
+        """The fits as a whitespace separated table, one row per site"""
+        names = [str(i) for i in range(len(self))] if names is None else [str(name) for name in names]
+        width = max([len(TABLE_COLUMNS[0])] + [len(name) for name in names])
+        lines = [f"{TABLE_COLUMNS[0]:<{width}}" + "".join(f"{column:>10}" for column in TABLE_COLUMNS[1:])]
+        for i, name in enumerate(names):
+            lines.append(
+                f"{name:<{width}}{self.pka[i]:10.3f}{self.pka_err[i]:10.3f}{self.hill[i]:10.3f}"
+                f"{self.hill_err[i]:10.3f}{self.points[i]:10d}{self.rmsd[i]:10.4f}{str(bool(self.converged[i])):>10}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def write_table(self, path: str, names=None):
+        atomic_write(path, self.table(names))
+
+
+def hill_curve(ph, pka, hill=1.0):
+    """Protonated fraction 1 / (1 + 10^(hill (pH - pKa)))"""
+    x = np.clip(hill * (ph - pka) * LN10, -700.0, 700.0)
+    return 1.0 / (1.0 + np.exp(x))
+
+
+def _start_values(ph, fractions, weights, fit_hill):
+    """pKa and Hill coefficient from the weighted linear fit of the Hill plot"""
+    f = np.clip(fractions, CLIP, 1.0 - CLIP)
+    z = np.log10((1.0 - f) / f)
+    w = weights * f * (1.0 - f)
+    w_sum = w.sum(axis=1)
+    ph_mean = (w * ph).sum(axis=1) / w_sum
+    z_mean = (w * z).sum(axis=1) / w_sum
+    if fit_hill:
+        dph = ph - ph_mean[:, None]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hill = (w * dph * (z - z_mean[:, None])).sum(axis=1) / (w * dph * dph).sum(axis=1)
+        hill = np.where(np.isfinite(hill) & (hill > MIN_HILL), hill, 1.0)
+    else:
+        hill = np.ones(len(ph))
+    pka = ph_mean - z_mean / hill
+    # sites without a transition in the ladder start next to its end
+    ph_masked = np.where(weights > 0, ph, np.nan)
+    return np.clip(pka, np.nanmin(ph_masked, axis=1) - 2.0, np.nanmax(ph_masked, axis=1) + 2.0), hill
+
+
+def _normal_equations(ph, fractions, weights, pka, hill, fit_hill):
+    """chi2, J^T W J and J^T W r of all sites"""
+    m = hill_curve(ph, pka[:, None], hill[:, None])
+    r = fractions - m
+    slope = m * (1.0 - m) * LN10
+    jacobian = [slope * hill[:, None]]
+    if fit_hill:
+        jacobian.append(-slope * (ph - pka[:, None]))
+    jacobian = np.stack(jacobian, axis=-1)
+    weighted = jacobian * weights[..., None]
+    return (
+        (weights * r * r).sum(axis=1),
+        np.einsum("spi,spj->sij", weighted, jacobian),
+        np.einsum("spi,sp->si", weighted, r),
+    )
+
+
+def fit_titration_curves(
+    ph,
+    fractions,
+    errors=None,
+    fit_hill: bool = True,
+    tolerance: float = DEFAULT_TOLERANCE,
+    max_iterations: int = MAX_ITERATIONS,
+) -> TitrationFit:
+    """
+    Fits the Hill equation to the protonated fractions of many sites at once.
+    Parameters
+    ----------
+    ph: np.ndarray
+        pH values, one ladder for all sites or sites x pH values
+    fractions: np.ndarray
+        protonated fractions, sites x pH values, NaN where a site has no estimate
+    errors: np.ndarray
+        standard errors of the fractions (e.g. bootstrap), same shape; None weights all points
+        equally and scales the parameter errors by the residual variance
+    fit_hill: bool
+        fit the Hill coefficient, False fixes it to 1 (Henderson-Hasselbalch)
+    tolerance: float
+        relative change of chi2 at convergence
+    max_iterations: int
+        most Levenberg-Marquardt iterations
+    Returns
+    ----------
+    fit: TitrationFit
+        one entry per site; sites with fewer points than parameters get NaN
+    """
+    fractions = np.atleast_2d(np.asarray(fractions, dtype=float))
+    ph = np.broadcast_to(np.asarray(ph, dtype=float), fractions.shape)
+    weights = np.isfinite(fractions) & np.isfinite(ph)
+    if errors is not None:
+        errors = np.broadcast_to(np.asarray(errors, dtype=float), fractions.shape)
+        weights &= np.isfinite(errors) & (errors > 0)
+        weights = np.where(weights, 1.0 / np.where(weights, errors, 1.0) ** 2, 0.0)
+    else:
+        weights = weights.astype(float)
+    n_params = 2 if fit_hill else 1
+    points = np.count_nonzero(weights, axis=1)
+    valid = points >= n_params
+    if not np.all(valid):
+        logger.warning(f"{np.count_nonzero(~valid)} sites have fewer than {n_params} points and are not fitted")
+    ph = np.where(weights > 0, ph, 0.0)[valid]
+    fractions = np.where(weights > 0, fractions, 0.0)[valid]
+    weights = weights[valid]
+
+    pka, hill = _start_values(ph, fractions, weights, fit_hill)
+    damping = np.full(len(pka), 1e-3)
+    chi2, a, g = _normal_equations(ph, fractions, weights, pka, hill, fit_hill)
+    converged = np.zeros(len(pka), dtype=bool)
+    iteration = 0
+    active = np.arange(len(pka))
+    while iteration < max_iterations and len(active):
+        iteration += 1
+        # (A + lambda diag(A)) delta = g for all sites that are still iterating
+        damped = a[active] * (1.0 + damping[active, None, None] * np.eye(n_params)) + 1e-12 * np.eye(n_params)
+        delta = np.linalg.solve(damped, g[active, :, None])[..., 0]
+        new_pka = pka[active] + delta[:, 0]
+        new_hill = np.maximum(hill[active] + delta[:, 1], MIN_HILL) if fit_hill else hill[active]
+        new_chi2, new_a, new_g = _normal_equations(
+            ph[active], fractions[active], weights[active], new_pka, new_hill, fit_hill
+        )
+        accept = new_chi2 <= chi2[active]
+        done = accept & (chi2[active] - new_chi2 <= tolerance * np.maximum(chi2[active], 1e-300))
+        done |= ~accept & (damping[active] > 1e10)
+        accepted = active[accept]
+        pka[accepted] = new_pka[accept]
+        hill[accepted] = new_hill[accept]
+        chi2[accepted] = new_chi2[accept]
+        a[accepted] = new_a[accept]
+        g[accepted] = new_g[accept]
+        damping[active] = np.where(accept, damping[active] / 10.0, damping[active] * 10.0)
+        converged[active[done]] = True
+        active = active[~done]
+    if not np.all(converged):
+        logger.warning(f"{np.count_nonzero(~converged)} titration fits did not converge in {iteration} iterations")
+
+    dof = points[valid] - n_params
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale = chi2 / dof if errors is None else np.ones(len(pka))
+        scale = np.where(dof > 0, scale, np.nan) if errors is None else scale
+        covariance = np.linalg.inv(a + 1e-12 * np.eye(n_params)) * scale[:, None, None]
+        residuals = (fractions - hill_curve(ph, pka[:, None], hill[:, None])) * (weights > 0)
+        rmsd = np.sqrt((residuals * residuals).sum(axis=1) / points[valid])
+
+    def full(values, fill=np.nan):
+        out = np.full(len(points), fill, dtype=np.asarray(values).dtype)
+        out[valid] = values
+        return out
+
+    return TitrationFit(
+        pka=full(pka),
+        pka_err=full(np.sqrt(covariance[:, 0, 0])),
+        hill=full(hill),
+        hill_err=full(np.sqrt(covariance[:, 1, 1]) if fit_hill else np.zeros(len(pka))),
+        points=points,
+        rmsd=full(rmsd),
+        converged=full(converged, False),
+        iterations=iteration,
+    )
+
+
+def stack_ladders(ladders: dict) -> tuple:
+    """
+    Stacks the pH ladders of many sites into the arrays of fit_titration_curves.
+    Parameters
+    ----------
+    ladders: dict
+        site name -> (pH values, fractions) or (pH values, fractions, errors)
+    Returns
+    ----------
+    names, ph, fractions, errors: tuple
+        site names and sites x pH arrays padded with NaN; errors is None if no site has any
+    """
+    names = list(ladders)
+    width = max((len(ladder[0]) for ladder in ladders.values()), default=0)
+    ph = np.full((len(names), width), np.nan)
+    fractions = np.full((len(names), width), np.nan)
+    errors = np.full((len(names), width), np.nan)
+    with_errors = False
+    for i, ladder in enumerate(ladders.values()):
+        n = len(ladder[0])
+        ph[i, :n] = ladder[0]
+        fractions[i, :n] = ladder[1]
+        if len(ladder) > 2 and ladder[2] is not None:
+            errors[i, :n] = ladder[2]
+            with_errors = True
+    return names, ph, fractions, errors if with_errors else None
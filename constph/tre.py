@@ -0,0 +1,448 @@
+"""
+Streaming reader of GROMOS energy trajectories (*.tre, gzipped or not).
+
+An energy trajectory is a sequence of frames, each starting with a TIMESTEP block followed by
+the ENERGY03 block (and further blocks, e.g. VOLUMEPRESSURE03). The ENERGY03 block is split
+into sections by comment lines (``# totals``, ``# eds``, ...). The reader keeps
+
+- step and time of the TIMESTEP block,
+- selected values of the totals section, by default the A-EDS reference energy (eds_vr) and
+  EMAX/EMIN (eds_emax, eds_emin),
+- the total energy of every end state of the eds section (numstates, then one line per state).
+
+The first frame is parsed line by line, which also gives the position of every value relative
+to the TIMESTEP line. md++ writes all frames of a run with the same layout, so the remaining
+frames are read in chunks of whole frames and converted column-wise with NumPy. A chunk that
+does not follow the layout (a different md++ version, a truncated last frame) is handed back to
+the line-by-line parser, which learns the new layout from the next complete frame.
+"""
+import gzip
+import itertools
+import logging
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from constph.column_cache import read_columns, source_stamp, write_columns
+
+logger = logging.getLogger(__name__)
+
+# position of the values in the totals section of ENERGY03 (md++ ene_ana library, 0-based)
+TOTALS = {
+    "total": 0,
+    "kinetic": 1,
+    "potential": 2,
+    "bonded": 3,
+    "nonbonded": 9,
+    "lj": 10,
+    "crf": 11,
+    "special": 20,
+    "eds_vmix": 33,
+    "eds_vr": 34,
+    "eds_emax": 35,
+    "eds_emin": 36,
+    "eds_globmin": 37,
+    "eds_globminfluc": 38,
+}
+DEFAULT_PROPERTIES = ("eds_vr", "eds_emax", "eds_emin")
+# frames per chunk of the fixed-layout path
+DEFAULT_CHUNK_FRAMES = 10000
+
+# kind and property column names of the columnar cache entries
+CACHE_KIND = "tre"
+PROPERTY_COLUMN = "totals.{}"
+
+TIME_BLOCK = "TIMESTEP"
+ENERGY_BLOCK = "ENERGY03"
+# comment lines that open a section of the energy block, other comments belong to the section
+SECTIONS = {"totals", "baths", "bonded", "nonbonded", "special", "eds"}
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+@dataclass
+class EnergyTrajectory:
+    step: np.ndarray
+    time: np.ndarray
+    # frames x states, total energy of every end state
+    states: np.ndarray
+    # name -> values per frame, see TOTALS
+    properties: dict
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    @property
+    def e_ref(self) -> np.ndarray:
+        """Energy of the A-EDS reference state"""
+        return self.properties["eds_vr"]
+
+
+def open_trajectory(path: str, mode: str = "rt"):
+    """Opens a trajectory, gzip-compressed files are recognized by their magic bytes"""
+    with open(path, "rb") as f:
+        compressed = f.read(2) == _GZIP_MAGIC
+    if compressed:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class _Layout(object):
+    def __init__(self, length: int, markers: list, timestep: tuple, properties: list, states: list):
+        """
+        Positions of the values of a frame, relative to its TIMESTEP line.
+        Parameters
+        ----------
+        length: int
+            lines per frame
+        markers: list
+            (offset, line) of the block names, END lines and section comments; a frame follows
+            the layout if all of them are found at their offsets
+        timestep: tuple
+            (offset, tokens) of the step/time line
+        properties: list
+            (offset, token, tokens) of each selected totals value
+        states: list
+            (offset, tokens) of each end state line
+        """
+
+        self.length = length
+        self.markers = markers
+        self.timestep = timestep
+        self.properties = properties
+        self.states = states
+
+    def count_matching(self, lines: list, n: int) -> int:
+        """Number of leading frames of lines that follow the layout"""
+        matching = n
+        for offset, text in self.markers:
+            column = lines[offset:matching * self.length:self.length]
+            if column != [text] * matching:
+                matching = next(i for i, line in enumerate(column) if line != text)
+                if matching == 0:
+                    break
+        return matching
+
+    def parse(self, lines: list, n: int):
+        """Values of the first n frames of lines, None if a value line is malformed"""
+        columns = {}
+
+        def column(offset, tokens):
+            if offset not in columns:
+                values = np.fromstring(" ".join(lines[offset:n * self.length:self.length]), sep=" ")
+                columns[offset] = values.reshape(n, tokens) if values.size == n * tokens else None
+            return columns[offset]
+
+        needed = [self.timestep] + [(offset, tokens) for offset, _, tokens in self.properties] + self.states
+        if any(column(offset, tokens) is None for offset, tokens in needed):
+            return None
+        timestep = column(*self.timestep)
+        properties = [column(offset, tokens)[:, token] for offset, token, tokens in self.properties]
+        states = [column(offset, tokens)[:, 0] for offset, tokens in self.states]
+        return (
+            timestep[:, 0].astype(np.int64),
+            timestep[:, 1].copy(),
+            np.column_stack(states) if states else np.empty((n, 0)),
+            np.column_stack(properties) if properties else np.empty((n, 0)),
+        )
+
+
+class _FrameParser(object):
+    def __init__(self, properties=DEFAULT_PROPERTIES):
+        """
+        Line-by-line state machine over the blocks of an energy trajectory.
+        feed returns every completed frame as (step, time, properties, states). Once a frame
+        is complete and the TIMESTEP line of the next one is fed, its layout is available.
+        """
+
+        self.indices = [TOTALS[name] for name in properties]
+        self.reset()
+
+    def reset(self):
+        self.block = None
+        # line index in the current frame, -1 before the first TIMESTEP
+        self.line = -1
+        self.layout = None
+        self._completed = None
+        self._start_frame()
+
+    def _start_frame(self):
+        self.section = None
+        self.timestep = None
+        self.totals = []
+        self.eds = []
+        self.markers = []
+
+    def feed(self, line: str):
+        if self.line >= 0:
+            self.line += 1
+        stripped = line.strip()
+        if self.block is None:
+            if not stripped or stripped.startswith("#"):
+                return None
+            if stripped == TIME_BLOCK:
+                if self._completed is not None:
+                    self.layout = _Layout(self.line, *self._completed)
+                    self._completed = None
+                self.line = 0
+                self._start_frame()
+            self.block = stripped
+            if self.line >= 0:
+                self.markers.append((self.line, line))
+            return None
+
+        if stripped == "END":
+            block, self.block = self.block, None
+            if self.line >= 0:
+                self.markers.append((self.line, line))
+                if block == ENERGY_BLOCK and self.timestep is not None:
+                    return self._frame()
+            return None
+        if self.line < 0 or not stripped:
+            return None
+
+        if self.block == TIME_BLOCK:
+            if self.timestep is None and not stripped.startswith("#"):
+                self.timestep = (self.line, stripped.split())
+        elif self.block == ENERGY_BLOCK:
+            if stripped.startswith("#"):
+                words = stripped[1:].split()
+                if words and words[0].lower() in SECTIONS:
+                    self.section = words[0].lower()
+                    self.markers.append((self.line, line))
+            elif self.section == "totals":
+                tokens = stripped.split()
+                self.totals.extend((value, self.line, j, len(tokens)) for j, value in enumerate(tokens))
+            elif self.section == "eds":
+                self.eds.append((self.line, stripped.split()))
+        return None
+
+    def _frame(self):
+        if self.indices and max(self.indices) >= len(self.totals):
+            raise ValueError(f"Energy frame with {len(self.totals)} totals, expected at least {max(self.indices) + 1}")
+        totals = [self.totals[i] for i in self.indices]
+        states = []
+        if self.eds:
+            nstates = int(self.eds[0][1][0])
+            states = self.eds[1:1 + nstates]
+            if len(states) != nstates:
+                raise ValueError(f"Energy frame with {len(states)} of {nstates} end states")
+        offset, tokens = self.timestep
+        self._completed = (
+            self.markers,
+            (offset, len(tokens)),
+            [(line, token, n) for _, line, token, n in totals],
+            [(line, len(values)) for line, values in states],
+        )
+        return (
+            int(float(tokens[0])),
+            float(tokens[1]),
+            [float(value) for value, *_ in totals],
+            [float(values[0]) for _, values in states],
+        )
+
+
+def _frames_to_arrays(frames: list, n_properties: int):
+    step = np.array([frame[0] for frame in frames], dtype=np.int64)
+    time = np.array([frame[1] for frame in frames], dtype=float)
+    states = np.array([frame[3] for frame in frames], dtype=float).reshape(len(frames), -1)
+    properties = np.array([frame[2] for frame in frames], dtype=float).reshape(len(frames), n_properties)
+    return step, time, states, properties
+
+
+class _FrameBuffer(object):
+    def __init__(self, properties: tuple, capacity: int = 1024):
+        """Preallocated step, time, end-state and property arrays, grown geometrically"""
+
+        self.properties = properties
+        self.capacity = capacity
+        self.arrays = None
+        self.n = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def append(self, step, time, states, values):
+        k = len(time)
+        if self.arrays is None:
+            self.arrays = [
+                np.empty((max(self.capacity, k),) + array.shape[1:], dtype=array.dtype)
+                for array in (step, time, states, values)
+            ]
+        elif states.shape[1] != self.arrays[2].shape[1]:
+            raise ValueError(f"{states.shape[1]} end states from step {step[0]} on, {self.arrays[2].shape[1]} before")
+        if self.n + k > len(self.arrays[0]):
+            capacity = max(2 * len(self.arrays[0]), self.n + k)
+            self.arrays = [np.resize(array, (capacity,) + array.shape[1:]) for array in self.arrays]
+        for array, value in zip(self.arrays, (step, time, states, values)):
+            array[self.n:self.n + k] = value
+        self.n += k
+
+    def trajectory(self, copy: bool = True) -> EnergyTrajectory:
+        """The frames so far, copies (releasing the spare capacity) or views"""
+        if self.arrays is None:
+            return EnergyTrajectory(
+                np.empty(0, dtype=np.int64),
+                np.empty(0),
+                np.empty((0, 0)),
+                {name: np.empty(0) for name in self.properties},
+            )
+        step, time, states, values = [array[:self.n].copy() if copy else array[:self.n] for array in self.arrays]
+        return EnergyTrajectory(step, time, states, dict(zip(self.properties, values.T)))
+
+
+def _iter_arrays(lines, parser: _FrameParser, chunk_frames: int):
+    """
+    Yields (step, time, states, properties) arrays of up to chunk_frames frames. The parser
+    keeps the state of a frame that is not complete at the end of lines, feeding it the lines
+    that follow continues that frame.
+    """
+    lines = iter(lines)
+    while True:
+        # line by line until the layout is known
+        frames = []
+        pushback = None
+        for line in lines:
+            frame = parser.feed(line)
+            if frame is not None:
+                frames.append(frame)
+            if parser.layout is not None:
+                pushback = line
+                break
+            if len(frames) >= chunk_frames:
+                break
+        if frames:
+            yield _frames_to_arrays(frames, len(parser.indices))
+        if pushback is None:
+            if not frames:
+                return
+            continue
+
+        # whole frames at once, as long as they follow the layout
+        layout = parser.layout
+        parser.reset()
+        chunk = [pushback]
+        while True:
+            chunk.extend(itertools.islice(lines, chunk_frames * layout.length - len(chunk)))
+            n = layout.count_matching(chunk, len(chunk) // layout.length)
+            arrays = layout.parse(chunk, n) if n else None
+            if arrays is None:
+                n = 0
+            else:
+                yield arrays
+            if n < chunk_frames:
+                break
+            chunk = []
+        # the rest goes back to the line-by-line parser
+        lines = itertools.chain(chunk[n * layout.length:], lines)
+
+
+def iter_tre(path: str, properties=DEFAULT_PROPERTIES, chunk_frames: int = DEFAULT_CHUNK_FRAMES):
+    """
+    Streams an energy trajectory in chunks, memory does not grow with the file.
+    Parameters
+    ----------
+    path: str
+        *.tre file, gzip-compressed or not
+    properties: tuple
+        names of the totals values to keep, see TOTALS
+    chunk_frames: int
+        frames per chunk
+    Returns
+    ----------
+    chunks: generator
+        EnergyTrajectory objects of up to chunk_frames frames
+    """
+    properties = tuple(properties)
+    with open_trajectory(path) as f:
+        for step, time, states, values in _iter_arrays(f, _FrameParser(properties), chunk_frames):
+            yield EnergyTrajectory(step, time, states, dict(zip(properties, values.T)))
+
+
+def _estimate_frames(path: str, bytes_per_frame: int) -> int:
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if f.read(2) == _GZIP_MAGIC:
+            # ISIZE: uncompressed size modulo 2**32
+            f.seek(-4, os.SEEK_END)
+            size = max(int.from_bytes(f.read(4), "little"), size)
+    return size // max(bytes_per_frame, 1) + 1
+
+
+def read_tre(
+    path: str,
+    properties=DEFAULT_PROPERTIES,
+    chunk_frames: int = DEFAULT_CHUNK_FRAMES,
+    use_cache: bool = True,
+    cache_dir: str = None,
+) -> EnergyTrajectory:
+    """
+    Reads an energy trajectory into one EnergyTrajectory.
+    The parsed columns are cached (see constph.column_cache), later reads of the unchanged file
+    memory-map them instead of parsing the text again.
+    Parameters
+    ----------
+    path: str
+        *.tre file, gzip-compressed or not
+    properties: tuple
+        names of the totals values to keep, see TOTALS
+    chunk_frames: int
+        frames per chunk while reading
+    use_cache: bool
+        read and write the columnar cache
+    cache_dir: str
+        directory of the cache, None is a .constph_cache directory next to the file
+    """
+    properties = tuple(properties)
+    if not use_cache:
+        return _parse_tre(path, properties, chunk_frames)
+
+    columns = read_columns(path, CACHE_KIND, cache_dir)
+    if columns is not None and all(PROPERTY_COLUMN.format(name) in columns for name in properties):
+        logger.info(f"Read {len(columns['time'])} frames of {path} from the cache")
+        return EnergyTrajectory(
+            columns["step"],
+            columns["time"],
+            columns["states"],
+            {name: columns[PROPERTY_COLUMN.format(name)] for name in properties},
+        )
+
+    # the cache keeps the properties read before as well
+    if columns is not None:
+        cached = [column.split(".", 1)[1] for column in columns if column.startswith(PROPERTY_COLUMN.format(""))]
+        properties_read = properties + tuple(name for name in cached if name not in properties)
+    else:
+        properties_read = properties
+    # stamped before parsing: a trajectory that grows meanwhile is not cached
+    stamp = source_stamp(path)
+    tre = _parse_tre(path, properties_read, chunk_frames)
+    columns = {"step": tre.step, "time": tre.time, "states": tre.states}
+    columns.update({PROPERTY_COLUMN.format(name): values for name, values in tre.properties.items()})
+    write_columns(path, CACHE_KIND, columns, cache_dir, stamp)
+    tre.properties = {name: tre.properties[name] for name in properties}
+    return tre
+
+
+def _parse_tre(path: str, properties: tuple, chunk_frames: int) -> EnergyTrajectory:
+    """
+    Parses an energy trajectory. The arrays are preallocated from an estimate of the frames
+    in the file (its uncompressed size over a typical frame size) and grown if the estimate was
+    too small, so no per-frame Python objects are kept.
+    """
+    frames = None
+    with open_trajectory(path) as f:
+        for step, time, states, values in _iter_arrays(f, _FrameParser(properties), chunk_frames):
+            if frames is None:
+                # a frame of md++ text output is about 30 bytes per value line
+                capacity = _estimate_frames(path, 30 * (len(TOTALS) + states.shape[1] + 8))
+                frames = _FrameBuffer(properties, capacity)
+            try:
+                frames.append(step, time, states, values)
+            except ValueError as e:
+                raise ValueError(f"{path}: {e}, read it with iter_tre")
+    if frames is None:
+        return _FrameBuffer(properties).trajectory()
+    logger.info(f"Read {len(frames)} frames from {path}")
+    # copies, so the overallocated arrays are released
+    return frames.trajectory()
@@ -0,0 +1,96 @@
+"""
+Box-aware choice of the PAIRLIST cutoffs and the lattice-sum grid of the NONBONDED block.
+
+The box is read from the GENBOX block of the coordinate file (*.cnf). The grid gets one point
+per target spacing in every direction, rounded up to a size with only the prime factors 2, 3
+and 5 (fast FFTs), and the cutoffs are limited to half the shortest box edge (minimum image).
+"""
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+# values of the templates, used as upper limits of the cutoffs
+DEFAULT_PAIRLIST = {"RCUTP": 0.8, "RCUTL": 1.4, "SIZE": 0.4, "RCRF": 1.4, "NGX": 32, "NGY": 32, "NGZ": 32}
+# target lattice-sum grid spacing, nm
+DEFAULT_GRID_SPACING = 0.1
+# smallest grid size per dimension
+MIN_GRID = 8
+
+
+def read_box(cnf_file: str) -> tuple:
+    """
+    Returns the box edge lengths (nm) of the GENBOX block of a GROMOS coordinate file.
+    The file is streamed, only the GENBOX block is parsed.
+    """
+    with open(cnf_file) as f:
+        for line in f:
+            if line.strip() == "GENBOX":
+                break
+        else:
+            raise ValueError(f"No GENBOX block in {cnf_file}")
+        values = []
+        for line in f:
+            stripped = line.strip()
+            if stripped == "END":
+                break
+            if stripped and not stripped.startswith("#"):
+                values.append(stripped.split())
+    # GENBOX: NTB, edge lengths, angles, euler angles, origin
+    if len(values) < 2 or len(values[1]) != 3:
+        raise ValueError(f"Malformed GENBOX block in {cnf_file}")
+    return tuple(float(length) for length in values[1])
+
+
+def fft_friendly(n: int) -> int:
+    """Smallest number >= n without prime factors other than 2, 3 and 5"""
+    n = max(int(n), 1)
+    while True:
+        m = n
+        for factor in (2, 3, 5):
+            while m % factor == 0:
+                m //= factor
+        if m == 1:
+            return n
+        n += 1
+
+
+def tune_nonbonded(
+    box: tuple,
+    grid_spacing: float = DEFAULT_GRID_SPACING,
+    rcutp: float = DEFAULT_PAIRLIST["RCUTP"],
+    rcutl: float = DEFAULT_PAIRLIST["RCUTL"],
+) -> dict:
+    """
+    Picks pairlist cutoffs and lattice-sum grid dimensions for a rectangular box.
+    Parameters
+    ----------
+    box: tuple
+        box edge lengths in nm
+    grid_spacing: float
+        target grid spacing in nm
+    rcutp, rcutl: float
+        short- and long-range cutoff to use when the box is large enough
+    Returns
+    ----------
+    fields: dict
+        RCUTP, RCUTL, SIZE and RCRF (nm), NGX, NGY, NGZ
+    """
+    if any(length <= 0 for length in box):
+        raise ValueError(f"Invalid box: {box}")
+    # minimum image: no cutoff may exceed half of the shortest edge
+    limit = math.floor(min(box) / 2 * 100) / 100
+    rcutl = min(rcutl, limit)
+    rcutp = min(rcutp, rcutl)
+    grid = [max(fft_friendly(math.ceil(round(length / grid_spacing, 6))), MIN_GRID) for length in box]
+    return {
+        "RCUTP": round(rcutp, 3),
+        "RCUTL": round(rcutl, 3),
+        # grid cell size of the grid-based pairlist
+        "SIZE": round(rcutp / 2, 3),
+        # the reaction field acts beyond the long-range cutoff
+        "RCRF": round(rcutl, 3),
+        "NGX": grid[0],
+        "NGY": grid[1],
+        "NGZ": grid[2],
+    }
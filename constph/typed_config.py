@@ -0,0 +1,165 @@
+"""
+Typed view of the configuration dictionary.
+
+The dataclasses are generated from a schema (an example configuration) once per schema
+version. Every class gets ``__slots__`` and a ``from_dict`` constructor that is specialized to
+the schema, so building a typed config is a handful of plain constructor calls instead of the
+per-call reflection of dacite.
+"""
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+
+from constph.atomic import atomic_write
+from constph.utils import CodeBlock, get_bin_dir, get_cache_dir, load_config_yaml
+
+logger = logging.getLogger(__name__)
+
+ROOT_CLASS = "input_dataclass"
+SCHEMA_FILE = "dataclass_structure.yaml"
+GENERATED_FILE = "dataclass.py"
+
+# generated modules of this process, keyed by schema version
+_modules = {}
+
+
+def default_schema() -> dict:
+    """Returns the schema shipped in the bin directory, wrapped in the root class"""
+    configuration = load_config_yaml(
+        config=os.path.join(get_bin_dir(), SCHEMA_FILE), input_dir=".", output_dir=get_bin_dir()
+    )
+    return {ROOT_CLASS: configuration}
+
+
+def _type_name(value) -> str:
+    if value is None:
+        return "object"
+    return type(value).__name__
+
+
+def schema_tree(configuration: dict) -> dict:
+    """Reduces an example configuration to its layout: nested dicts of field name -> type name"""
+    return {
+        key: schema_tree(value) if isinstance(value, dict) else _type_name(value)
+        for key, value in configuration.items()
+    }
+
+
+def schema_version(configuration: dict) -> str:
+    """Hash of the schema layout, field order included since from_dict passes fields by position"""
+    tree = json.dumps(schema_tree(configuration)).encode()
+    return hashlib.sha256(tree).hexdigest()[:16]
+
+
+def _class_blocks(name: str, tree: dict, classes: dict, parent: str = "") -> str:
+    """Collects the class definitions of tree and its children in classes, returns the class name"""
+    fields = []
+    arguments = []
+    for key, value in tree.items():
+        if isinstance(value, dict):
+            child = _class_blocks(key, value, classes, parent=name)
+            fields.append(f"{key}: {child}")
+            arguments.append(f"{child}.from_dict(data['{key}'])")
+        else:
+            fields.append(f"{key}: {value}")
+            arguments.append(f"data['{key}']")
+
+    # the same key on different levels with a different layout gets the parent's name as prefix
+    class_name = name
+    if class_name in classes and classes[class_name][0] != tree:
+        class_name = f"{parent}_{name}"
+
+    slots = ", ".join(f"'{key}'" for key in tree) + ("," if len(tree) == 1 else "")
+    from_dict = CodeBlock("def from_dict(cls, data)", ["return cls(" + ", ".join(arguments) + ")"])
+    block = [f"__slots__ = ({slots})"] + fields + ["@classmethod", from_dict]
+    classes[class_name] = (tree, "@dataclass\n" + str(CodeBlock(f"class {class_name}", block)))
+    return class_name
+
+
+def generate_source(configuration: dict) -> str:
+    """
+    Generates the source of the typed config module for a schema.
+    Parameters
+    ----------
+    configuration: dict
+        example configuration with a single root key, e.g. {'input_dataclass': settingsMap}
+    Returns
+    ----------
+    source: str
+    """
+    tree = schema_tree(configuration)
+    classes = {}
+    for name, value in tree.items():
+        _class_blocks(name, value, classes)
+
+    header = (
+        "# Generated by constph.typed_config, do not edit.\n"
+        "# flake8: noqa\n"
+        "from dataclasses import dataclass\n\n"
+        f"SCHEMA_VERSION = '{schema_version(configuration)}'\n\n"
+        "#dataclass\n"
+    )
+    return header + "".join(code for _, code in classes.values())
+
+
+def _import_from_path(path: str, module_name: str):
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_typed_config_module(configuration: dict = None, cache_dir: str = None):
+    """
+    Returns the typed config module for a schema, generating it only if no module for this
+    schema version exists yet. The module shipped in the bin directory is used when it matches,
+    otherwise the module is generated once into the cache directory.
+    Parameters
+    ----------
+    configuration: dict
+        schema, defaults to default_schema()
+    cache_dir: str
+        location of generated modules, defaults to get_cache_dir()
+    """
+    if configuration is None:
+        configuration = default_schema()
+    version = schema_version(configuration)
+    if version in _modules:
+        return _modules[version]
+
+    shipped = os.path.join(get_bin_dir(), GENERATED_FILE)
+    module = None
+    if os.path.isfile(shipped):
+        module = _import_from_path(shipped, "constph_typed_config")
+        if getattr(module, "SCHEMA_VERSION", None) != version:
+            module = None
+
+    if module is None:
+        path = os.path.join(cache_dir or get_cache_dir(), "typed_config", f"typed_config_{version}.py")
+        if not os.path.isfile(path):
+            logger.info(f"Generating typed config for schema {version}: {path}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, generate_source(configuration), durable=False)
+        module = _import_from_path(path, f"constph_typed_config_{version}")
+
+    _modules[version] = module
+    return module
+
+
+def build_typed_config(settingsMap: dict, module=None):
+    """
+    Builds the typed config of a settings map obtained with utils.load_config_yaml.
+    Parameters
+    ----------
+    settingsMap: dict
+    module:
+        typed config module, defaults to the one of the shipped schema
+    Returns
+    ----------
+    config: input_dataclass
+    """
+    if module is None:
+        module = load_typed_config_module()
+    return getattr(module, ROOT_CLASS).from_dict(settingsMap)
@@ -0,0 +1,238 @@
+"""
+Uncertainties of free energies and pKa values: autocorrelation, block averaging and bootstrap.
+
+Bootstrap resamples are drawn in batches. A batch is a (resamples x frames) matrix of counts,
+how often each frame is drawn, so estimators that are weighted sums over frames (EXP) evaluate a
+whole batch with one matrix product. Batches run in a process pool; the input arrays are placed
+in shared memory once and mapped by every worker instead of being copied to it. Every batch
+draws from its own child of one SeedSequence, so the resamples depend on the seed and the batch
+size only, not on the number of workers.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from constph.constants import BOLTZMANN, DEFAULT_SEED, DEFAULT_TEMPERATURE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESAMPLES = 1000
+# resamples per batch, each batch holds a resamples x frames count matrix
+DEFAULT_BATCH_SIZE = 16
+
+
+def autocorrelation(x: np.ndarray, max_lag: int = None) -> np.ndarray:
+    """Normalized autocorrelation C_t of a time series for t = 0 .. max_lag, computed by FFT"""
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    max_lag = n - 1 if max_lag is None else min(max_lag, n - 1)
+    dx = x - x.mean()
+    variance = np.dot(dx, dx) / n
+    if variance == 0.0:
+        return np.ones(max_lag + 1)
+    size = 1 << (2 * n - 1).bit_length()
+    spectrum = np.fft.rfft(dx, size)
+    covariance = np.fft.irfft(spectrum * np.conj(spectrum), size)[:max_lag + 1]
+    return covariance / (variance * np.arange(n, n - max_lag - 1, -1))
+
+
+def statistical_inefficiency(x: np.ndarray) -> float:
+    """
+    Statistical inefficiency g = 1 + 2 sum_t (1 - t/N) C_t of a time series, with C_t summed
+    up to its first non-positive value.
+    """
+    n = len(x)
+    if n < 3:
+        return 1.0
+    correlation = autocorrelation(x)[1:]
+    stop = np.flatnonzero(correlation <= 0.0)
+    t = np.arange(1, (stop[0] if len(stop) else n - 1) + 1)
+    return max(1.0, 1.0 + 2.0 * float(np.sum((1.0 - t / n) * correlation[:len(t)])))
+
+
+def subsample_indices(x: np.ndarray, g: float = None) -> np.ndarray:
+    """Indices of uncorrelated frames of a time series, every ceil(g)-th frame"""
+    g = statistical_inefficiency(x) if g is None else g
+    return np.arange(0, len(x), int(np.ceil(g)))
+
+
+@dataclass
+class BlockAnalysis:
+    block_sizes: np.ndarray
+    # standard error of the mean from the block means, per block size
+    standard_errors: np.ndarray
+    # statistical inefficiency at the plateau of the standard error
+    statistical_inefficiency: float
+
+
+def block_average(x: np.ndarray, min_blocks: int = 16) -> BlockAnalysis:
+    """
+    Block averaging over block sizes 1, 2, 4, ... with at least min_blocks blocks. The
+    standard error of the mean grows with the block size until the blocks are uncorrelated;
+    the plateau value over the naive standard error, squared, is the statistical inefficiency.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    variance = x.var()
+    sizes = []
+    errors = []
+    size = 1
+    while n // size >= min_blocks:
+        blocks = n // size
+        means = x[:blocks * size].reshape(blocks, size).mean(axis=1)
+        sizes.append(size)
+        errors.append(np.sqrt(means.var(ddof=1) / blocks))
+        size *= 2
+    sizes = np.array(sizes)
+    errors = np.array(errors)
+    if len(errors) == 0 or variance == 0.0:
+        return BlockAnalysis(sizes, errors, 1.0)
+    # plateau: mean of the errors from the first size whose error is no longer growing by > 5 %
+    growing = np.flatnonzero(errors[1:] > 1.05 * errors[:-1])
+    start = growing[-1] + 1 if len(growing) else 0
+    plateau = errors[start:].mean()
+    return BlockAnalysis(sizes, errors, max(1.0, plateau ** 2 * n / variance))
+
+
+@dataclass
+class BootstrapResult:
+    # one row of estimates per resample
+    samples: np.ndarray
+
+    @property
+    def mean(self) -> np.ndarray:
+        return self.samples.mean(axis=0)
+
+    @property
+    def std(self) -> np.ndarray:
+        return self.samples.std(axis=0, ddof=1)
+
+    def confidence_interval(self, level: float = 0.95) -> tuple:
+        """Percentile interval of the resampled estimates"""
+        tail = (1.0 - level) / 2.0 * 100.0
+        return tuple(np.percentile(self.samples, [tail, 100.0 - tail], axis=0))
+
+
+def resample_counts(rng: np.random.Generator, n_frames: int, n_resamples: int, block_length: int = 1) -> np.ndarray:
+    """
+    How often every frame is drawn in each of n_resamples bootstrap resamples, resamples x
+    frames. With block_length > 1 whole blocks of consecutive frames are drawn (moving-block
+    bootstrap of correlated data); frames after the last full block are not used.
+    """
+    n_blocks = n_frames // block_length
+    counts = np.zeros((n_resamples, n_frames))
+    for row in counts:
+        drawn = np.bincount(rng.integers(0, n_blocks, n_blocks), minlength=n_blocks)
+        row[:n_blocks * block_length] = np.repeat(drawn, block_length) if block_length > 1 else drawn
+    return counts
+
+
+def exp_statistic(
+    counts: np.ndarray, e_states: np.ndarray, e_ref: np.ndarray, temperature: float = DEFAULT_TEMPERATURE
+) -> np.ndarray:
+    """
+    EXP free energies of the end states relative to the first one, for every row of counts
+    (resamples x frames): one matrix product over the shifted Boltzmann factors.
+    """
+    kT = BOLTZMANN * temperature
+    reduced = (e_ref[:, None] - e_states) / kT
+    amax = reduced.max(axis=0)
+    np.exp(reduced - amax, out=reduced)
+    free_energies = -kT * (np.log(counts @ reduced) + amax - np.log(counts.sum(axis=1))[:, None])
+    return free_energies - free_energies[:, :1]
+
+
+def index_statistic(counts: np.ndarray, *arrays, function=None) -> np.ndarray:
+    """
+    Evaluates function(*resampled arrays) for every row of counts, for estimators that are not
+    weighted sums (e.g. MBAR); use with functools.partial(index_statistic, function=...).
+    """
+    frames = np.arange(counts.shape[1])
+    return np.array([function(*[array[np.repeat(frames, row.astype(int))] for array in arrays]) for row in counts])
+
+
+# shared arrays of a worker, attached once by the pool initializer
+_worker_arrays = None
+_worker_memory = None
+
+
+def _attach(specs: list):
+    global _worker_arrays, _worker_memory
+    _worker_memory = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    _worker_arrays = [
+        np.ndarray(shape, dtype=np.dtype(dtype), buffer=memory.buf)
+        for memory, (_, shape, dtype) in zip(_worker_memory, specs)
+    ]
+
+
+def _run_batch(statistic, seed: np.random.SeedSequence, size: int, block_length: int, arrays=None):
+    arrays = _worker_arrays if arrays is None else arrays
+    counts = resample_counts(np.random.default_rng(seed), len(arrays[0]), size, block_length)
+    return np.asarray(statistic(counts, *arrays))
+
+
+def bootstrap(
+    statistic,
+    arrays: list,
+    n_resamples: int = DEFAULT_RESAMPLES,
+    seed: int = DEFAULT_SEED,
+    n_workers: int = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    block_length: int = 1,
+) -> BootstrapResult:
+    """
+    Bootstrap estimates of a statistic over frames.
+    Parameters
+    ----------
+    statistic: callable
+        statistic(counts, *arrays) -> one row of estimates per row of counts (resamples x
+        frames), e.g. exp_statistic or partial(index_statistic, function=...); must be
+        picklable (a module-level function or a partial of one)
+    arrays: list
+        input arrays, frames along the first axis
+    n_resamples: int
+        number of resamples
+    seed: int
+        seed of the resamples, the result does not depend on n_workers
+    n_workers: int
+        worker processes, None uses all CPUs, 1 runs in this process
+    batch_size: int
+        resamples per batch
+    block_length: int
+        frames per resampled block, e.g. ceil of the statistical inefficiency
+    Returns
+    ----------
+    result: BootstrapResult
+    """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    sizes = [batch_size] * (n_resamples // batch_size)
+    if n_resamples % batch_size:
+        sizes.append(n_resamples % batch_size)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    n_workers = min(n_workers or os.cpu_count() or 1, len(sizes))
+
+    if n_workers <= 1:
+        batches = [_run_batch(statistic, s, size, block_length, arrays) for s, size in zip(seeds, sizes)]
+        return BootstrapResult(np.concatenate(batches))
+
+    memory = []
+    try:
+        specs = []
+        for array in arrays:
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            memory.append(block)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            specs.append((block.name, array.shape, array.dtype.str))
+        with ProcessPoolExecutor(n_workers, initializer=_attach, initargs=(specs,)) as pool:
+            batches = list(pool.map(partial(_run_batch, statistic, block_length=block_length), seeds, sizes))
+    finally:
+        for block in memory:
+            block.close()
+            block.unlink()
+    logger.info(f"Bootstrap: {n_resamples} resamples of {len(arrays[0])} frames on {n_workers} workers")
+    return BootstrapResult(np.concatenate(batches))
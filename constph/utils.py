@@ -1,33 +1,175 @@
 #packages
+import hashlib
+import json
+import logging
 import os
+import pickle
 import yaml
 from dataclasses import dataclass
-from dacite import from_dict
+
+from constph.atomic import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the layout of the cached settings map changes
+CONFIG_CACHE_VERSION = 2
+
 
 #stuff
 def get_bin_dir():
     """Returns the bin directory of this package"""
     return os.path.abspath(os.path.join(os.path.dirname(__file__), 'bin'))
 
-def load_config_yaml(config, input_dir, output_dir):
 
-    with open(f"{config}", 'r') as stream:
-        try:
-            settingsMap = yaml.load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
+def get_cache_dir():
+    """Returns the directory used for on-disk caches (``$CONSTPH_CACHE_DIR`` or ``~/.cache/constph``)"""
+    cache_dir = os.environ.get('CONSTPH_CACHE_DIR')
+    if not cache_dir:
+        cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'constph')
+    return os.path.abspath(cache_dir)
 
-    # set the bin, data and analysis dir
+
+def get_yaml_loader():
+    """Returns the C-accelerated (libyaml) safe loader if available, the pure-Python one otherwise"""
+    return getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _resolve_settings(settingsMap, input_dir, output_dir):
+    """Sets the bin, data, analysis and system directories of a parsed settings map"""
     settingsMap['bin_dir'] = get_bin_dir()
-    print (settingsMap['bin_dir'])
     settingsMap['analysis_dir_base'] = os.path.abspath(f"{output_dir}")
     settingsMap['data_dir_base'] = os.path.abspath(f"{input_dir}")
     system_name = f"{settingsMap['system']['structure']['name']}"
     settingsMap['system_dir'] = f"{settingsMap['analysis_dir_base']}/{system_name}"
     settingsMap['system']['name'] = system_name
-
     return settingsMap
 
+
+# pickled yaml payloads of this process, keyed like the on-disk (JSON) cache
+_settings_cache = {}
+
+
+def _settings_cache_key(content, *parts):
+    """Hash of the raw yaml content and everything else the cached object depends on"""
+    digest = hashlib.sha256()
+    digest.update(f"{CONFIG_CACHE_VERSION}:{yaml.__version__}".encode())
+    for part in parts:
+        digest.update(b'\0' + str(part).encode())
+    digest.update(b'\0' + content)
+    return digest.hexdigest()
+
+
+def _read_cache_entry(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_cache_entry(path, data):
+    """Writes a cache entry; a cache that can not be written is only worth a debug message"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, data, durable=False)
+    except OSError as exc:
+        logger.debug(f"Could not write config cache {path}: {exc}")
+
+
+def _load_yaml_cached(config, build, key_parts, use_cache=True, cache_dir=None):
+    """
+    Parses a yaml file, post-processes it with build and caches the result in memory and on disk.
+    Parameters
+    ----------
+    config: str
+        path to the yaml file
+    build: callable
+        turns the parsed yaml into the object that is cached
+    key_parts: tuple
+        everything besides the file content the result of build depends on
+    Returns
+    ----------
+    a fresh copy of the built object
+    """
+
+    with open(f"{config}", 'rb') as stream:
+        content = stream.read()
+    if not use_cache:
+        return build(yaml.load(content, Loader=get_yaml_loader()))
+
+    key = _settings_cache_key(content, *key_parts)
+    cached = _settings_cache.get(key)
+    if cached is None:
+        # the on-disk cache is JSON: a cache directory others can write to must not run code
+        cache_path = os.path.join(cache_dir or get_cache_dir(), 'config', f"{key}.json")
+        stored = _read_cache_entry(cache_path)
+        if stored is not None:
+            try:
+                result = json.loads(stored)
+                logger.debug(f"{config} loaded from cache {cache_path}")
+                _settings_cache[key] = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+                return result
+            except ValueError:
+                logger.debug(f"Ignoring unreadable config cache {cache_path}")
+        result = build(yaml.load(content, Loader=get_yaml_loader()))
+        try:
+            stored = json.dumps(result)
+        except (TypeError, ValueError):
+            stored = None
+        if stored is not None and json.loads(stored) == result:
+            _write_cache_entry(cache_path, stored.encode())
+        else:
+            # dates, non-string keys: kept in memory only
+            logger.debug(f"{config} does not round-trip through JSON, not cached on disk")
+        cached = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        _settings_cache[key] = cached
+
+    # unpickling the in-process copy hands out an independent copy on every call
+    return pickle.loads(cached)
+
+
+def load_yaml(config, use_cache=True, cache_dir=None):
+    """
+    Parses a yaml file through the same content-hash cache as load_config_yaml.
+    Parameters
+    ----------
+    config: str
+        path to the yaml file
+    Returns
+    ----------
+    data: dict
+    """
+    return _load_yaml_cached(config, lambda data: data, ('yaml',), use_cache, cache_dir)
+
+
+def load_config_yaml(config, input_dir, output_dir, use_cache=True, cache_dir=None):
+    """
+    Loads a configuration yaml and resolves the bin, data, analysis and system directories.
+    The resolved settings map is cached in memory and on disk, keyed by the sha256 of the
+    file content and the resolved directories, so an unchanged config is only parsed once.
+    Parameters
+    ----------
+    config: str
+        path to the yaml file
+    input_dir: str
+        directory the input data is read from
+    output_dir: str
+        directory the systems are set up in
+    use_cache: bool
+        read and write the settings cache
+    cache_dir: str
+        location of the on-disk cache, defaults to get_cache_dir()
+    Returns
+    ----------
+    settingsMap: dict
+        a fresh copy of the settings map, callers may modify it
+    """
+
+    key_parts = ('settings', get_bin_dir(), os.path.abspath(f"{input_dir}"), os.path.abspath(f"{output_dir}"))
+    return _load_yaml_cached(config, lambda data: _resolve_settings(data, input_dir, output_dir),
+                             key_parts, use_cache, cache_dir)
+
+
 class CodeBlock():
     
     def __init__(self, head, block):
@@ -43,35 +185,6 @@ class CodeBlock():
             else:
                 result += indent + block + '\n' 
         return result
-    
-    
-def class_code(configuration, total_code, in_secondary_loop = False):
-    if isinstance(configuration, dict):
-        for key, value in configuration.items():
-            head = '@dataclass' + '\n' + 'class ' + str(key)
-            block = []
-            if isinstance(value, dict):   
-                for key1, value1 in value.items(): 
-                    if isinstance(value1, dict): 
-                        block.append(str(key1) + ':' + ' ' + str(key1))
-                    elif not isinstance(value1, dict):
-                        value_type = str(type(value1)).split("'")[1]
-                        block.append(str(key1) + ':' + ' ' + value_type)        
-                total_code = str(CodeBlock(head,block)) + total_code
-                total_code = class_code(value,total_code='', in_secondary_loop = True) + total_code
-                in_secondary_loop = False
-            elif not isinstance(value, dict):
-                pass
-                #if in_secondary_loop == False:
-                    #value_type = str(type(value)).split("'")[1]
-                    #block.append(str(key) + ':' + ' ' + value_type)
-                    #total_code = str(CodeBlock(head,block)) + total_code
-                #else:
-                    #pass
-            else:
-                print ('type error')
-                #logger.info("Unsupported Type")
-    return total_code
 
 
 class create_dataclass_file(object):
@@ -80,28 +193,28 @@ class create_dataclass_file(object):
         self.configuration = configuration
         self.results = self.__structure__(self.configuration)
         self.__parser__(self.results)
-       
-    def __structure__(self, configuration):        
-        self.total_code = ''
-        self.code = str(class_code(self.configuration,self.total_code))
-        self.setup = 'from dataclasses import dataclass' + '\n' + '\n' + '#dataclass' + '\n'
-        self.results = self.setup + self.code
+
+    def __structure__(self, configuration):
+        # imported here, typed_config itself builds on this module
+        from constph.typed_config import generate_source
+        self.results = generate_source(configuration)
         return self.results
 
     def __parser__(self, results):
-        file_path = os.getcwd()
-        file_name = '/constph/bin/dataclass.py'
-        tmp_path = file_path + file_name
-        
+        file_name = 'dataclass.py'
+        path = os.path.join(get_bin_dir(), file_name)
+
         try:
-            with open(tmp_path, 'w') as f:
-                f.write(self.results)
-                f.close()
+            atomic_write(path, self.results)
         except IOError:
-            print(f"Data class could not be created: {file_name}")
-            #logger.info(f"Data class could not be created: {file_name}")
-            pass
+            logger.error(f"Data class could not be created: {file_name}")
+
 
 def fill_dataclass(input_dataclass,configuration):
+    """Fills a dataclass from a configuration, through the generated from_dict constructor if there is one"""
+    if hasattr(input_dataclass, 'from_dict'):
+        return input_dataclass.from_dict(configuration)
+    # dacite is only needed for classes without a generated constructor
+    from dacite import from_dict
     filled_class = from_dict(data_class=input_dataclass, data=configuration)
-    return filled_class
\ No newline at end of file
+    return filled_class
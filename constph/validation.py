@@ -0,0 +1,189 @@
+"""
+Validation of configurations before any directory, file or job is produced.
+
+The schema is compiled once into flat field lookups and vectorized range rules, so checking a
+whole campaign is one pass collecting every field into an array per field, followed by one
+NumPy expression per rule.
+"""
+import logging
+from numbers import Integral, Real
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigValidationError(ValueError):
+    """Raised when configurations do not match the schema, carries the list of all errors"""
+
+    def __init__(self, errors: list):
+        self.errors = errors
+        super().__init__(f"{len(errors)} configuration error(s):\n" + "\n".join(f" - {e}" for e in errors))
+
+
+def _aeds_parameters(**extra) -> dict:
+    parameters = {
+        "NSM": Integral,
+        "NSTLIM": Integral,
+        "dt": Real,
+        "ATMNR1": Integral,
+        "ATMNR2": Integral,
+        "NTWX": Integral,
+        "NTWE": Integral,
+        "NSTATES": Integral,
+        "sigma": Real,
+    }
+    parameters.update(extra)
+    return parameters
+
+
+# required fields and their types, nested like the settings map
+SCHEMA = {
+    "system": {"structure": {"name": str, "topo": str, "coord": str, "pttopo": str}},
+    "config": {"paths": {"gromos_bin": str}},
+    "search_run": {"search_parameters": _aeds_parameters(asteps=Integral, bsteps=Integral)},
+    "production_run": {"production_parameters": _aeds_parameters()},
+}
+
+
+def _divisible_or_off(nstlim, stride):
+    """True where stride is switched off (0) or divides nstlim"""
+    return (stride <= 0) | (nstlim % np.maximum(stride, 1) == 0)
+
+
+def _run_rules() -> list:
+    """Range rules shared by the search and the production run"""
+    return [
+        ("{}.dt must be > 0", ("dt",), lambda dt: dt > 0),
+        ("{}.NSTLIM must be > 0", ("NSTLIM",), lambda nstlim: nstlim > 0),
+        ("{}.NSM must be >= 0", ("NSM",), lambda nsm: nsm >= 0),
+        ("{}.NSTATES must be >= 2", ("NSTATES",), lambda nstates: nstates >= 2),
+        ("{}.sigma must be > 0", ("sigma",), lambda sigma: sigma > 0),
+        ("{}.ATMNR1 must be >= 1", ("ATMNR1",), lambda atmnr1: atmnr1 >= 1),
+        ("{}.ATMNR2 must be > ATMNR1", ("ATMNR1", "ATMNR2"), lambda atmnr1, atmnr2: atmnr2 > atmnr1),
+        ("{}.NTWX must be >= 0", ("NTWX",), lambda ntwx: ntwx >= 0),
+        ("{}.NTWE must be >= 0", ("NTWE",), lambda ntwe: ntwe >= 0),
+        ("{}.NSTLIM must be divisible by NTWX", ("NSTLIM", "NTWX"), _divisible_or_off),
+        ("{}.NSTLIM must be divisible by NTWE", ("NSTLIM", "NTWE"), _divisible_or_off),
+    ]
+
+
+# range rules per parameter block: (message, fields, rule), a rule maps the field
+# arrays to a boolean array that is True for valid configurations
+RULES = {
+    ("search_run", "search_parameters"): _run_rules()
+    + [
+        ("{}.asteps must be >= 0", ("asteps",), lambda asteps: asteps >= 0),
+        ("{}.bsteps must be >= 0", ("bsteps",), lambda bsteps: bsteps >= 0),
+    ],
+    ("production_run", "production_parameters"): _run_rules(),
+}
+
+
+def _flatten(schema: dict, prefix: tuple = ()) -> list:
+    fields = []
+    for key, value in schema.items():
+        if isinstance(value, dict):
+            fields += _flatten(value, prefix + (key,))
+        else:
+            fields.append((prefix + (key,), value))
+    return fields
+
+
+def _lookup(settingsMap: dict, path: tuple):
+    value = settingsMap
+    for key in path:
+        value = value[key]
+    return value
+
+
+class ConfigValidator(object):
+    def __init__(self, schema: dict = SCHEMA, rules: dict = RULES):
+        """
+        A schema compiled into flat field paths and vectorized range rules.
+        Parameters
+        ----------
+        schema: dict
+            required fields and their types, nested like the settings map
+        rules: dict
+            (section path) -> list of (message, fields, rule), see RULES
+        """
+
+        self.fields = _flatten(schema)
+        self.rules = [
+            ([section + (field,) for field in fields], message.format(".".join(section)), rule)
+            for section, section_rules in rules.items()
+            for message, fields, rule in section_rules
+        ]
+
+    def errors(self, configurations) -> list:
+        """
+        Checks configurations against the schema.
+        Parameters
+        ----------
+        configurations: iterable
+            settings maps, (name, settings map) pairs or a constph.campaign.Campaign
+        Returns
+        ----------
+        errors: list
+            one message per problem, empty if all configurations are valid
+        """
+
+        if hasattr(configurations, "items") and not isinstance(configurations, dict):
+            configurations = configurations.items()
+        labeled = []
+        for item in configurations:
+            if isinstance(item, dict):
+                name = item.get("system", {}).get("structure", {}).get("name", f"#{len(labeled)}")
+                item = (name, item)
+            labeled.append(item)
+        names = [name for name, _ in labeled]
+
+        errors = []
+        columns = {}
+        for path, expected in self.fields:
+            column = np.full(len(labeled), np.nan)
+            for i, (name, settingsMap) in enumerate(labeled):
+                try:
+                    value = _lookup(settingsMap, path)
+                except (KeyError, TypeError):
+                    errors.append(f"{name}: {'.'.join(path)} is missing")
+                    continue
+                # bool is an Integral, but never a valid number of steps or atoms
+                if not isinstance(value, expected) or isinstance(value, bool):
+                    errors.append(f"{name}: {'.'.join(path)} must be {expected.__name__}, got {value!r}")
+                    continue
+                if expected is not str:
+                    column[i] = value
+            columns[path] = column
+
+        for paths, message, rule in self.rules:
+            arrays = [columns[path] for path in paths]
+            # rows with missing or mistyped fields already have an error
+            known = np.logical_and.reduce([~np.isnan(a) for a in arrays])
+            with np.errstate(invalid="ignore"):
+                invalid = known & ~rule(*arrays)
+            for i in np.flatnonzero(invalid):
+                errors.append(f"{names[i]}: {message}")
+
+        return errors
+
+    def validate(self, configurations):
+        """Raises a ConfigValidationError listing every problem of the configurations"""
+        errors = self.errors(configurations)
+        if errors:
+            raise ConfigValidationError(errors)
+
+
+_default_validator = None
+
+
+def validate_configurations(configurations):
+    """
+    Checks settings maps (or a campaign) against the default schema in one pass and
+    raises a ConfigValidationError with every problem found.
+    """
+    global _default_validator
+    if _default_validator is None:
+        _default_validator = ConfigValidator()
+    _default_validator.validate(configurations)
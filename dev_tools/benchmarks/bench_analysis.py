@@ -0,0 +1,34 @@
+"""
+Times the EXP free-energy estimate of constph.analysis.
+
+    python dev_tools/benchmarks/bench_analysis.py --frames 1000000 --states 2
+"""
+import argparse
+import time
+
+import numpy as np
+
+from constph.analysis import relative_free_energies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=1000000, help="number of frames")
+    parser.add_argument("--states", type=int, default=2, help="number of end states")
+    parser.add_argument("-n", type=int, default=10, help="repetitions")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    e_states = rng.normal(-100.0, 5.0, (args.frames, args.states)) + np.arange(args.states) * 50.0
+    e_ref = e_states.min(axis=1)
+    timings = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        offsets = relative_free_energies(e_states, e_ref)
+        timings.append(time.perf_counter() - start)
+    print(f"{args.frames} frames x {args.states} states: best {min(timings) * 1e3:.1f} ms, "
+          f"median {np.median(timings) * 1e3:.1f} ms, offsets {np.round(offsets, 2)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Times the setup of the intermediate state directories of a campaign, serial and on a thread pool.
+
+    python dev_tools/benchmarks/bench_setup.py --systems 100 --ph-values 8 --workers 1 8 --out /scratch/bench
+"""
+import argparse
+import copy
+import os
+import shutil
+import tempfile
+import time
+
+from constph import load_config_yaml
+from constph.assets import AssetStore
+from constph.batch import ParameterGrid
+from constph.state import StateFactory, setup_systems
+
+CONFIG = "constph/test_suite/test_data/example.yaml"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--systems", type=int, default=100, help="number of systems")
+    parser.add_argument("--ph-values", type=int, default=8, help="production runs per system")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 8], help="thread counts to compare")
+    parser.add_argument("--out", default=None, help="directory on the filesystem to test, default a temporary one")
+    args = parser.parse_args()
+
+    out = tempfile.mkdtemp(dir=args.out)
+    try:
+        settingsMap = load_config_yaml(CONFIG, os.path.join(out, "input", "a", "b"), os.path.join(out, "systems"))
+        structure = settingsMap["system"]["structure"]
+        for key in ("topo", "pttopo", "coord"):
+            path = os.path.join(settingsMap["data_dir_base"], structure[key])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(f"TITLE\n{key}\nEND\n" * 10000)
+        system = type("System", (), {"name": settingsMap["system"]["name"], "structure": structure})
+        grid = ParameterGrid(2, ph_values=[2.0 + i for i in range(args.ph_values)])
+        search = {"EMIN": -320.0, "EMAX": -280.0, "offsets": [0.0, 12.5]}
+
+        for n_workers in args.workers:
+            store = AssetStore(os.path.join(out, f"store{n_workers}"))
+            factories = []
+            for i in range(args.systems):
+                settings = copy.deepcopy(settingsMap)
+                settings["system_dir"] = os.path.join(out, f"systems{n_workers}", f"system{i}")
+                factories.append(StateFactory(system, settings, asset_store=store, aeds_parameters=search))
+            for label in ("fresh", "unchanged"):
+                start = time.perf_counter()
+                reports = setup_systems(factories, grid, n_workers=n_workers)
+                elapsed = time.perf_counter() - start
+                stages = {}
+                for report in reports:
+                    for stage, seconds in report.stage_times.items():
+                        stages[stage] = stages.get(stage, 0.0) + seconds
+                print(f"{n_workers:3d} threads, {label:9s}: {elapsed:6.2f} s, "
+                      f"{sum(r.written for r in reports)} written; "
+                      + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in sorted(stages.items())))
+            print(f"    {store.report}")
+    finally:
+        shutil.rmtree(out, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+Times the batch titration-curve fit of constph.titration.
+
+    python dev_tools/benchmarks/bench_titration.py --sites 10000 --ph-values 25
+"""
+import argparse
+import time
+
+import numpy as np
+
+from constph.titration import fit_titration_curves, hill_curve
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sites", type=int, default=10000, help="number of titratable sites")
+    parser.add_argument("--ph-values", type=int, default=25, help="pH values per ladder")
+    parser.add_argument("--noise", type=float, default=0.02, help="standard error of the fractions")
+    parser.add_argument("-n", type=int, default=5, help="repetitions")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(1)
+    ph = np.linspace(0.0, 12.0, args.ph_values)
+    pka = rng.uniform(2.0, 10.0, args.sites)
+    hill = rng.uniform(0.6, 1.5, args.sites)
+    fractions = hill_curve(ph, pka[:, None], hill[:, None]) + rng.normal(0.0, args.noise, (args.sites, len(ph)))
+    errors = np.full(fractions.shape, args.noise)
+    timings = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        fit = fit_titration_curves(ph, fractions, errors)
+        table = fit.table()
+        timings.append(time.perf_counter() - start)
+    print(f"{args.sites} sites x {len(ph)} pH values: best {min(timings) * 1e3:.1f} ms, "
+          f"median {np.median(timings) * 1e3:.1f} ms, {fit.iterations} iterations, "
+          f"{np.count_nonzero(fit.converged)} converged, median |pKa error| {np.median(np.abs(fit.pka - pka)):.3f}, "
+          f"table {len(table)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares the chunked NumPy reader of energy trajectories with a naive line-by-line parse.
+
+    python dev_tools/benchmarks/bench_tre_reader.py --frames 1000000 --gzip
+
+The synthetic trajectory has the md++ layout read by constph.tre (45 totals, two baths, the eds
+section) and is written once to the given directory (about 1.3 kB per frame), along with the
+columnar cache of the trajectory.
+"""
+import argparse
+import gzip
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from constph.tre import open_trajectory, read_tre
+
+
+def write_synthetic_tre(path, n_frames, nstates, seed=1):
+    rng = np.random.default_rng(seed)
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt") as f:
+        f.write("TITLE\nsynthetic energy trajectory\nEND\nENEVERSION\n 2015-06-23-A\nEND\n")
+        for start in range(0, n_frames, 10000):
+            e_states = rng.normal(-100.0, 5.0, (min(10000, n_frames - start), nstates))
+            frames = []
+            for i, states in enumerate(e_states, start=start):
+                totals = np.zeros(45)
+                totals[34] = states.min()
+                frames.append(
+                    f"TIMESTEP\n{i * 100:15d} {i * 0.2:15.9f}\nEND\nENERGY03\n# totals\n"
+                    + "".join(f"{value:18.9e}\n" for value in totals)
+                    + "# baths\n# numbaths\n 2\n# kinetic total, centre of mass, internal/rotational\n"
+                    + f"{1.0:18.9e}{2.0:18.9e}{3.0:18.9e}\n" * 2
+                    + f"# eds\n# numstates\n{nstates}\n# total nonbonded special\n"
+                    + "".join(f"{value:18.9e}{value:18.9e}{0.0:18.9e}\n" for value in states)
+                    + "END\nVOLUMEPRESSURE03\n# mass\n   3.0e+04\nEND\n"
+                )
+            f.write("".join(frames))
+
+
+def naive_read(path):
+    """Every line through Python, values collected in lists"""
+    time_, e_ref, e_states = [], [], []
+    block = section = None
+    with open_trajectory(path) as f:
+        for line in f:
+            stripped = line.strip()
+            if block is None:
+                block, section, rows = stripped, None, []
+            elif stripped == "END":
+                if block == "TIMESTEP":
+                    time_.append(float(rows[0][1][1]))
+                elif block == "ENERGY03":
+                    totals = [float(value) for row in rows if row[0] == "totals" for value in row[1]]
+                    eds = [row[1] for row in rows if row[0] == "eds"]
+                    e_ref.append(totals[34])
+                    e_states.append([float(values[0]) for values in eds[1:1 + int(eds[0][0])]])
+                block = None
+            elif stripped.startswith("#"):
+                words = stripped[1:].split()
+                if words and words[0] in ("totals", "baths", "eds"):
+                    section = words[0]
+            else:
+                rows.append((section, stripped.split()))
+    return np.array(time_), np.array(e_ref), np.array(e_states)
+
+
+def measure(label, func, path, n_frames, reference=None, memory=False):
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = func(path)
+    elapsed = time.perf_counter() - start
+    peak = f"  peak {tracemalloc.get_traced_memory()[1] / 1e6:.1f} MB" if memory else ""
+    tracemalloc.stop()
+    ratio = f"  ({reference / elapsed:.1f}x faster)" if reference else ""
+    print(f"{label:<12} {elapsed:8.2f} s  {elapsed / n_frames * 1e6:6.2f} us/frame{peak}{ratio}")
+    return elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=1000000, help="frames of the synthetic trajectory")
+    parser.add_argument("--states", type=int, default=2, help="number of end states")
+    parser.add_argument("--gzip", action="store_true", help="gzip the trajectory")
+    parser.add_argument("--dir", default=".", help="where the trajectory is written")
+    parser.add_argument("--memory", action="store_true", help="trace the peak memory (slows both readers down)")
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, f"bench_{args.frames}_{args.states}.tre" + (".gz" if args.gzip else ""))
+    if not os.path.isfile(path):
+        write_synthetic_tre(path, args.frames, args.states)
+    print(f"{path}: {os.path.getsize(path) / 1e6:.1f} MB, {args.frames} frames")
+
+    naive, (time_, e_ref, e_states) = measure("naive", naive_read, path, args.frames, memory=args.memory)
+    _, tre = measure("constph.tre", lambda p: read_tre(p, use_cache=False), path, args.frames, naive, args.memory)
+    # the first cached read parses and writes the columns, the second one maps them
+    read_tre(path, cache_dir=args.dir)
+    _, cached = measure("cached", lambda p: read_tre(p, cache_dir=args.dir), path, args.frames, naive)
+    assert np.array_equal(cached.states, tre.states)
+    assert np.allclose(tre.time, time_) and np.allclose(tre.e_ref, e_ref) and np.allclose(tre.states, e_states)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Compares building typed configs through the generated from_dict constructors with dacite.
+
+    python dev_tools/benchmarks/bench_typed_config.py -n 10000
+"""
+import argparse
+import pickle
+import time
+
+from dacite import from_dict
+
+from constph.typed_config import ROOT_CLASS, build_typed_config, default_schema, load_typed_config_module
+
+
+def timed(label, func, n, reference=None):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    ratio = f"  ({elapsed / reference:.1f}x dicts)" if reference else ""
+    print(f"{label:<28} {elapsed * 1e3:9.1f} ms  {elapsed / n * 1e6:8.2f} us/config{ratio}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", type=int, default=10000, help="number of configs to load")
+    args = parser.parse_args()
+
+    schema = default_schema()
+    module = load_typed_config_module(schema)
+    input_dataclass = getattr(module, ROOT_CLASS)
+    settingsMap = schema[ROOT_CLASS]
+    # load_config_yaml hands out unpickled copies, so that is what loading n dicts costs
+    payload = pickle.dumps(settingsMap, protocol=pickle.HIGHEST_PROTOCOL)
+    configs = [pickle.loads(payload) for _ in range(args.n)]
+
+    dicts = timed("dicts (cached load)", lambda: [pickle.loads(payload) for _ in range(args.n)], args.n)
+    timed("dicts + typed from_dict", lambda: [build_typed_config(pickle.loads(payload), module)
+                                              for _ in range(args.n)], args.n, dicts)
+    timed("typed from_dict only", lambda: [input_dataclass.from_dict(c) for c in configs], args.n, dicts)
+    timed("dacite from_dict only", lambda: [from_dict(data_class=input_dataclass, data=c) for c in configs],
+          args.n, dicts)
+
+
+if __name__ == "__main__":
+    main()